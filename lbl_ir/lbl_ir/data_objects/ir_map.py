@@ -4,6 +4,12 @@ import datetime
 import sys
 import os
 import matplotlib.pyplot as plt  
+from lbl_ir.math_tools.band_stats import compute_band_stats, write_band_stats
+from lbl_ir.math_tools.pyramid import build_image_pyramid, LARGE_MAP_PIXELS
+from lbl_ir.math_tools.absorbance import t_to_a, transmission_scale, MIN_Y_LIMIT
+from lbl_ir.math_tools.pixel_metrics import compute_pixel_metrics, write_pixel_metrics
+from lbl_ir.math_tools.quality import quality_detector, write_quality, read_quality, good_spectra, pixel_quality, \
+    ALL_FLAGS
 
 def val2ind(val, an_array):
     return np.argmin(abs(an_array-val), axis=0)
@@ -93,6 +99,8 @@ class ir_map(object):
 
     write_as_hdf5(self, filename) : Writes in-memory data as an hdf5 file.
 
+    to_absorbance(self)           : Converts transmission data to absorbance in place.
+
     """
 
     def __init__(self, 
@@ -108,6 +116,8 @@ class ir_map(object):
         self._h5_filename = filename
         self.xy          = np.empty( (0,2) )
         self.data        = np.empty( (0,self.N_w) )
+        self.quality     = None # per spectrum quality flags, see math_tools.quality
+        self._data_from_cube = False # whether self.data was flattened from self.imageCube
         self._N_obs      = 0
         self._with_image_cube = with_image_cube
         self._with_factorization = with_factorization
@@ -148,6 +158,7 @@ class ir_map(object):
                   into the ir_map object, 1D int array
         
         """ 
+        self._data_from_cube = False
         if self._mode == 'memory':
             assert spectrum is not None, "please provide a spectrum matrix"
             assert xy is not None, "please provide a xy position array"
@@ -169,6 +180,7 @@ class ir_map(object):
                 else:
                     self.data = self._h5[self._root+'/data/spectra'][ind,:]
                     self.xy   = self._h5[self._root+'/data/xy'][ind,:]  
+            self.quality = read_quality(self._h5_filename, ind)
 
     def add_image_cube(self, imageCube=None, imageMask=None, image_grid_param=None, ind=[]):
         """When working in memory mode, load the image cube data in memory into the ir_map object
@@ -209,6 +221,7 @@ class ir_map(object):
                  self.N_w = len(self.wavenumbers)
             # convert image cube to 2d data matrix and load the data into self.data, self.xy
             self.flatten_image_cube(imageCube, imageMask, image_grid_param)
+            self.quality = None # flags of other spectra don't apply to the pixels of a new cube
                  
         if self._mode == 'hdf5':
             self._h5= h5py.File(self._h5_filename,'r')
@@ -225,6 +238,13 @@ class ir_map(object):
                 self.N_w = len(self.wavenumbers)
                 # convert image cube to 2d data matrix and load the data into self.data, self.xy    
                 self.flatten_image_cube(self.imageCube, self.imageMask, self.image_grid_param)
+                ind_rc_map = self._h5[self._root+'/data/image/ind_rc_map'][:,:]
+            # the flags are in the row order of data/spectra, self.data is in the pixel order of the image mask
+            flags = read_quality(self._h5_filename)
+            if flags is None:
+                self.quality = None
+            else:
+                self.quality = pixel_quality(flags, ind_rc_map, self.imageMask.shape)[self.imageMask]
     
     def add_factorization(self, component=None, component_coef=None, prefix='PCA', ind=[]):
         """When working in memory mode, load the factorized components data in memory into the ir_map object.
@@ -319,13 +339,19 @@ class ir_map(object):
                                       (self._N_obs, self.N_component), 
                                       dtype='float32') # we just allocate space
 
-    def write_as_hdf5(self, filename):
+    def write_as_hdf5(self, filename, pyramid=None, quality=True):
         """Save the object out as an hdf5 file. 
         
         Arguments:
         
         ----------
         filename : The hdf5 filename where data will be written to. 
+
+        pyramid  : Whether to also store a multi-resolution image pyramid (see math_tools.pyramid).
+                   If None(default), it is built for maps with at least LARGE_MAP_PIXELS pixels.
+
+        quality  : Whether to flag spiky, saturated, zeroed and NaN spectra and store the flags
+                   (see math_tools.quality).
         
         """
         # prevent overwriting the existing hdf5 files 
@@ -339,19 +365,86 @@ class ir_map(object):
         with self._h5:
             self._h5[self._root + '/data/xy'][:,:] = self.xy
             self._h5[self._root + '/data/spectra'][:,:] = self.data
+            if quality:
+                detector = quality_detector()
+                self.quality = detector.detect(self.data)
+                write_quality(self._h5, self._root, self.quality, detector.params())
             
             if self._with_image_cube: #save image cube
                 self._h5[self._root + '/data/image/image_cube'][:,:,:] = self.imageCube
                 self._h5[self._root + '/data/image/image_mask'][:,:] = self.imageMask
                 self._h5[self._root + '/data/image/ind_rc_map'][:,:] = self.ind_rc_map
                 self._h5[self._root + '/data/image/image_grid_param'][:] = self.image_grid_param
+                # per-band statistics, so viewers get display levels without reading the cube
+                write_band_stats(self._h5, self._root, compute_band_stats(self.imageCube, self.imageMask))
+                # per-pixel metrics, so auto masks and QC filters don't read the cube
+                write_pixel_metrics(self._h5, self._root,
+                                    compute_pixel_metrics(self.imageCube, self.imageMask, self.wavenumbers))
                 
             if self._with_factorization: #save factorization
                 self._h5[self._root + '/data/factorization/' + self._factor_prefix +'component'][:,:] = self.component
                 self._h5[self._root + '/data/factorization/' + self._factor_prefix +'component_coef'][:,:] = self.component_coef
+
+        if self._with_image_cube:
+            if pyramid is None:
+                pyramid = self.N_y * self.N_x >= LARGE_MAP_PIXELS
+            if pyramid:
+                build_image_pyramid(filename)
         
         print(f'Data is saved as an HDF5 file. Filename : {filename}')
             
+    def good_spectra(self, skip=ALL_FLAGS):
+        """Bool array of the spectra without any of the skip quality flags, all True without quality flags.
+
+        Arguments:
+        ----------
+        skip : flags that disqualify a spectrum, e.g. quality.SPIKE | quality.NON_FINITE
+        """
+        if self.quality is None:
+            return np.ones(self.data.shape[0], dtype=bool)
+        return good_spectra(self.quality, skip)
+
+    def to_absorbance(self, scale=None, eps=1e-10, min_y_limit=MIN_Y_LIMIT):
+        """Convert transmission data to absorbance in place, A = -log10(T / scale).
+
+           When the spectra matrix was flattened from the image cube, only the cube is converted and the spectra
+           matrix is taken from it again. Spectra added with add_data keep their own rows, so the spectra matrix
+           and an image cube built from it with to_image_cube are converted separately.
+
+        Arguments:
+        ----------
+        scale       : 100 for percent transmission, 1 for transmission. If None(default), it is detected from
+                      the first spectrum: data with max(Y) >= min_y_limit is percent transmission, other data is
+                      taken as absorbance and not converted.
+
+        eps         : lower clip of T / scale
+
+        Returns:
+        --------
+        converted   : whether the data was converted
+        """
+        from_cube = self._with_image_cube and self._data_from_cube
+        first = self.imageCube.reshape(-1, self.imageCube.shape[-1])[0] if from_cube else self.data[0]
+        if scale is None:
+            scale = transmission_scale(first, min_y_limit)
+            if scale is None:
+                return False
+
+        def convert(a):
+            if not np.issubdtype(a.dtype, np.floating):
+                a = a.astype('float32')
+            return t_to_a(a, scale, eps, out=a)
+
+        if from_cube:
+            self.imageCube = convert(self.imageCube)
+            self.data = self.imageCube[self.imageMask, :]
+        else:
+            self.data = convert(self.data)
+            if self._with_image_cube:
+                self.imageCube = convert(self.imageCube)
+        self.data_type = 'absorbance'
+        return True
+
     def to_image_cube(self, N_x=64, N_y=64, x0=0, y0=0, dx=1, dy=1):
         """Transform the spectra matrix to 3D image cube. 
         
@@ -397,6 +490,7 @@ class ir_map(object):
         self.imageCube /= np.where(self.pointCounts != 0, self.pointCounts,1)[:,:,np.newaxis]# get average spectra per pixel
         self.imageMask = self.pointCounts.astype('bool') # convert to boolean matrix
         self.ind_rc_map = ind_rc_map
+        self._data_from_cube = False
         
         return self.imageCube, self.imageMask, self.pointCounts
     
@@ -437,6 +531,7 @@ class ir_map(object):
         self.xy = xy_grid[imageMask,:]
         self.data = imageCube[imageMask,:]
         self.ind_rc_map = ind_rc_map
+        self._data_from_cube = True
 
 if __name__ == "__main__":
    si = sample_info(sample_id = 'C_elegans')
@@ -500,5 +595,32 @@ if __name__ == "__main__":
    print(ir_data4.component_coef.shape)
    
    os.remove('tst_file2.h5')
+
+   # absorbance of spectra added row by row keeps them aligned with xy, duplicate pixels included
+   T = np.random.uniform(1, 99, (4, N_wav))
+   ir_data5 = ir_map(waves, si, data_type='transmission')
+   ir_data5.add_data(T, np.array([[0, 0], [1, 0], [1, 0], [2, 1]]))
+   ir_data5.to_image_cube(3, 2)
+   assert ir_data5.to_absorbance()
+   assert ir_data5.data.shape == (4, N_wav) and np.allclose(ir_data5.data, -np.log10(T / 100))
+   assert np.allclose(ir_data5.imageCube[0, 1], -np.log10((T[1] + T[2]) / 200))
+   ir_data3.to_absorbance(scale=1)
+   assert np.array_equal(ir_data3.data, ir_data3.imageCube[imageMask, :])
+
+   # quality flags of an image cube read from hdf5 follow the pixels, for spectra measured in any order
+   peak = np.exp(-(waves - 1650) ** 2 / 2e4)
+   spectra = np.random.uniform(0.5, 1.5, (13, 1)) * peak + 1e-3 * np.random.randn(13, N_wav)
+   spectra[0, 50] += 1.0 # spike in the first measurement
+   xy_rev = np.array([[c, r] for r in range(4) for c in range(3)][::-1] + [[0, 0]], dtype='float')
+   ir_data6 = ir_map(waves, si)
+   ir_data6.add_data(spectra, xy_rev) # measured from the last pixel back, two spectra in pixel (0, 0)
+   ir_data6.to_image_cube(3, 4)
+   ir_data6.write_as_hdf5('tst_file3.h5')
+   assert np.where(ir_data6.quality)[0].tolist() == [0]
+   ir_data7 = ir_map(filename='tst_file3.h5')
+   ir_data7.add_image_cube()
+   bad = ir_data7.xy[~ir_data7.good_spectra()]
+   assert bad.tolist() == [[2, 3]], bad # the pixel of the first measurement, at flattened row 11
+   os.remove('tst_file3.h5')
     
    print('OK')
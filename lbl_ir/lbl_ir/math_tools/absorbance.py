@@ -0,0 +1,171 @@
+"""
+Transmission to absorbance conversion.
+
+One kernel, A = -log(T / scale), used by the map converter, transform.to_absorbance and the NMF data aggregation.
+It works in place or into an output array, a block of rows at a time, so only a block sized temporary is
+allocated. T is clipped to [eps, high] before the log and NaNs are optionally replaced. Maps in hdf5 files are
+converted in place, block by block, with bounded memory.
+
+"""
+
+import numpy as np
+import h5py
+
+from lbl_ir.math_tools.band_stats import STATS_GROUP, backfill_band_stats
+from lbl_ir.math_tools.pyramid import has_pyramid, build_image_pyramid
+from lbl_ir.math_tools.pixel_metrics import METRICS_GROUP, backfill_pixel_metrics
+from lbl_ir.math_tools.quality import QUALITY_PATH, quality_detector, backfill_quality
+
+# max(Y) of a spectrum above which the data is taken as percent transmission
+MIN_Y_LIMIT = 5
+# derived data that is only recomputed on demand, deleted on conversion: band scores of data_prep.data_prepper
+STALE_PATHS = ['/data/band_scores']
+
+
+def transmission_scale(spectrum, min_y_limit=MIN_Y_LIMIT):
+    """
+    Auto detect percent transmission.
+
+    :param spectrum: a spectrum, or any block of spectra
+    :param min_y_limit: max(Y) above which the data is percent transmission
+    :return: 100.0 for percent transmission, None if the data looks like absorbance
+    """
+    return 100.0 if np.nanmax(spectrum) >= min_y_limit else None
+
+
+def t_to_a(data, scale=100.0, eps=1e-10, high=None, base=10, nan=None, out=None, chunk_size=1024):
+    """
+    Convert transmission to absorbance.
+
+    :param data: (N, ...) transmission array, converted along the first axis in blocks of chunk_size
+    :param scale: 100 for percent transmission, 1 for transmission
+    :param eps: lower clip of T / scale
+    :param high: upper clip of T / scale, no upper clip if None
+    :param base: 10 or np.e
+    :param nan: value NaNs are replaced with, NaNs are kept if None
+    :param out: output array of the shape of data, pass data itself to convert in place. A new float32 array,
+                or float64 for float64 data, if None.
+    :param chunk_size: number of rows per block
+    :return: absorbance
+    """
+    if out is None:
+        dtype = data.dtype if np.issubdtype(data.dtype, np.floating) else np.dtype('float32')
+        out = np.empty(data.shape, dtype=dtype)
+    factor = -1.0 / np.log(base)
+    for i0 in range(0, len(data), chunk_size):
+        i1 = min(i0 + chunk_size, len(data))
+        block = np.divide(data[i0:i1], scale, dtype=out.dtype)
+        np.maximum(block, eps, out=block)
+        if high is not None:
+            np.minimum(block, high, out=block)
+        np.log(block, out=block)
+        block *= factor
+        if nan is not None:
+            block[np.isnan(block)] = nan
+        out[i0:i1] = block
+    return out
+
+
+def h5_to_absorbance(filename, scale=None, eps=1e-10, min_y_limit=MIN_Y_LIMIT, chunk_size=1024):
+    """
+    Convert the spectra and the image cube of a map hdf5 file from transmission to absorbance in place.
+
+    The datasets are read and written a block of rows at a time. Band statistics and the image pyramid are
+    rebuilt if the file has them. The spectra dataset is marked with a data_type attribute, so a converted file
+    isn't converted twice. Pixel metrics and quality flags are recomputed too, the flags with the detector
+    parameters they were stored with, and band scores are deleted.
+
+    :param filename: map hdf5 filename
+    :param scale: 100 for percent transmission, 1 for transmission, auto detected from the first spectrum if None
+    :param eps: lower clip of T / scale
+    :param min_y_limit: see transmission_scale
+    :param chunk_size: number of spectra, or image rows, per block
+    :return: True if the file was converted
+    """
+    with h5py.File(filename, 'r+') as f:
+        root = list(f.keys())[0]
+        spectra = f[root + '/data/spectra']
+        if spectra.attrs.get('data_type', '') == 'absorbance':
+            return False
+        if scale is None:
+            scale = transmission_scale(spectra[0, :], min_y_limit)
+            if scale is None:
+                spectra.attrs['data_type'] = 'absorbance'
+                return False
+        for i0 in range(0, spectra.shape[0], chunk_size):
+            i1 = min(i0 + chunk_size, spectra.shape[0])
+            block = spectra[i0:i1]
+            spectra[i0:i1] = t_to_a(block, scale, eps, out=block)
+        spectra.attrs['data_type'] = 'absorbance'
+        for name in STALE_PATHS:
+            if root + name in f:
+                del f[root + name]
+        quality_params = None
+        if root + QUALITY_PATH in f:
+            attrs = f[root + QUALITY_PATH].attrs
+            quality_params = {key: attrs[key] for key in quality_detector().params() if key in attrs}
+        with_cube = root + '/data/image/image_cube' in f
+        if with_cube:
+            cube = f[root + '/data/image/image_cube']
+            rows = max(1, chunk_size // max(cube.shape[1], 1))
+            for r0 in range(0, cube.shape[0], rows):
+                r1 = min(r0 + rows, cube.shape[0])
+                block = cube[r0:r1]
+                cube[r0:r1] = t_to_a(block, scale, eps, out=block)
+        with_stats = root + STATS_GROUP in f
+        with_metrics = root + METRICS_GROUP in f
+    if quality_params is not None:
+        # flags of the transmission spectra: zeroed runs are clipped to 1 / eps and the log changes the spikes
+        backfill_quality(filename, chunk_size, **quality_params)
+    if with_cube and with_stats:
+        backfill_band_stats(filename)
+    if with_cube and with_metrics:
+        backfill_pixel_metrics(filename)
+    if with_cube and has_pyramid(filename):
+        build_image_pyramid(filename)
+    return True
+
+
+if __name__ == "__main__":
+    import os
+    import time
+    from lbl_ir.math_tools.quality import ZERO, read_quality, quality_flags
+
+    np.random.seed(0)
+    T = np.random.uniform(1, 99, (200, 300, 400)).astype('float32')
+    T[0, 0, :3] = [0, np.nan, 150]
+    ref = -np.log10(T / 100 + 1e-10)
+    A = t_to_a(T)
+    assert np.allclose(A[1:], ref[1:], rtol=1e-5)
+    assert np.isnan(A[0, 0, 1]) and (A[0, 0, 0] == np.float32(10)) and (A[0, 0, 2] < 0)
+    assert t_to_a(T, nan=0.0)[0, 0, 1] == 0
+    assert np.allclose(t_to_a(T[1:], base=np.e, high=1 - 1e-5), -np.log(np.clip(T[1:] / 100, 1e-5, 1 - 1e-5)),
+                       rtol=1e-5)
+    assert transmission_scale(T[1, 1]) == 100.0 and transmission_scale(A[1, 1]) is None
+
+    t0 = time.perf_counter()
+    ref = -np.log10(T / 100 + 1e-10)
+    t_numpy = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    t_to_a(T, out=T)
+    t_inplace = time.perf_counter() - t0
+    print(f'{T.nbytes / 2 ** 20:.0f} MB cube: numpy expression {t_numpy:.2f} s, in place {t_inplace:.2f} s')
+
+    T = np.random.uniform(1, 99, (50, 60, 100)).astype('float32')
+    T[0, 0, 20:30] = 0  # zeroed readout
+    with h5py.File('tst_t2a.h5', 'w') as f:
+        f.create_dataset('tst/data/spectra', data=T.reshape(-1, 100))
+        f.create_dataset('tst/data/image/image_cube', data=T)
+    flags = backfill_quality('tst_t2a.h5', min_run=4)
+    assert flags[0] & ZERO
+    assert h5_to_absorbance('tst_t2a.h5', chunk_size=256)
+    with h5py.File('tst_t2a.h5', 'r') as f:
+        assert f['tst' + QUALITY_PATH].attrs['min_run'] == 4
+    # the zeros are clipped to A = 10, flagged as saturated now
+    assert np.array_equal(read_quality('tst_t2a.h5'), quality_flags(t_to_a(T).reshape(-1, 100), min_run=4))
+    assert not h5_to_absorbance('tst_t2a.h5')
+    with h5py.File('tst_t2a.h5', 'r') as f:
+        assert np.allclose(f['tst/data/image/image_cube'][:], t_to_a(T))
+        assert np.allclose(f['tst/data/spectra'][:], t_to_a(T).reshape(-1, 100))
+    os.remove('tst_t2a.h5')
+    print('OK')
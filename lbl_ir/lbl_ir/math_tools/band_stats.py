@@ -0,0 +1,240 @@
+"""
+Per-band statistics of a spectral image cube.
+
+The statistics are computed in one pass over chunks of bands and stored next to the image cube
+in the hdf5 file, so viewers can set display levels and histograms without touching pixel data.
+
+A map file that is open for reading elsewhere, e.g. by the viewer's data handler, can't be written. Statistics
+backfilled for such a file go to a sidecar hdf5 file next to it, '<map>_summary.h5', with the same layout. The
+sidecar is stamped with the modification time and size of the map file and only read while they match.
+
+"""
+
+import os
+import threading
+import warnings
+import numpy as np
+import h5py
+
+STATS_GROUP = '/data/image/band_stats'
+SIDECAR_SUFFIX = '_summary.h5'
+
+_sidecar_lock = threading.Lock()
+STATS_KEYS = ['min', 'max', 'mean', 'std', 'percentiles', 'histogram', 'hist_edges']
+
+
+def _chunk_stats(block, percentiles, n_bins):
+    """
+    Statistics of a (N_pixels, N_bands) block, one value per band
+    """
+    block = np.asarray(block, dtype='float64')
+    with np.errstate(invalid='ignore'):
+        b_min = np.nanmin(block, axis=0)
+        b_max = np.nanmax(block, axis=0)
+        b_mean = np.nanmean(block, axis=0)
+        b_std = np.nanstd(block, axis=0)
+        b_pct = np.nanpercentile(block, percentiles, axis=0).T
+
+    # histogram of every band on its own [min, max] range
+    span = np.where(b_max > b_min, b_max - b_min, 1.0)
+    bins = np.floor((block - b_min) / span * n_bins)
+    bins = np.clip(np.nan_to_num(bins, nan=-1), -1, n_bins - 1).astype('int64')
+    n_bands = block.shape[1]
+    offsets = np.arange(n_bands) * (n_bins + 1)
+    counts = np.bincount((bins + 1 + offsets).ravel(), minlength=n_bands * (n_bins + 1))
+    hist = counts.reshape(n_bands, n_bins + 1)[:, 1:]  # drop the NaN bin
+    edges = b_min[:, np.newaxis] + span[:, np.newaxis] * np.linspace(0, 1, n_bins + 1)
+    return b_min, b_max, b_mean, b_std, b_pct, hist, edges
+
+
+def compute_band_stats(imageCube, imageMask=None, percentiles=(1, 99), n_bins=64, chunk_bands=64):
+    """
+    Compute per-band min, max, mean, std, percentiles and a coarse histogram of an image cube.
+
+    :param imageCube: (N_y, N_x, N_w) array or hdf5 dataset, read chunk_bands bands at a time
+    :param imageMask: (N_y, N_x) bool array of measured pixels, all pixels are used if None
+    :param percentiles: percentiles stored for each band
+    :param n_bins: number of histogram bins per band
+    :param chunk_bands: number of bands read per chunk
+    :return: dict with the STATS_KEYS entries, per-band arrays along the first axis
+    """
+    N_w = imageCube.shape[2]
+    if imageMask is not None:
+        imageMask = np.asarray(imageMask, dtype='bool')
+    stats = {'min': np.zeros(N_w), 'max': np.zeros(N_w), 'mean': np.zeros(N_w), 'std': np.zeros(N_w),
+             'percentiles': np.zeros((N_w, len(percentiles))),
+             'histogram': np.zeros((N_w, n_bins), dtype='int64'),
+             'hist_edges': np.zeros((N_w, n_bins + 1))}
+
+    for b0 in range(0, N_w, chunk_bands):
+        b1 = min(b0 + chunk_bands, N_w)
+        block = imageCube[:, :, b0:b1]
+        if imageMask is not None:
+            block = block[imageMask, :]
+        else:
+            block = block.reshape(-1, b1 - b0)
+        for key, val in zip(STATS_KEYS, _chunk_stats(block, percentiles, n_bins)):
+            stats[key][b0:b1] = val
+    stats['percentile_values'] = np.array(percentiles, dtype='float64')
+    return stats
+
+
+def write_band_stats(h5, root, stats):
+    """
+    Store band statistics in an open hdf5 file, replacing existing ones.
+
+    :param h5: h5py.File opened for writing
+    :param root: sample root group name
+    :param stats: dict from compute_band_stats
+    """
+    group_name = root + STATS_GROUP
+    if group_name in h5:
+        del h5[group_name]
+    group = h5.create_group(group_name)
+    for key in STATS_KEYS:
+        group.create_dataset(key, data=stats[key], dtype='int64' if key == 'histogram' else 'float32')
+    group.attrs['percentile_values'] = stats['percentile_values']
+
+
+def read_band_stats(filename):
+    """
+    Read band statistics from a map hdf5 file, or from its sidecar file.
+
+    :param filename: hdf5 filename
+    :return: stats dict, or None if neither file has band statistics
+    """
+    for name in summary_files(filename):
+        with h5py.File(name, 'r') as f:
+            root = list(f.keys())[0]
+            if root + STATS_GROUP not in f:
+                continue
+            group = f[root + STATS_GROUP]
+            stats = {key: group[key][()] for key in STATS_KEYS}
+            stats['percentile_values'] = group.attrs['percentile_values']
+        return stats
+    return None
+
+
+def sidecar_filename(filename):
+    """Sidecar hdf5 file of a map file, for results that can't be written into the map file"""
+    return os.path.splitext(filename)[0] + SIDECAR_SUFFIX
+
+
+def _map_stamp(filename):
+    st = os.stat(filename)
+    return np.array([st.st_mtime, st.st_size], dtype='float64')
+
+
+def summary_files(filename):
+    """
+    :param filename: map hdf5 filename
+    :return: the map file, followed by its sidecar file if it exists and is up to date with the map file
+    """
+    files = [filename]
+    sidecar = sidecar_filename(filename)
+    if os.path.exists(sidecar):
+        try:
+            with h5py.File(sidecar, 'r') as f:
+                if np.array_equal(f.attrs.get('map_stamp'), _map_stamp(filename)):
+                    files.append(sidecar)
+        except OSError as e:
+            warnings.warn(f'Could not read {sidecar}: {e}')
+    return files
+
+
+def write_summary(filename, writer, *args):
+    """
+    Store backfilled results of a map file with writer(h5, root, *args): into the map file, or into its sidecar
+    file if the map file can't be opened for writing.
+
+    :param filename: map hdf5 filename
+    :param writer: e.g. write_band_stats
+    :return: name of the file written, None if neither could be written
+    """
+    sidecar = sidecar_filename(filename)
+    current = len(summary_files(filename)) > 1
+    try:
+        with h5py.File(filename, 'r+') as f:
+            writer(f, list(f.keys())[0], *args)
+    except (OSError, ValueError):
+        pass  # open for reading elsewhere, or read only
+    else:
+        if current:
+            # the map file changed by our own write, its sidecar results still hold
+            with _sidecar_lock, h5py.File(sidecar, 'a') as f:
+                f.attrs['map_stamp'] = _map_stamp(filename)
+        return filename
+    try:
+        with h5py.File(filename, 'r') as f:
+            root = list(f.keys())[0]
+        stamp = _map_stamp(filename)
+        with _sidecar_lock, h5py.File(sidecar, 'a') as f:
+            if not np.array_equal(f.attrs.get('map_stamp'), stamp):
+                # results of an older version of the map file
+                for key in list(f.keys()):
+                    del f[key]
+            writer(f, root, *args)
+            f.attrs['map_stamp'] = stamp
+        return sidecar
+    except (OSError, ValueError) as e:
+        warnings.warn(f'Could not store the results of {filename} in {sidecar}: {e}')
+        return None
+
+
+def backfill_band_stats(filename, write=True, **kwargs):
+    """
+    Compute band statistics of a map hdf5 file that was saved without them.
+
+    :param filename: hdf5 filename
+    :param write: store the statistics in the file, or in its sidecar file if the file can't be written, see
+                  write_summary
+    :param kwargs: passed to compute_band_stats
+    :return: stats dict
+    """
+    with h5py.File(filename, 'r') as f:
+        root = list(f.keys())[0]
+        imageMask = f[root + '/data/image/image_mask'][:, :]
+        stats = compute_band_stats(f[root + '/data/image/image_cube'], imageMask, **kwargs)
+    if write:
+        write_summary(filename, write_band_stats, stats)
+    return stats
+
+
+def band_levels(stats, i=None):
+    """
+    Display levels from band statistics: the band minimum and its highest stored percentile.
+
+    :param stats: stats dict
+    :param i: band index; levels spanning all bands if None
+    :return: (low, high)
+    """
+    if i is None:
+        return np.nanmin(stats['min']), np.nanmax(stats['percentiles'][:, -1])
+    return stats['min'][i], stats['percentiles'][i, -1]
+
+
+if __name__ == "__main__":
+    np.random.seed(0)
+    cube = np.random.normal(1.0, 0.2, (20, 30, 100))
+    mask = np.random.random((20, 30)) > 0.2
+    stats = compute_band_stats(cube, mask, chunk_bands=16)
+    ref = cube[mask, :]
+    assert np.allclose(stats['mean'], ref.mean(axis=0))
+    assert np.allclose(stats['std'], ref.std(axis=0))
+    assert np.allclose(stats['percentiles'][:, 1], np.percentile(ref, 99, axis=0))
+    assert np.all(stats['histogram'].sum(axis=1) == mask.sum())
+
+    # a map file open for reading elsewhere gets its statistics in the sidecar file
+    with h5py.File('tst_stats.h5', 'w') as f:
+        f.create_dataset('tst/data/image/image_cube', data=cube)
+        f.create_dataset('tst/data/image/image_mask', data=mask)
+    with h5py.File('tst_stats.h5', 'r'):
+        backfill_band_stats('tst_stats.h5', chunk_bands=16)
+        assert os.path.exists(sidecar_filename('tst_stats.h5'))
+        assert np.allclose(read_band_stats('tst_stats.h5')['mean'], stats['mean'])
+    with h5py.File('tst_stats.h5', 'r+') as f:
+        f['tst/data/image/image_cube'][0, 0, 0] = 0  # changed map, the sidecar is stale
+    assert read_band_stats('tst_stats.h5') is None
+    os.remove('tst_stats.h5')
+    os.remove(sidecar_filename('tst_stats.h5'))
+    print('OK')
@@ -0,0 +1,190 @@
+"""
+Batched Savitzky-Golay smoothing and derivatives of spectra.
+
+The filter is a least squares polynomial fit in a moving window, so for a given wavenumber axis, window and
+polynomial order every output point is a fixed linear combination of the window points. These coefficients are
+computed once per axis:
+
+* on a uniform axis the interior points share one convolution kernel, applied with a direct convolution or,
+  for long windows, with FFT convolution;
+* the window is shifted inwards at the ends of the axis, and on a non uniform axis at every point, with
+  coefficients fitted to the actual wavenumbers of the window.
+
+Blocks of spectra are filtered along the last axis, chunked and spread over threads.
+
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from math import factorial
+import numpy as np
+import scipy.ndimage
+import scipy.signal
+
+# windows at least this long are convolved with FFTs
+FFT_WINDOW = 101
+
+
+def local_coefficients(x, window, polyorder, deriv=0):
+    """
+    Savitzky-Golay coefficients of every point of a wavenumber axis, fitted to the actual x of the window.
+
+    :param x: wavenumbers, sorted ascending or descending
+    :param window: odd window length
+    :param polyorder: order of the fitted polynomial, < window
+    :param deriv: derivative order, <= polyorder
+    :return: (N_w, window) coefficients and (N_w,) first window index of every point
+    """
+    x = np.asarray(x, dtype='float64')
+    N_w = len(x)
+    half = window // 2
+    start = np.clip(np.arange(N_w) - half, 0, N_w - window)
+    idx = start[:, None] + np.arange(window)
+    h = np.abs(np.mean(np.diff(x)))
+    t = (x[idx] - x[:, None]) / h  # scaled offsets keep the fit well conditioned
+    V = t[:, :, None] ** np.arange(polyorder + 1)
+    # the deriv-th polynomial coefficient of the local fit, times deriv!, is the derivative at the point
+    coef = np.linalg.pinv(V)[:, deriv, :] * factorial(deriv) / h ** deriv
+    return coef, start
+
+
+def is_uniform(x, rtol=1e-3):
+    """
+    Check whether the wavenumber spacing is uniform within rtol
+    """
+    dx = np.diff(np.asarray(x, dtype='float64'))
+    return np.all(np.abs(dx - dx[0]) <= rtol * np.abs(dx[0]))
+
+
+class savgol(object):
+    """
+    Savitzky-Golay filter for a fixed wavenumber axis.
+
+    Arguments:
+    ----------
+    wavenumbers : wavenumber array
+
+    window      : odd window length, in points; raised to polyorder + 2 if shorter
+
+    polyorder   : order of the fitted polynomial
+
+    deriv       : derivative order, 0 smooths
+
+    n_threads   : number of threads of filter()
+
+    Attributes:
+    -----------
+    uniform     : whether the axis is uniform; the interior of a uniform axis is filtered with one kernel
+
+    coef, start : per point coefficients and first window index, see local_coefficients
+    """
+
+    def __init__(self, wavenumbers, window=11, polyorder=3, deriv=0, n_threads=4):
+        window = max(int(window), polyorder + 2)
+        window += 1 - window % 2  # odd
+        self.wavenumbers = np.asarray(wavenumbers, dtype='float64')
+        self.window = min(window, len(self.wavenumbers) - (1 - len(self.wavenumbers) % 2))
+        if polyorder >= self.window:
+            raise ValueError('polyorder must be less than the window length.')
+        if deriv > polyorder:
+            raise ValueError('deriv must not exceed polyorder.')
+        self.polyorder, self.deriv = polyorder, deriv
+        self.n_threads = n_threads
+        self.uniform = is_uniform(self.wavenumbers)
+        self.coef, self.start = local_coefficients(self.wavenumbers, self.window, polyorder, deriv)
+        if self.uniform:
+            delta = self.wavenumbers[1] - self.wavenumbers[0]
+            self.kernel = scipy.signal.savgol_coeffs(self.window, polyorder, deriv=deriv, delta=delta, use='conv')
+
+    def _windows(self, block, points):
+        """Windows of the given points as a (n, len(points), window) view"""
+        view = np.lib.stride_tricks.sliding_window_view(block, self.window, axis=-1)
+        return view[:, self.start[points], :]
+
+    def __call__(self, block, out=None):
+        """
+        :param block: (n, N_w) spectra
+        :param out: optional (n, N_w) output, not block itself
+        :return: filtered spectra
+        """
+        block = np.asarray(block, dtype='float64')
+        if out is None:
+            out = np.empty(block.shape)
+        if not self.uniform:
+            out[:] = np.einsum('npw,pw->np', self._windows(block, np.arange(block.shape[-1])), self.coef)
+            return out
+        half = self.window // 2
+        if self.window >= FFT_WINDOW:
+            full = scipy.signal.oaconvolve(block, self.kernel[None, :], mode='same', axes=-1)
+        else:
+            full = scipy.ndimage.convolve1d(block, self.kernel[::-1], axis=-1, mode='constant')
+        out[:, half:-half] = full[:, half:-half]
+        edges = np.r_[0:half, block.shape[-1] - half:block.shape[-1]]
+        out[:, edges] = np.einsum('npw,pw->np', self._windows(block, edges), self.coef[edges])
+        return out
+
+    def filter(self, data, out=None, chunk_size=2000):
+        """
+        Filter all spectra of a map, chunk by chunk in a thread pool.
+
+        :param data: (N_obs, N_w) spectra, array or row sliceable dataset
+        :param out: (N_obs, N_w) output array, a new float32 array if None
+        :param chunk_size: number of spectra per task
+        :return: filtered spectra
+        """
+        N_obs = len(data)
+        if out is None:
+            out = np.empty((N_obs, len(self.wavenumbers)), dtype='float32')
+
+        def task(i0, i1):
+            out[i0:i1] = self(data[i0:i1])
+
+        with ThreadPoolExecutor(max_workers=self.n_threads) as executor:
+            futures = [executor.submit(task, i0, min(i0 + chunk_size, N_obs)) for i0 in range(0, N_obs, chunk_size)]
+            for future in futures:
+                future.result()
+        return out
+
+
+def savgol_derivative(wavenumbers, data, window=11, polyorder=3, deriv=2, chunk_size=2000, n_threads=4):
+    """
+    Savitzky-Golay derivative (or smoothing with deriv=0) of one spectrum or of all spectra of a map.
+
+    :param wavenumbers: wavenumber array
+    :param data: (N_w,) spectrum or (N_obs, N_w) spectra
+    :return: filtered data with the shape of data
+    """
+    sg = savgol(wavenumbers, window, polyorder, deriv, n_threads)
+    if np.ndim(data) == 1:
+        return sg(np.asarray(data)[None, :])[0]
+    return sg.filter(data, chunk_size=chunk_size)
+
+
+if __name__ == "__main__":
+    import time
+
+    np.random.seed(0)
+    wavenumbers = np.linspace(4000, 650, 1738)
+    spectra = np.random.random((20000, len(wavenumbers)))
+    for window, deriv in [(11, 0), (15, 2), (151, 1)]:
+        ref = scipy.signal.savgol_filter(spectra[:50], window, 3, deriv=deriv, delta=wavenumbers[1] - wavenumbers[0],
+                                         mode='interp')
+        assert np.allclose(savgol(wavenumbers, window, 3, deriv)(spectra[:50]), ref)
+
+    # a polynomial on a non uniform axis is differentiated exactly
+    x = np.sort(np.random.uniform(650, 4000, 800))[::-1]
+    y = 1e-9 * (x - 2000) ** 3
+    d2 = savgol_derivative(x, np.tile(y, (3, 1)), window=9, polyorder=3, deriv=2)
+    assert np.allclose(d2, 6e-9 * (x - 2000), rtol=1e-6, atol=1e-9)
+
+    sg = savgol(wavenumbers, 15, 3, 2)
+    sg(spectra[:10])
+    t0 = time.perf_counter()
+    for a in spectra[:1000]:
+        np.gradient(np.gradient(a, 1.93), 1.93)
+    t_single = (time.perf_counter() - t0) * len(spectra) / 1000
+    t0 = time.perf_counter()
+    sg.filter(spectra)
+    t_batch = time.perf_counter() - t0
+    print(f'{len(spectra)} spectra: np.gradient per spectrum {t_single:.2f} s (estimated), '
+          f'batched Savitzky-Golay {t_batch:.2f} s')
+    print('OK')
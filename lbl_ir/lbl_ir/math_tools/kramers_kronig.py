@@ -0,0 +1,108 @@
+"""
+Batched Kramers-Kronig transform of spectra.
+
+The EMSC corrections estimate the real part of the refractive index from an absorbance like spectrum with the
+discrete Hilbert transform, -imag(scipy.signal.hilbert(m)). Here the transform is computed for a whole block of
+spectra at once with real FFTs along the last axis. The FFT length and the frequency multiplier are computed
+once per wavenumber axis length and reused for all blocks.
+
+"""
+
+from functools import lru_cache
+import numpy as np
+import scipy.fft
+
+
+class kramers_kronig(object):
+    """
+    Kramers-Kronig transform of spectra with a fixed number of wavenumbers.
+
+    Arguments:
+    ----------
+    N_w        : number of wavenumbers
+
+    pad        : zero pad the spectra to a fast FFT length of at least twice N_w, which reduces the wrap around of
+                 the periodic transform. Without padding the result equals -imag(scipy.signal.hilbert(m)).
+
+    dtype      : working precision, 'float32' or 'float64'
+
+    chunk_size : number of spectra transformed at a time, bounds the memory of the FFT buffers
+
+    workers    : number of threads used by scipy.fft, all cores if None
+    """
+
+    def __init__(self, N_w, pad=False, dtype='float32', chunk_size=4096, workers=None):
+        self.N_w = N_w
+        self.n_fft = scipy.fft.next_fast_len(2 * N_w, real=True) if pad else N_w
+        self.dtype = np.dtype(dtype)
+        self.chunk_size = chunk_size
+        self.workers = -1 if workers is None else workers
+        # -H(x) = irfft(i * sign(f) * X): 0 at DC and at the Nyquist frequency of an even length
+        multiplier = np.full(self.n_fft // 2 + 1, 1j)
+        multiplier[0] = 0
+        if self.n_fft % 2 == 0:
+            multiplier[-1] = 0
+        self.multiplier = multiplier.astype(np.result_type(self.dtype, np.complex64))
+
+    def __call__(self, data, out=None):
+        """
+        :param data: (..., N_w) spectra
+        :param out: optional output array of the same shape
+        :return: Kramers-Kronig transform of every spectrum, in the working precision
+        """
+        data = np.asarray(data)
+        shape = data.shape
+        data = data.reshape(-1, self.N_w)
+        if out is None:
+            out = np.empty(data.shape, dtype=self.dtype)
+        else:
+            out = out.reshape(-1, self.N_w)
+        for i0 in range(0, len(data), self.chunk_size):
+            i1 = min(i0 + self.chunk_size, len(data))
+            X = scipy.fft.rfft(data[i0:i1].astype(self.dtype, copy=False), n=self.n_fft, axis=-1,
+                               workers=self.workers)
+            X *= self.multiplier
+            out[i0:i1] = scipy.fft.irfft(X, n=self.n_fft, axis=-1, workers=self.workers)[:, :self.N_w]
+        return out.reshape(shape)
+
+
+@lru_cache(maxsize=16)
+def _transform(N_w, pad, dtype, chunk_size):
+    return kramers_kronig(N_w, pad=pad, dtype=dtype, chunk_size=chunk_size)
+
+
+def kk_transform(data, pad=False, dtype='float32', chunk_size=4096):
+    """
+    Kramers-Kronig transform of one spectrum or a block of spectra along the last axis.
+
+    :param data: (N_w,) or (N_obs, N_w) spectra
+    :param pad: zero pad to twice the length, see kramers_kronig
+    :param dtype: working precision
+    :param chunk_size: number of spectra transformed at a time
+    :return: transform with the shape of data
+    """
+    data = np.asarray(data)
+    return _transform(data.shape[-1], pad, np.dtype(dtype).name, chunk_size)(data)
+
+
+if __name__ == "__main__":
+    import time
+    from scipy.signal import hilbert
+
+    np.random.seed(0)
+    for N_w in [1738, 435]:
+        data = np.random.random((100, N_w))
+        ref = -1.0 * np.imag(hilbert(data))
+        assert np.allclose(kk_transform(data, dtype='float64'), ref)
+        assert np.allclose(kk_transform(data), ref, atol=1e-4)
+        assert np.allclose(kk_transform(data[0], dtype='float64'), ref[0])
+
+    data = np.random.random((20000, 1738)).astype('float32')
+    t0 = time.perf_counter()
+    for m in data[:1000]:
+        -1.0 * np.imag(hilbert(m))
+    t_single = (time.perf_counter() - t0) * len(data) / 1000
+    t0 = time.perf_counter()
+    kk_transform(data)
+    t_batch = time.perf_counter() - t0
+    print(f'{len(data)} spectra: one at a time {t_single:.2f} s (estimated), batched float32 {t_batch:.2f} s')
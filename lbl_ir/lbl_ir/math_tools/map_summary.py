@@ -0,0 +1,128 @@
+"""
+Band statistics and pixel metrics of maps saved without them, in one read of the image cube.
+
+Maps converted before band statistics and pixel metrics existed get both from one background pass. The image
+cube is read once, a block of image rows at a time. The pixel metrics and the per-band min, max, mean and std are
+exact; the per-band percentiles and histograms come from an evenly strided sample of pixels, the histogram counts
+scaled to the number of pixels. Spectra with NaNs are left out of the band statistics.
+
+The results are stored in the map file, or in its sidecar file while the map is open for reading elsewhere, see
+band_stats.write_summary.
+
+"""
+
+import numpy as np
+import h5py
+
+from lbl_ir.math_tools.band_stats import _chunk_stats, write_band_stats, write_summary
+from lbl_ir.math_tools.pixel_metrics import METRIC_NAMES, metrics_calculator, write_pixel_metrics
+from lbl_ir.math_tools.streaming_stats import running_stats
+
+
+def compute_map_summary(imageCube, imageMask, wavenumbers, percentiles=(1, 99), n_bins=64, sample_size=65536,
+                        chunk_pixels=4096):
+    """
+    Band statistics and pixel metrics of an image cube, in one pass over blocks of image rows.
+
+    :param imageCube: (N_y, N_x, N_w) array or hdf5 dataset
+    :param imageMask: (N_y, N_x) bool array of measured pixels, all pixels are used if None
+    :param wavenumbers: wavenumber array
+    :param percentiles: percentiles stored for each band
+    :param n_bins: number of histogram bins per band
+    :param sample_size: approximate number of pixels of the percentiles and histograms
+    :param chunk_pixels: approximate number of pixels per block
+    :return: stats dict as band_stats.compute_band_stats, metrics dict as pixel_metrics.compute_pixel_metrics
+    """
+    N_y, N_x, N_w = imageCube.shape
+    if imageMask is None:
+        imageMask = np.ones((N_y, N_x), dtype=bool)
+    imageMask = np.asarray(imageMask, dtype=bool)
+    calc = metrics_calculator(wavenumbers)
+    metrics = {name: np.full((N_y, N_x), np.nan, dtype='float32') for name in METRIC_NAMES}
+    stats = running_stats(N_w, covariance=False)
+    step = max(1, int(imageMask.sum()) // sample_size)
+    sample = []
+    n_seen = 0
+    rows = max(1, chunk_pixels // max(N_x, 1))
+    for r0 in range(0, N_y, rows):
+        r1 = min(r0 + rows, N_y)
+        sel = imageMask[r0:r1]
+        if not sel.any():
+            continue
+        block = np.asarray(imageCube[r0:r1])[sel]
+        for name, val in calc(block).items():
+            metrics[name][r0:r1][sel] = val
+        finite = np.all(np.isfinite(block), axis=1)
+        stats.update(block, finite)
+        # pixels n_seen, n_seen + 1, ... of the map, every step-th one is sampled
+        sample.append(block[(np.arange(n_seen, n_seen + len(block)) % step == 0) & finite])
+        n_seen += len(block)
+
+    sample = np.concatenate(sample) if sample else np.zeros((0, N_w))
+    band_stats = {'min': stats.min, 'max': stats.max, 'mean': stats.mean, 'std': stats.std(ddof=0)}
+    if len(sample):
+        _, _, _, _, pct, hist, edges = _chunk_stats(sample, percentiles, n_bins)
+        hist = np.round(hist * (stats.count / len(sample))).astype('int64')
+    else:
+        pct = np.full((N_w, len(percentiles)), np.nan)
+        hist, edges = np.zeros((N_w, n_bins), dtype='int64'), np.zeros((N_w, n_bins + 1))
+    band_stats.update({'percentiles': pct, 'histogram': hist, 'hist_edges': edges})
+    band_stats['percentile_values'] = np.array(percentiles, dtype='float64')
+    return band_stats, metrics
+
+
+def backfill_map_summary(filename, write=True, **kwargs):
+    """
+    Compute band statistics and pixel metrics of a map hdf5 file that was saved without them, in one read.
+
+    :param filename: hdf5 filename
+    :param write: store the results in the file, or in its sidecar file if the file can't be written
+    :param kwargs: passed to compute_map_summary
+    :return: stats dict, metrics dict
+    """
+    with h5py.File(filename, 'r') as f:
+        root = list(f.keys())[0]
+        imageMask = f[root + '/data/image/image_mask'][:, :]
+        wavenumbers = f[root + '/data/wavenumbers'][:]
+        stats, metrics = compute_map_summary(f[root + '/data/image/image_cube'], imageMask, wavenumbers, **kwargs)
+    if write:
+        write_summary(filename, lambda h5, root: (write_band_stats(h5, root, stats),
+                                                  write_pixel_metrics(h5, root, metrics)))
+    return stats, metrics
+
+
+if __name__ == "__main__":
+    import os
+    from lbl_ir.math_tools.band_stats import compute_band_stats, read_band_stats, sidecar_filename
+    from lbl_ir.math_tools.pixel_metrics import compute_pixel_metrics, read_pixel_metrics
+
+    np.random.seed(0)
+    wavenumbers = np.linspace(4000, 650, 400)
+    cube = (np.random.uniform(0, 1, (120, 90, 1)) * np.exp(-(wavenumbers - 1650) ** 2 / 300)
+            + 0.01 * np.random.randn(120, 90, len(wavenumbers))).astype('float32')
+    mask = np.random.random((120, 90)) > 0.1
+
+    stats, metrics = compute_map_summary(cube, mask, wavenumbers, sample_size=5000, chunk_pixels=1000)
+    ref_stats = compute_band_stats(cube, mask)
+    ref_metrics = compute_pixel_metrics(cube, mask, wavenumbers)
+    for key in ['min', 'max', 'mean', 'std']:
+        assert np.allclose(stats[key], ref_stats[key], rtol=1e-5, atol=1e-6), key
+    assert all(np.allclose(metrics[k], ref_metrics[k], equal_nan=True) for k in METRIC_NAMES)
+    # sampled percentiles within a few percent of the spread of the band
+    spread = ref_stats['max'] - ref_stats['min']
+    assert np.all(np.abs(stats['percentiles'] - ref_stats['percentiles']) < 0.05 * spread[:, None])
+    assert np.allclose(stats['histogram'].sum(axis=1), mask.sum(), rtol=0.01)
+
+    # one read of a map file that is open elsewhere, both results land in the sidecar file
+    with h5py.File('tst_summary.h5', 'w') as f:
+        f.create_dataset('tst/data/wavenumbers', data=wavenumbers)
+        f.create_dataset('tst/data/image/image_cube', data=cube)
+        f.create_dataset('tst/data/image/image_mask', data=mask)
+    with h5py.File('tst_summary.h5', 'r'):
+        backfill_map_summary('tst_summary.h5')
+        assert np.allclose(read_band_stats('tst_summary.h5')['mean'], stats['mean'])
+        stored = read_pixel_metrics('tst_summary.h5')
+        assert all(np.allclose(stored[k], metrics[k], equal_nan=True) for k in METRIC_NAMES)
+    os.remove('tst_summary.h5')
+    os.remove(sidecar_filename('tst_summary.h5'))
+    print('OK')
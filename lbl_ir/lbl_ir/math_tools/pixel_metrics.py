@@ -0,0 +1,241 @@
+"""
+Per-pixel quality metrics of a spectral image cube.
+
+The metrics are computed in one pass over blocks of image rows and stored as (N_y, N_x) images next to the image
+cube in the hdf5 file, so masks, QC filters and ROI suggestions are comparisons of small images instead of cube
+reads:
+
+* amide_I, amide_II : absorbance at the band nearest 1650 and 1550 cm-1
+* total_absorbance  : area under the spectrum, trapezoidal rule over the wavenumbers
+* baseline_slope    : slope, per cm-1, of the line through the mean absorbance at both ends of the spectrum
+* snr               : amide I peak height over the noise, the robust std of second differences in a band free region
+* water_vapour      : rms roughness of the water bending region over the noise of the band free region, ~1
+                      without water vapour lines
+
+Metrics whose wavenumber regions are outside of the measured range are NaN, as are pixels outside of the image
+mask.
+
+"""
+
+import numpy as np
+import h5py
+
+from lbl_ir.math_tools.band_stats import summary_files, write_summary
+from lbl_ir.tasks.preprocessing.normalize import trapezoid_weights
+
+METRICS_GROUP = '/data/image/metrics'
+METRIC_NAMES = ['amide_I', 'amide_II', 'total_absorbance', 'baseline_slope', 'snr', 'water_vapour']
+
+AMIDE_I = 1650
+AMIDE_II = 1550
+AMIDE_I_REGION = (1600, 1700)
+QUIET_REGION = (1900, 2250)  # no bands of biological samples, left of the CO2 doublet
+WATER_REGION = (1400, 1900)
+END_FRACTION = 0.02
+
+
+def _region(wavenumbers, region, min_points=3):
+    idx = np.where((wavenumbers >= min(region)) & (wavenumbers <= max(region)))[0]
+    return idx if len(idx) >= min_points else None
+
+
+def _roughness(block, robust=True):
+    """
+    Noise level from the second differences along the last axis: their robust std (MAD), or their rms, which
+    includes sparse sharp lines
+    """
+    d2 = np.diff(block, n=2, axis=-1)
+    # the second difference of white noise has variance 6 sigma^2
+    if robust:
+        return 1.4826 * np.median(np.abs(d2 - np.median(d2, axis=-1, keepdims=True)), axis=-1) / np.sqrt(6)
+    return np.sqrt(np.mean(d2 ** 2, axis=-1) / 6)
+
+
+class metrics_calculator(object):
+    """
+    Pixel metrics of blocks of spectra on a fixed wavenumber axis. Band indexes and weights are resolved once.
+
+    Arguments:
+    ----------
+    wavenumbers : wavenumber array
+    """
+
+    def __init__(self, wavenumbers):
+        w = np.asarray(wavenumbers, dtype='float64')
+        self.wavenumbers = w
+        inside = lambda v: min(w) <= v <= max(w)
+        self.i_amide_I = int(np.argmin(np.abs(w - AMIDE_I))) if inside(AMIDE_I) else None
+        self.i_amide_II = int(np.argmin(np.abs(w - AMIDE_II))) if inside(AMIDE_II) else None
+        self.area_weights = trapezoid_weights(w)
+        n_end = max(1, int(END_FRACTION * len(w)))
+        self.ends = (np.arange(n_end), np.arange(len(w) - n_end, len(w)))
+        self.dw = w[self.ends[1]].mean() - w[self.ends[0]].mean()
+        self.amide_I_region = _region(w, AMIDE_I_REGION)
+        self.quiet = _region(w, QUIET_REGION, 8)
+        self.water = _region(w, WATER_REGION, 8)
+
+    def __call__(self, block):
+        """
+        :param block: (n, N_w) spectra
+        :return: dict of (n,) float32 metrics
+        """
+        block = np.asarray(block, dtype='float64')
+        n = len(block)
+        nan = np.full(n, np.nan)
+        out = {}
+        out['amide_I'] = block[:, self.i_amide_I] if self.i_amide_I is not None else nan
+        out['amide_II'] = block[:, self.i_amide_II] if self.i_amide_II is not None else nan
+        out['total_absorbance'] = np.abs(block @ self.area_weights)
+        out['baseline_slope'] = (block[:, self.ends[1]].mean(axis=1) - block[:, self.ends[0]].mean(axis=1)) / self.dw
+        noise = _roughness(block[:, self.quiet]) if self.quiet is not None else nan
+        with np.errstate(divide='ignore', invalid='ignore'):
+            if (self.amide_I_region is not None) and (self.quiet is not None):
+                height = block[:, self.amide_I_region].max(axis=1) - np.median(block[:, self.quiet], axis=1)
+                out['snr'] = height / noise
+            else:
+                out['snr'] = nan
+            if (self.water is not None) and (self.quiet is not None):
+                out['water_vapour'] = _roughness(block[:, self.water], robust=False) / noise
+            else:
+                out['water_vapour'] = nan
+        return {key: np.asarray(val, dtype='float32') for key, val in out.items()}
+
+
+def compute_pixel_metrics(imageCube, imageMask, wavenumbers, chunk_pixels=4096):
+    """
+    Metrics of every pixel of an image cube, in one pass over blocks of image rows.
+
+    :param imageCube: (N_y, N_x, N_w) array or hdf5 dataset
+    :param imageMask: (N_y, N_x) bool array of measured pixels, all pixels are used if None
+    :param wavenumbers: wavenumber array
+    :param chunk_pixels: approximate number of pixels per block
+    :return: dict of (N_y, N_x) float32 metric images, NaN outside of the mask
+    """
+    N_y, N_x, N_w = imageCube.shape
+    calc = metrics_calculator(wavenumbers)
+    metrics = {name: np.full((N_y, N_x), np.nan, dtype='float32') for name in METRIC_NAMES}
+    rows = max(1, chunk_pixels // max(N_x, 1))
+    for r0 in range(0, N_y, rows):
+        r1 = min(r0 + rows, N_y)
+        sel = np.ones((r1 - r0, N_x), dtype=bool) if imageMask is None else np.asarray(imageMask[r0:r1], dtype=bool)
+        if not sel.any():
+            continue
+        block = np.asarray(imageCube[r0:r1])[sel]
+        for name, val in calc(block).items():
+            metrics[name][r0:r1][sel] = val
+    return metrics
+
+
+def metric_mask(metrics, **limits):
+    """
+    Pixels whose metrics are within limits, e.g. metric_mask(metrics, amide_II=(0.1, None), water_vapour=(None, 2)).
+
+    :param metrics: dict of metric images
+    :param limits: metric name = (low, high), None for no limit; limits are exclusive
+    :return: bool image, NaN metrics fail
+    """
+    mask = None
+    for name, (low, high) in limits.items():
+        m = np.asarray(metrics[name])
+        ok = np.isfinite(m)
+        with np.errstate(invalid='ignore'):
+            if low is not None:
+                ok &= m > low
+            if high is not None:
+                ok &= m < high
+        mask = ok if mask is None else mask & ok
+    return mask
+
+
+def write_pixel_metrics(h5, root, metrics):
+    """
+    Store pixel metrics in an open hdf5 file, replacing existing ones.
+
+    :param h5: h5py.File opened for writing
+    :param root: sample root group name
+    :param metrics: dict from compute_pixel_metrics
+    """
+    group_name = root + METRICS_GROUP
+    if group_name in h5:
+        del h5[group_name]
+    group = h5.create_group(group_name)
+    for name, val in metrics.items():
+        group.create_dataset(name, data=val, dtype='float32')
+
+
+def read_pixel_metrics(filename):
+    """
+    Read pixel metrics from a map hdf5 file, or from its sidecar file.
+
+    :param filename: hdf5 filename
+    :return: dict of metric images, or None if neither file has pixel metrics
+    """
+    for name in summary_files(filename):
+        with h5py.File(name, 'r') as f:
+            root = list(f.keys())[0]
+            if root + METRICS_GROUP not in f:
+                continue
+            group = f[root + METRICS_GROUP]
+            return {key: group[key][()] for key in group}
+    return None
+
+
+def backfill_pixel_metrics(filename, write=True, **kwargs):
+    """
+    Compute the pixel metrics of a map hdf5 file that was saved without them.
+
+    :param filename: hdf5 filename
+    :param write: store the metrics in the file, or in its sidecar file if the file can't be written, see
+                  band_stats.write_summary
+    :param kwargs: passed to compute_pixel_metrics
+    :return: metrics dict
+    """
+    with h5py.File(filename, 'r') as f:
+        root = list(f.keys())[0]
+        imageMask = f[root + '/data/image/image_mask'][:, :]
+        wavenumbers = f[root + '/data/wavenumbers'][:]
+        metrics = compute_pixel_metrics(f[root + '/data/image/image_cube'], imageMask, wavenumbers, **kwargs)
+    if write:
+        write_summary(filename, write_pixel_metrics, metrics)
+    return metrics
+
+
+if __name__ == "__main__":
+    import os
+    import time
+
+    np.random.seed(0)
+    wavenumbers = np.linspace(4000, 650, 1738)
+    amide = np.exp(-(wavenumbers - 1650) ** 2 / 300) + 0.6 * np.exp(-(wavenumbers - 1550) ** 2 / 300)
+    N_y, N_x = 200, 150
+    scale = np.random.uniform(0, 1, (N_y, N_x, 1))
+    cube = scale * amide + 1e-5 * (wavenumbers - 650) + 0.002 * np.random.randn(N_y, N_x, len(wavenumbers))
+    cube = cube.astype('float32')
+    lines = np.zeros(len(wavenumbers))
+    lines[np.where((wavenumbers > 1400) & (wavenumbers < 1900))[0][::7]] = 0.05
+    cube[:10] += lines  # water vapour in the first rows
+    mask = np.ones((N_y, N_x), dtype=bool)
+    mask[-1, :] = False
+
+    t0 = time.perf_counter()
+    metrics = compute_pixel_metrics(cube, mask, wavenumbers)
+    t = time.perf_counter() - t0
+    i1550 = np.argmin(np.abs(wavenumbers - 1550))
+    assert np.allclose(metrics['amide_II'][mask], cube[:, :, i1550][mask])
+    assert np.all(np.isnan(metrics['amide_II'][-1]))
+    assert np.allclose(np.nanmedian(metrics['baseline_slope']), 1e-5, rtol=0.05)
+    assert np.corrcoef(metrics['snr'][mask], scale[:, :, 0][mask])[0, 1] > 0.9
+    assert np.nanmin(metrics['water_vapour'][:10]) > 2 * np.nanmax(metrics['water_vapour'][10:])
+    auto = metric_mask(metrics, amide_II=(0.3, None))
+    assert np.array_equal(auto, (cube[:, :, i1550] > 0.3) & mask)
+    print(f'{N_y * N_x} pixels: metrics in {t:.2f} s')
+
+    with h5py.File('tst_metrics.h5', 'w') as f:
+        f.create_dataset('tst/data/wavenumbers', data=wavenumbers)
+        f.create_dataset('tst/data/image/image_cube', data=cube)
+        f.create_dataset('tst/data/image/image_mask', data=mask)
+    backfill_pixel_metrics('tst_metrics.h5', chunk_pixels=1000)
+    stored = read_pixel_metrics('tst_metrics.h5')
+    assert all(np.allclose(stored[k], metrics[k], equal_nan=True) for k in METRIC_NAMES)
+    os.remove('tst_metrics.h5')
+    print('OK')
@@ -0,0 +1,171 @@
+"""
+Multi-resolution spatial pyramid of a spectral image cube.
+
+Level k of the pyramid is the image cube averaged over 2^k x 2^k pixel blocks. Levels are stored as extra
+hdf5 datasets next to the image cube, so a viewer can show very large maps and mosaics at the resolution
+of the screen and read full resolution data only for the visible region.
+
+"""
+
+import numpy as np
+import h5py
+
+PYRAMID_GROUP = '/data/image/pyramid'
+# maps with at least this many pixels get a pyramid by default when saved
+LARGE_MAP_PIXELS = 1024 * 1024
+
+
+def _downsample(block, weight):
+    """
+    2x2 weighted average of an image block.
+
+    :param block: (rows, cols, N_w) array
+    :param weight: (rows, cols) number of measured pixels behind each pixel, 0 for blank pixels
+    :return: averaged (ceil(rows/2), ceil(cols/2), N_w) block and its summed weights
+    """
+    rows, cols = weight.shape
+    pad = ((0, rows % 2), (0, cols % 2))
+    if rows % 2 or cols % 2:
+        block = np.pad(block, pad + ((0, 0),))
+        weight = np.pad(weight, pad)
+    rows, cols = weight.shape
+    w_sum = weight.reshape(rows // 2, 2, cols // 2, 2).sum(axis=(1, 3))
+    b_sum = (block * weight[:, :, np.newaxis]).reshape(rows // 2, 2, cols // 2, 2, -1).sum(axis=(1, 3))
+    b_sum /= np.where(w_sum > 0, w_sum, 1)[:, :, np.newaxis]
+    return b_sum.astype('float32'), w_sum
+
+
+def build_image_pyramid(filename, min_size=256, max_block_bytes=64 * 2 ** 20):
+    """
+    Build the image pyramid of a map hdf5 file in a streaming pass over blocks of rows.
+
+    Blank pixels (image_mask == False) don't contribute to the averages.
+
+    :param filename: hdf5 filename, opened for writing
+    :param min_size: levels are added until both image dimensions are at most min_size
+    :param max_block_bytes: approximate size of a block of rows read at a time
+    :return: number of levels, including the full resolution image cube
+    """
+    with h5py.File(filename, 'r+') as f:
+        root = list(f.keys())[0]
+        if root + PYRAMID_GROUP in f:
+            del f[root + PYRAMID_GROUP]
+        group = f.create_group(root + PYRAMID_GROUP)
+        src = f[root + '/data/image/image_cube']
+        weight = f[root + '/data/image/image_mask'][:, :].astype('float32')
+
+        level = 0
+        while max(src.shape[:2]) > min_size:
+            level += 1
+            N_y, N_x, N_w = src.shape
+            dst = group.create_dataset('level_%d' % level, ((N_y + 1) // 2, (N_x + 1) // 2, N_w), dtype='float32')
+            # an even number of rows per block keeps 2x2 blocks aligned
+            rows = max(2, int(max_block_bytes // (N_x * N_w * 4)) // 2 * 2)
+            for r0 in range(0, N_y, rows):
+                r1 = min(r0 + rows, N_y)
+                block, _ = _downsample(src[r0:r1, :, :], weight[r0:r1, :])
+                dst[r0 // 2: r0 // 2 + block.shape[0], :, :] = block
+            _, weight = _downsample(np.zeros(weight.shape + (0,), dtype='float32'), weight)
+            group.create_dataset('weight_%d' % level, data=weight, dtype='float32')
+            src = dst
+        group.attrs['n_levels'] = level + 1
+    return level + 1
+
+
+def has_pyramid(filename):
+    """
+    Check whether a map hdf5 file has pyramid levels
+    """
+    with h5py.File(filename, 'r') as f:
+        root = list(f.keys())[0]
+        return (root + PYRAMID_GROUP in f) and (f[root + PYRAMID_GROUP].attrs.get('n_levels', 1) > 1)
+
+
+class pyramid_source(object):
+    """
+    Read band images of a map from the pyramid level that matches the display resolution.
+
+    Arguments:
+    ----------
+    filename : hdf5 filename of a map with pyramid levels
+
+    Attributes:
+    -----------
+    levels              : list of hdf5 datasets, levels[0] is the full resolution image cube
+
+    shape               : shape of the full resolution image cube
+
+    pick_level(zoom)    : level to display given the number of full resolution pixels per screen pixel
+
+    band(E, level, region) : band image of a region of the map at a given level
+    """
+
+    def __init__(self, filename):
+        self._h5 = h5py.File(filename, 'r')
+        root = list(self._h5.keys())[0]
+        self.levels = [self._h5[root + '/data/image/image_cube']]
+        if root + PYRAMID_GROUP in self._h5:
+            group = self._h5[root + PYRAMID_GROUP]
+            for level in range(1, group.attrs['n_levels']):
+                self.levels.append(group['level_%d' % level])
+        self.shape = self.levels[0].shape
+
+    @property
+    def n_levels(self):
+        return len(self.levels)
+
+    def pick_level(self, zoom):
+        """
+        :param zoom: full resolution pixels per screen pixel
+        :return: the coarsest level that still has at least one pixel per screen pixel
+        """
+        level = int(np.floor(np.log2(max(zoom, 1.0))))
+        return min(level, self.n_levels - 1)
+
+    def band(self, E, level=0, region=None):
+        """
+        Read a band image.
+
+        :param E: band index
+        :param level: pyramid level
+        :param region: (r0, r1, c0, c1) in full resolution pixels, the whole map if None
+        :return: image, and the (r0, r1, c0, c1) full resolution region it covers
+        """
+        s = 2 ** level
+        dset = self.levels[level]
+        if region is None:
+            r0, r1, c0, c1 = 0, dset.shape[0], 0, dset.shape[1]
+        else:
+            r0 = int(np.clip(np.floor(region[0] / s), 0, dset.shape[0]))
+            r1 = int(np.clip(np.ceil(region[1] / s), r0, dset.shape[0]))
+            c0 = int(np.clip(np.floor(region[2] / s), 0, dset.shape[1]))
+            c1 = int(np.clip(np.ceil(region[3] / s), c0, dset.shape[1]))
+        img = dset[r0:r1, c0:c1, E]
+        return img, (r0 * s, r1 * s, c0 * s, c1 * s)
+
+    def value(self, E, row, col):
+        return self.levels[0][row, col, E]
+
+    def close(self):
+        self._h5.close()
+
+
+if __name__ == "__main__":
+    import os
+    np.random.seed(0)
+    cube = np.random.random((37, 50, 8)).astype('float32')
+    mask = np.random.random((37, 50)) > 0.1
+    with h5py.File('tst_pyramid.h5', 'w') as f:
+        f.create_dataset('tst/data/image/image_cube', data=cube)
+        f.create_dataset('tst/data/image/image_mask', data=mask)
+    n_levels = build_image_pyramid('tst_pyramid.h5', min_size=8, max_block_bytes=4 * 50 * 8 * 6)
+    src = pyramid_source('tst_pyramid.h5')
+    assert src.n_levels == n_levels == 4
+    img, covered = src.band(3, level=1)
+    block = cube[0:2, 0:2, 3]
+    assert np.isclose(img[0, 0], block[mask[0:2, 0:2]].mean())
+    img, covered = src.band(3, level=0, region=(10.5, 20.2, 5, 9))
+    assert covered == (10, 21, 5, 9) and np.allclose(img, cube[10:21, 5:9, 3])
+    src.close()
+    os.remove('tst_pyramid.h5')
+    print('OK')
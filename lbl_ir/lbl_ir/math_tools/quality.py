@@ -0,0 +1,252 @@
+"""
+Per-spectrum quality flags: spikes, saturation, zeroed regions and NaNs.
+
+Every spectrum gets a bitmask of the problems found in it:
+
+* SPIKE      : a single channel sticks out of its neighbors, e.g. a cosmic ray. The second difference
+               x[i] - (x[i-1] + x[i+1]) / 2 removes the smooth spectral shape; its robust per-band z-score against
+               the median and MAD of the map flags the channel. Real narrow bands are present in most pixels and
+               so are part of the per-band median and MAD.
+* SATURATED  : a run of at least min_run channels clipped flat at the maximum or minimum of the spectrum
+* ZERO       : a run of at least min_run channels that are exactly 0, e.g. a dropped detector readout
+* NON_FINITE : NaN or inf values
+
+The per-band median and MAD come from an evenly strided sample of spectra, then all spectra are flagged in one
+pass over blocks of rows. The flags are stored next to the spectra in the map hdf5 file, aligned with the rows
+of data/spectra, so later analyses can skip flagged pixels without scanning the data again.
+
+"""
+
+import numpy as np
+import h5py
+
+SPIKE = 1
+SATURATED = 2
+ZERO = 4
+NON_FINITE = 8
+FLAG_NAMES = {SPIKE: 'spike', SATURATED: 'saturated', ZERO: 'zero', NON_FINITE: 'non_finite'}
+ALL_FLAGS = SPIKE | SATURATED | ZERO | NON_FINITE
+
+QUALITY_PATH = '/data/quality'
+
+
+def _second_difference(block):
+    """Residual of every interior channel against the mean of its two neighbors"""
+    return block[:, 1:-1] - 0.5 * (block[:, :-2] + block[:, 2:])
+
+
+def _has_run(mask, min_run):
+    """Whether every row of a bool array has at least min_run consecutive True values"""
+    if mask.shape[1] < min_run:
+        return np.zeros(len(mask), dtype=bool)
+    c = np.zeros((mask.shape[0], mask.shape[1] + 1), dtype='int32')
+    np.cumsum(mask, axis=1, out=c[:, 1:])
+    return np.any(c[:, min_run:] - c[:, :-min_run] == min_run, axis=1)
+
+
+class quality_detector(object):
+    """
+    Spike, saturation, zero and NaN detector for the spectra of a map.
+
+    Arguments:
+    ----------
+    z_spike     : robust z-score of the second difference above which a channel is a spike
+
+    min_run     : minimal number of consecutive channels of a saturated or zero region
+
+    sample_size : number of spectra of the median and MAD reference
+
+    Attributes:
+    -----------
+    median, mad : (N_w - 2,) per-band median and scaled MAD of the second differences, set by fit()
+    """
+
+    def __init__(self, z_spike=10.0, min_run=5, sample_size=2048):
+        self.z_spike = z_spike
+        self.min_run = min_run
+        self.sample_size = sample_size
+        self.median = None
+        self.mad = None
+
+    def fit(self, data):
+        """
+        Robust per-band reference of the second differences, from an evenly strided sample of spectra.
+
+        :param data: (N_obs, N_w) spectra, array or row sliceable dataset
+        :return: self
+        """
+        step = max(1, len(data) // self.sample_size)
+        sample = np.asarray(data[::step], dtype='float64')
+        sample = sample[np.all(np.isfinite(sample), axis=1)]
+        if len(sample) == 0:
+            self.median = np.zeros(data.shape[1] - 2)
+            self.mad = np.full(data.shape[1] - 2, np.inf)
+            return self
+        r = _second_difference(sample)
+        self.median = np.median(r, axis=0)
+        self.mad = 1.4826 * np.median(np.abs(r - self.median), axis=0)
+        # a band without spread in the sample (e.g. a constant band) can't show spikes on this scale
+        floor = np.median(self.mad[self.mad > 0]) if np.any(self.mad > 0) else 1.0
+        self.mad = np.maximum(self.mad, 1e-3 * floor)
+        return self
+
+    def __call__(self, block):
+        """
+        :param block: (n, N_w) spectra
+        :return: (n,) uint8 flags
+        """
+        block = np.asarray(block, dtype='float64')
+        flags = np.zeros(len(block), dtype='uint8')
+        finite = np.isfinite(block)
+        flags[~finite.all(axis=1)] |= NON_FINITE
+        with np.errstate(invalid='ignore'):
+            z = np.abs(_second_difference(block) - self.median) / self.mad
+            flags[np.any(z > self.z_spike, axis=1)] |= SPIKE
+            flat = np.diff(block, axis=1) == 0
+            top = np.nanmax(block, axis=1, keepdims=True)
+            bottom = np.nanmin(block, axis=1, keepdims=True)
+            extreme = ((block == top) | (block == bottom)) & (block != 0)
+            # min_run equal values are min_run - 1 zero differences
+            flags[_has_run(flat & extreme[:, 1:], self.min_run - 1)] |= SATURATED
+            flags[_has_run(block == 0, self.min_run)] |= ZERO
+        return flags
+
+    def detect(self, data, chunk_size=4096):
+        """
+        Flag all spectra, a block at a time; fits the reference first if needed.
+
+        :param data: (N_obs, N_w) spectra, array or row sliceable dataset
+        :return: (N_obs,) uint8 flags
+        """
+        if self.median is None:
+            self.fit(data)
+        flags = np.zeros(len(data), dtype='uint8')
+        for i0 in range(0, len(data), chunk_size):
+            flags[i0:i0 + chunk_size] = self(data[i0:i0 + chunk_size])
+        return flags
+
+    def params(self):
+        return {'z_spike': self.z_spike, 'min_run': self.min_run, 'sample_size': self.sample_size}
+
+
+def quality_flags(data, chunk_size=4096, **kwargs):
+    """
+    Quality flags of all spectra, see quality_detector
+    """
+    return quality_detector(**kwargs).detect(data, chunk_size)
+
+
+def good_spectra(flags, skip=ALL_FLAGS):
+    """
+    :param flags: quality flags
+    :param skip: flags that disqualify a spectrum, e.g. SPIKE | NON_FINITE
+    :return: bool array of the spectra without any of the skip flags
+    """
+    return (np.asarray(flags) & skip) == 0
+
+
+def pixel_quality(flags, ind_rc_map, shape):
+    """
+    Quality flags of the pixels of an image cube, from the flags of the spectra measured in them.
+
+    :param flags: (N_obs,) flags, aligned with the rows of data/spectra
+    :param ind_rc_map: (N_obs, 3) [row of data/spectra, image row, image col] of every spectrum
+    :param shape: (N_y, N_x) image shape
+    :return: (N_y, N_x) uint8 flags, the flags of all spectra of a pixel or-ed together
+    """
+    ind_rc_map = np.asarray(ind_rc_map)
+    image = np.zeros(shape, dtype='uint8')
+    np.bitwise_or.at(image, (ind_rc_map[:, 1], ind_rc_map[:, 2]), np.asarray(flags, dtype='uint8')[ind_rc_map[:, 0]])
+    return image
+
+
+def summarize(flags):
+    """
+    :return: dict of the number of spectra with every flag
+    """
+    flags = np.asarray(flags)
+    return {name: int(np.count_nonzero(flags & bit)) for bit, name in FLAG_NAMES.items()}
+
+
+def write_quality(h5, root, flags, params=None):
+    """
+    Store quality flags in an open hdf5 file, replacing existing ones.
+
+    :param h5: h5py.File opened for writing
+    :param root: sample root group name
+    :param flags: (N_obs,) flags, aligned with the rows of data/spectra
+    :param params: detector parameters, stored as attributes
+    """
+    name = root + QUALITY_PATH
+    if name in h5:
+        del h5[name]
+    dataset = h5.create_dataset(name, data=np.asarray(flags, dtype='uint8'))
+    for bit, flag in FLAG_NAMES.items():
+        dataset.attrs['flag_' + flag] = bit
+    for key, val in (params or {}).items():
+        dataset.attrs[key] = val
+
+
+def read_quality(filename, ind=None):
+    """
+    Read quality flags from a map hdf5 file.
+
+    :param filename: hdf5 filename
+    :param ind: optional row indexes
+    :return: (N_obs,) uint8 flags, or None if the file has no quality flags
+    """
+    with h5py.File(filename, 'r') as f:
+        root = list(f.keys())[0]
+        if root + QUALITY_PATH not in f:
+            return None
+        dataset = f[root + QUALITY_PATH]
+        return dataset[:] if ind is None or len(ind) == 0 else dataset[:][ind]
+
+
+def backfill_quality(filename, chunk_size=4096, **kwargs):
+    """
+    Flag the spectra of a map hdf5 file that was saved without quality flags, reading them a block at a time.
+
+    :param filename: hdf5 filename
+    :param kwargs: passed to quality_detector
+    :return: flags
+    """
+    detector = quality_detector(**kwargs)
+    with h5py.File(filename, 'r+') as f:
+        root = list(f.keys())[0]
+        flags = detector.detect(f[root + '/data/spectra'], chunk_size)
+        write_quality(f, root, flags, detector.params())
+    return flags
+
+
+if __name__ == "__main__":
+    import os
+    import time
+
+    np.random.seed(0)
+    wavenumbers = np.linspace(4000, 650, 1738)
+    peaks = np.exp(-(wavenumbers - 1650) ** 2 / 200) + 0.5 * np.exp(-(wavenumbers - 2920) ** 2 / 30)
+    spectra = np.random.uniform(0.5, 1.5, (50000, 1)) * peaks + 0.01 * np.random.randn(50000, len(wavenumbers))
+    spectra = spectra.astype('float32')
+    spectra[10, 700] += 0.5          # cosmic ray
+    spectra[20, 300:320] = spectra[20].max()   # clipped
+    spectra[30, 1000:1040] = 0       # zeroed
+    spectra[40, 5] = np.nan
+    spectra[50, 900] -= 0.4          # negative spike
+
+    t0 = time.perf_counter()
+    flags = quality_flags(spectra)
+    t = time.perf_counter() - t0
+    assert flags[10] == SPIKE and flags[50] == SPIKE
+    assert flags[20] & SATURATED and flags[30] & ZERO and flags[40] & NON_FINITE
+    bad = np.where(flags)[0]
+    assert set(bad) == {10, 20, 30, 40, 50}, bad
+    assert good_spectra(flags).sum() == len(spectra) - 5 and good_spectra(flags, skip=NON_FINITE).sum() == len(spectra) - 1
+    print(f'{len(spectra)} spectra flagged in {t:.2f} s: {summarize(flags)}')
+
+    with h5py.File('tst_quality.h5', 'w') as f:
+        f.create_dataset('tst/data/spectra', data=spectra)
+    assert np.array_equal(backfill_quality('tst_quality.h5', chunk_size=3000), flags)
+    assert np.array_equal(read_quality('tst_quality.h5', ind=[10, 11]), [SPIKE, 0])
+    os.remove('tst_quality.h5')
+    print('OK')
@@ -0,0 +1,220 @@
+"""
+Streaming mean, covariance and min / max of map spectra.
+
+The statistics of all spectra of a map are accumulated in one read over blocks of rows of an array, memmap or
+hdf5 dataset, with Chan's parallel form of Welford's update: every block is reduced to its count, mean and scatter
+matrix about its own mean, which are merged into the running totals. This avoids the cancellation of the textbook
+sum of squares formula, and partial results of different blocks, threads or processes merge the same way.
+
+"""
+
+import numpy as np
+
+
+class running_stats(object):
+    """
+    Accumulated count, mean, scatter matrix (or per-band sum of squares) and min / max of spectra.
+
+    Arguments:
+    ----------
+    N_w         : number of bands
+
+    covariance  : accumulate the full (N_w, N_w) scatter matrix, else only its diagonal
+
+    Attributes:
+    -----------
+    count       : number of spectra
+
+    mean        : (N_w,) mean spectrum
+
+    M2          : (N_w, N_w) scatter matrix sum((x - mean)^T (x - mean)), or its (N_w,) diagonal
+
+    min, max    : (N_w,) per-band extremes
+
+    Examples:
+    ---------
+    stats = running_stats(N_w)
+    for block in blocks:
+        stats.update(block)
+    total = stats_a.merge(stats_b)   # partial results of two processes
+    """
+
+    def __init__(self, N_w, covariance=True):
+        self.N_w = N_w
+        self.covariance = covariance
+        self.count = 0
+        self.mean = np.zeros(N_w)
+        self.M2 = np.zeros((N_w, N_w) if covariance else N_w)
+        self.min = np.full(N_w, np.inf)
+        self.max = np.full(N_w, -np.inf)
+
+    def _merge(self, count, mean, M2, b_min, b_max):
+        """Chan's update with the statistics of another set of spectra"""
+        if count == 0:
+            return self
+        total = self.count + count
+        delta = mean - self.mean
+        if self.covariance:
+            self.M2 += M2 + np.outer(delta, delta) * (self.count * count / total)
+        else:
+            self.M2 += M2 + delta ** 2 * (self.count * count / total)
+        self.mean += delta * (count / total)
+        self.count = total
+        np.minimum(self.min, b_min, out=self.min)
+        np.maximum(self.max, b_max, out=self.max)
+        return self
+
+    def update(self, block, mask=None):
+        """
+        Add a block of spectra.
+
+        :param block: (n, N_w) spectra
+        :param mask: optional (n,) bool array, only the selected spectra are added
+        :return: self
+        """
+        block = np.asarray(block, dtype='float64')
+        if mask is not None:
+            block = block[np.asarray(mask, dtype=bool)]
+        if len(block) == 0:
+            return self
+        b_mean = block.mean(axis=0)
+        centered = block - b_mean
+        if self.covariance:
+            M2 = centered.T @ centered
+        else:
+            M2 = np.einsum('ij,ij->j', centered, centered)
+        return self._merge(len(block), b_mean, M2, block.min(axis=0), block.max(axis=0))
+
+    def merge(self, other):
+        """
+        Add the statistics of another running_stats, e.g. of a block processed by another worker
+        :return: self
+        """
+        if other.covariance != self.covariance:
+            raise ValueError('cannot merge statistics with and without covariance')
+        return self._merge(other.count, other.mean, other.M2, other.min, other.max)
+
+    def variance(self, ddof=1):
+        """(N_w,) per-band variance"""
+        M2 = np.diag(self.M2) if self.covariance else self.M2
+        return M2 / max(self.count - ddof, 1)
+
+    def std(self, ddof=1):
+        """(N_w,) per-band standard deviation"""
+        return np.sqrt(self.variance(ddof))
+
+    def cov(self, ddof=1):
+        """(N_w, N_w) covariance matrix, as np.cov of the spectra as observations"""
+        if not self.covariance:
+            raise ValueError('covariance was not accumulated')
+        return self.M2 / max(self.count - ddof, 1)
+
+    def gram(self):
+        """(N_w, N_w) Gram matrix sum(x^T x) of the uncentered spectra"""
+        if not self.covariance:
+            raise ValueError('covariance was not accumulated')
+        return self.M2 + self.count * np.outer(self.mean, self.mean)
+
+    def as_dict(self):
+        """Plain arrays, to send partial results between processes or store them"""
+        return {'count': self.count, 'mean': self.mean, 'M2': self.M2, 'min': self.min, 'max': self.max}
+
+    @classmethod
+    def from_dict(cls, d):
+        stats = cls(len(d['mean']), covariance=np.ndim(d['M2']) == 2)
+        return stats._merge(int(d['count']), np.asarray(d['mean']), np.asarray(d['M2']), d['min'], d['max'])
+
+
+def stream_stats(data, mask=None, bands=None, covariance=True, chunk_size=4096):
+    """
+    Statistics of all spectra of a map in one read.
+
+    :param data: (N_obs, N_w) spectra or (N_y, N_x, N_w) image cube, array, memmap or hdf5 dataset
+    :param mask: selected spectra, (N_obs,) or (N_y, N_x) bool array (e.g. an image mask or ROI), or an array of
+                 row indexes; all spectra if None
+    :param bands: optional band indexes or slice to restrict the statistics to
+    :param covariance: accumulate the full covariance matrix
+    :param chunk_size: number of spectra (rows of the image cube times its width) per block
+    :return: running_stats
+    """
+    cube = len(data.shape) == 3
+    N_w = data.shape[-1]
+    if bands is not None:
+        N_w = len(np.arange(N_w)[bands])
+    if mask is not None:
+        mask = np.asarray(mask)
+        if mask.dtype != bool:
+            rows = mask
+            mask = np.zeros(data.shape[:-1], dtype=bool).ravel()
+            mask[rows] = True
+            mask = mask.reshape(data.shape[:-1])
+    stats = running_stats(N_w, covariance)
+    step = max(1, chunk_size // data.shape[1]) if cube else chunk_size
+    for i0 in range(0, data.shape[0], step):
+        i1 = min(i0 + step, data.shape[0])
+        if mask is not None and not mask[i0:i1].any():
+            continue
+        block = np.asarray(data[i0:i1]).reshape(-1, data.shape[-1])
+        if bands is not None:
+            block = block[:, bands]
+        stats.update(block, None if mask is None else mask[i0:i1].ravel())
+    return stats
+
+
+def mahalanobis(data, stats, chunk_size=4096):
+    """
+    Mahalanobis distances of spectra to the distribution of running_stats.
+
+    :param data: (N_obs, N_w) spectra
+    :param stats: running_stats with covariance, e.g. of the background spectra
+    :return: (N_obs,) distances
+    """
+    inv_cov = np.linalg.pinv(stats.cov())
+    out = np.empty(len(data))
+    for i0 in range(0, len(data), chunk_size):
+        t = np.asarray(data[i0:i0 + chunk_size], dtype='float64') - stats.mean
+        out[i0:i0 + chunk_size] = np.sqrt(np.maximum(np.einsum('ij,jk,ik->i', t, inv_cov, t), 0))
+    return out
+
+
+if __name__ == "__main__":
+    import os
+    import time
+    import h5py
+
+    np.random.seed(0)
+    data = (1e4 + np.random.random((50000, 200))).astype('float32')  # large offset: naive sums of squares lose it
+    mask = np.random.random(len(data)) > 0.3
+
+    stats = stream_stats(data, mask, chunk_size=3000)
+    ref = data[mask].astype('float64')
+    assert stats.count == mask.sum()
+    assert np.allclose(stats.mean, ref.mean(axis=0))
+    assert np.allclose(stats.cov(), np.cov(ref.T), rtol=1e-6, atol=1e-8)
+    assert np.allclose(stats.gram(), ref.T @ ref, rtol=1e-10)
+    assert np.allclose(stats.min, ref.min(axis=0)) and np.allclose(stats.max, ref.max(axis=0))
+
+    # partial results merge to the statistics of the whole
+    a = stream_stats(data[:20000], mask[:20000])
+    b = running_stats.from_dict(stream_stats(data[20000:], mask[20000:]).as_dict())
+    assert np.allclose(a.merge(b).cov(), stats.cov())
+    diag = stream_stats(data, mask, covariance=False)
+    assert np.allclose(diag.std(), ref.std(axis=0, ddof=1))
+
+    # image cube with an image mask, read from hdf5, restricted to bands
+    cube = data.reshape(250, 200, 200)
+    with h5py.File('tst_stats.h5', 'w') as f:
+        f.create_dataset('image_cube', data=cube)
+    with h5py.File('tst_stats.h5', 'r') as f:
+        t0 = time.perf_counter()
+        s = stream_stats(f['image_cube'], mask.reshape(250, 200), bands=slice(10, 50))
+        t_stream = time.perf_counter() - t0
+    os.remove('tst_stats.h5')
+    assert np.allclose(s.cov(), np.cov(ref[:, 10:50].T), rtol=1e-6, atol=1e-8)
+    assert np.allclose(stream_stats(data, np.where(mask)[0]).mean, stats.mean)
+
+    d = mahalanobis(ref[:5], stats)
+    t = ref[:5] - ref.mean(axis=0)
+    assert np.allclose(d, np.sqrt(np.einsum('ij,jk,ik->i', t, np.linalg.pinv(np.cov(ref.T)), t)))
+    print(f'{mask.sum()} of {len(data)} spectra, 40 bands from hdf5 in one read: {t_stream:.2f} s')
+    print('OK')
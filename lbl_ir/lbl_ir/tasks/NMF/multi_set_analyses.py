@@ -30,20 +30,21 @@ class aggregate_data(object):
         return result
 
     def get_data(self,data):
-        result = []
-        dims = []
+        dims = [cube.imageCube.shape[:2] for cube in data]
+        N_obs = sum( dim[0]*dim[1] for dim in dims )
+        # the selected bands of all maps are converted into one preallocated matrix
+        result = np.empty( (N_obs, len(self.master_wmask)), dtype='float32' )
         labels = []
+        i0 = 0
         for kk,cube in enumerate(data):
-            sel_cube = cube.imageCube[:,:, self.master_wmask ]
-            dim = sel_cube.shape
-            sel_cube = sel_cube.reshape( dim[0]*dim[1],dim[2] )
-            result.append( sel_cube )
+            dim = dims[kk]
+            sel_cube = cube.imageCube[:,:, self.master_wmask ].reshape( dim[0]*dim[1], -1 )
+            transform.to_absorbance( sel_cube, None, out=result[i0:i0+len(sel_cube)] )
+            i0 += len(sel_cube)
             labs = np.zeros( dim[0]*dim[1] ) + kk
             labels.append(labs)
-            dims.append( dim[:2] )
-        result = np.vstack( result )
         labels = np.concatenate(labels).flatten()
-        return transform.to_absorbance(result,False)[0], dims, labels
+        return result, dims, labels
 
     def splitter(self,X,to_map=False):
         sets = []
@@ -106,7 +107,7 @@ if __name__ == "__main__":
         for fname in names:
             data,fmt = read_map.read_all_formats( fname )
             data_files.append( data )
-            ds = data_prep.data_prepper(data)
+            ds = data_prep.data_prepper(data, filename=fname)
             wav_masks.append( ds.decent_bands )
 
         ad = aggregate_data(names, data_files, wav_masks)
@@ -115,7 +116,7 @@ if __name__ == "__main__":
     else:
         data,fmt = read_map.read_all_formats( names[0] )
         print(fmt)
-        wmask = data_prep.data_prepper(data).decent_bands
+        wmask = data_prep.data_prepper(data, filename=names[0]).decent_bands
         wavs,W,H = single_set_NMF(data, wmask, 4 )
         for i in range(4):
             plt.plot(wavs, H.components_[i], label='NMF'+str(i))
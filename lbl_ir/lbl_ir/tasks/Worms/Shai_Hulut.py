@@ -11,6 +11,7 @@ from lbl_ir.io_tools.Omnic_PyMca5.OmnicMap import OmnicMap
 
 # doing SVD
 from lbl_ir.math_tools.batched_SVD import batched_SVD
+from lbl_ir.math_tools.streaming_stats import stream_stats, mahalanobis
 
 # for segmentating of the image
 from scipy.ndimage.morphology import binary_closing, binary_dilation, binary_fill_holes
@@ -207,16 +208,8 @@ class little_maker( object ):
 
         # now we use this mask to define the background
         bg_sel = mask.flatten() < 0.5
-        background = self.U[bg_sel,:]
-        mean_bg = np.mean( background, axis=0)
-        var_covar = np.cov( (background-mean_bg).transpose() )
-        inv_vcv = np.linalg.pinv( var_covar )
-        t = self.U - mean_bg
-        z_scores = []
-        for tt in t:
-            z = tt.reshape(1,-1)
-            z_scores.append( np.sqrt( z.dot(inv_vcv).dot(z.transpose()) ) )
-        z_scores = np.array(z_scores).reshape( self.data_shape[0:2] )
+        bg_stats = stream_stats( self.U, bg_sel )
+        z_scores = mahalanobis( self.U, bg_stats ).reshape( self.data_shape[0:2] )
         return z_scores
 
  
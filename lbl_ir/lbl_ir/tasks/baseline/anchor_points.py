@@ -0,0 +1,149 @@
+"""
+Anchor point baselines of many spectra at once.
+
+The baseline of a spectrum is interpolated between its values at a few anchor wavenumbers. For a given wavenumber
+axis, anchor set and interpolation kind the interpolation is linear in the anchor values, so it is a fixed
+(n_anchor, n_energy) matrix W and the baselines of a block of spectra are spectra[:, anchor_idx] @ W. For a
+linear baseline every column of W has at most two non zero weights. W is built once and applied chunk by chunk.
+
+"""
+
+import numpy as np
+from scipy.interpolate import interp1d
+
+from lbl_ir.data_objects.ir_map import val2ind
+
+
+def parse_anchors(anchors, wavenumbers):
+    """
+    Anchor point indexes from an anchor string such as '400, 1800, 4000'
+    """
+    anchor_idx = []
+    for entry in anchors.split(','):
+        try:
+            anchor_idx.append(val2ind(int(entry.strip()), wavenumbers))
+        except ValueError:
+            continue
+    return sorted(anchor_idx)
+
+
+def anchor_matrix(wav_anchor, energy, kind='linear'):
+    """
+    Interpolation matrix of an anchor point baseline.
+
+    :param wav_anchor: anchor wavenumbers
+    :param energy: wavenumbers the baseline is evaluated at
+    :param kind: 'linear', 'quadratic' or 'cubic', as in scipy.interpolate.interp1d
+    :return: (n_anchor, n_energy) matrix W, baseline = anchor values @ W
+    """
+    n_anchor = len(wav_anchor)
+    # interpolating the unit vectors gives the weight of every anchor at every wavenumber
+    return interp1d(wav_anchor, np.eye(n_anchor), kind=kind, axis=-1)(energy)
+
+
+def anchor_values(spectra, anchor_idx, window=0):
+    """
+    Values of the spectra at the anchor points.
+
+    :param spectra: (N_obs, N_w) spectra
+    :param anchor_idx: anchor point indexes
+    :param window: if > 0, the value at an anchor is the local minimum of the spectrum within +/- window points,
+                   which keeps the baseline below the spectrum when an anchor falls on a small band or on noise
+    :return: (N_obs, n_anchor) anchor values
+    """
+    anchor_idx = np.asarray(anchor_idx)
+    if window <= 0:
+        return spectra[:, anchor_idx]
+    idx = np.clip(anchor_idx[:, None] + np.arange(-window, window + 1), 0, spectra.shape[-1] - 1)
+    return spectra[:, idx].min(axis=-1)
+
+
+class anchor_baseline(object):
+    """
+    Anchor point baseline for a fixed wavenumber axis and anchor set.
+
+    Arguments:
+    ----------
+    wavenumbers : wavenumber array
+
+    anchor_idx  : sorted anchor point indexes; the first and last anchor define the baseline energy range
+
+    kind        : interpolation between anchors: 'linear', 'quadratic' or 'cubic'
+
+    window      : local minimum search half width around every anchor, in points, 0 uses the anchor values
+
+    Attributes:
+    -----------
+    energy      : wavenumbers of the baseline
+
+    trim        : slice of the spectra covered by the baseline
+
+    W           : (n_anchor, len(energy)) interpolation matrix
+    """
+
+    def __init__(self, wavenumbers, anchor_idx, kind='linear', window=0):
+        self.wavenumbers = np.asarray(wavenumbers)
+        self.anchor_idx = np.asarray(anchor_idx)
+        self.kind = kind
+        self.window = window
+        self.trim = slice(self.anchor_idx[0], self.anchor_idx[-1] + 1)
+        self.energy = self.wavenumbers[self.trim]
+        self.wav_anchor = self.wavenumbers[self.anchor_idx]
+        self.W = anchor_matrix(self.wav_anchor, self.energy, kind)
+
+    def __call__(self, spectra):
+        """
+        :param spectra: (N_w,) or (N_obs, N_w) spectra
+        :return: baselines over energy, with the leading shape of spectra
+        """
+        spectra = np.asarray(spectra)
+        return anchor_values(np.atleast_2d(spectra), self.anchor_idx, self.window).dot(self.W).reshape(
+            spectra.shape[:-1] + (len(self.energy),))
+
+
+def rubberband_baseline(wavenumbers, spectra, anchors, kind='linear', window=0, chunk_size=5000):
+    """
+    Anchor point baselines of all spectra of a map.
+
+    :param wavenumbers: wavenumber array
+    :param spectra: (N_obs, N_w) spectra, array or hdf5 dataset
+    :param anchors: anchor points string, e.g. '650, 1800, 4000'
+    :param kind: interpolation between anchors
+    :param window: local minimum search half width around every anchor, in points
+    :param chunk_size: number of spectra per block
+    :return: energy, (N_obs, len(energy)) baselines
+    """
+    baseline = anchor_baseline(wavenumbers, parse_anchors(anchors, wavenumbers), kind, window)
+    out = np.empty((len(spectra), len(baseline.energy)))
+    for i0 in range(0, len(spectra), chunk_size):
+        i1 = min(i0 + chunk_size, len(spectra))
+        out[i0:i1] = baseline(np.asarray(spectra[i0:i1], dtype='float64'))
+    return baseline.energy, out
+
+
+if __name__ == "__main__":
+    import time
+
+    np.random.seed(0)
+    wavenumbers = np.linspace(4000, 650, 1738)
+    x = np.linspace(0, 1, len(wavenumbers))
+    spectra = np.random.random((20000, 1)) * x + np.random.random((20000, 1)) * x ** 2 \
+        + 0.01 * np.random.random((20000, len(wavenumbers)))
+    anchors = '650, 1000, 1800, 2700, 3700, 4000'
+    anchor_idx = parse_anchors(anchors, wavenumbers)
+    trim = slice(anchor_idx[0], anchor_idx[-1] + 1)
+
+    for kind in ['linear', 'quadratic', 'cubic']:
+        t0 = time.perf_counter()
+        for a in spectra[:1000]:
+            ref = interp1d(wavenumbers[anchor_idx], a[anchor_idx], kind=kind)(wavenumbers[trim])
+        t_single = (time.perf_counter() - t0) * len(spectra) / 1000
+        t0 = time.perf_counter()
+        energy, baselines = rubberband_baseline(wavenumbers, spectra, anchors, kind=kind)
+        t_batch = time.perf_counter() - t0
+        assert np.allclose(baselines[999], ref)
+        print(f'{kind}: per spectrum {t_single:.2f} s (estimated), matrix {t_batch:.2f} s')
+
+    energy, baselines = rubberband_baseline(wavenumbers, spectra[:100], anchors, window=5)
+    assert np.all(baselines[:, 0] <= spectra[:100, trim][:, 0])
+    print('OK')
@@ -1,29 +1,122 @@
 import numpy as np
+import numba
 from scipy.spatial import ConvexHull
 
+
+def _lower_hull_baseline(x, spectra, out):
+    """
+    Lower convex hull of every spectrum over the sorted ascending x, by Andrew's monotone chain, and its linear
+    interpolation over x
+    """
+    N_obs, N_w = spectra.shape
+    for k in numba.prange(N_obs):
+        y = spectra[k]
+        hull = np.empty(N_w, dtype=np.int64)
+        n = 0
+        for i in range(N_w):
+            # drop the last hull point while it lies above or on the segment to the new point
+            while n >= 2:
+                o, a = hull[n - 2], hull[n - 1]
+                if (x[a] - x[o]) * (y[i] - y[o]) - (y[a] - y[o]) * (x[i] - x[o]) > 0:
+                    break
+                n -= 1
+            hull[n] = i
+            n += 1
+        for j in range(n - 1):
+            i0, i1 = hull[j], hull[j + 1]
+            slope = (y[i1] - y[i0]) / (x[i1] - x[i0])
+            for i in range(i0, i1 + 1):
+                out[k, i] = y[i0] + slope * (x[i] - x[i0])
+        if n == 1:
+            out[k, 0] = y[0]
+
+
+# the parallel kernel uses numba's thread pool; the serial one releases the GIL for callers that run it in their own
+# threads, since numba's default threading layer can't be entered from several threads at once
+_hull_parallel = numba.jit(nopython=True, parallel=True)(_lower_hull_baseline)
+_hull_serial = numba.jit(nopython=True, nogil=True)(_lower_hull_baseline)
+
+
+def rubberband_batch(wavenumbers, spectra, chunk_size=10000, parallel=True):
+    """
+    Rubberband baselines of many spectra: the lower half of the convex hull of every spectrum.
+
+    :param wavenumbers: sorted (ascending or descending) wavenumbers
+    :param spectra: (N_w,) or (..., N_w) spectra
+    :param chunk_size: number of spectra converted to float64 at a time
+    :param parallel: spread the spectra over numba threads; use False when calling from a thread pool
+    :return: baselines with the shape of spectra
+    """
+    wavenumbers = np.asarray(wavenumbers, dtype='float64').ravel()
+    spectra = np.asarray(spectra)
+    shape = spectra.shape
+    spectra = spectra.reshape(-1, shape[-1])
+    reverse = wavenumbers[0] > wavenumbers[-1]
+    x = wavenumbers[::-1].copy() if reverse else wavenumbers
+    out = np.empty(spectra.shape)
+    for i0 in range(0, len(spectra), chunk_size):
+        i1 = min(i0 + chunk_size, len(spectra))
+        block = spectra[i0:i1, ::-1] if reverse else spectra[i0:i1]
+        baseline = np.empty(block.shape)
+        kernel = _hull_parallel if parallel else _hull_serial
+        kernel(x, np.ascontiguousarray(block, dtype='float64'), baseline)
+        out[i0:i1] = baseline[:, ::-1] if reverse else baseline
+    return out.reshape(shape)
+
+
 def rubberband(wavenumbers, spectrum):
     """
-    A rubberband baseline is essentially the lower half of tyhe convex hull 
+    A rubberband baseline is essentially the lower half of tyhe convex hull
     of the data. See this discussion for more details and code.
 
     https://dsp.stackexchange.com/questions/2725/how-to-perform-a-rubberband-correction-on-spectroscopic-data
     """
+    return rubberband_batch(wavenumbers, spectrum)
+
+
+def rubberband_convex_hull(wavenumbers, spectrum):
+    """
+    Rubberband baseline of a single spectrum with scipy.spatial.ConvexHull, for ascending wavenumbers. Kept as
+    reference for rubberband_batch.
+    """
 
     # First find the convex hull using scipy.spatial tools
     tmp = np.vstack([ wavenumbers.flatten(),spectrum.flatten()]).transpose()
     v = ConvexHull(tmp).vertices
-    
+
     # rool it untill the first point is the first point measured
     v = np.roll(v, -v.argmin())
     # We don't care aboput the top half of the convex hull
-    v = v[:v.argmax()]
+    v = v[:v.argmax() + 1]
 
-    # Use interpolation to get the baseline across the whole 
+    # Use interpolation to get the baseline across the whole
     # spectrum
     return np.interp(wavenumbers, wavenumbers[v], spectrum[v])
-    
 
 
+if __name__ == "__main__":
+    import time
 
+    np.random.seed(0)
+    wavenumbers = np.linspace(650, 4000, 1738)
+    x = np.linspace(0, 1, len(wavenumbers))
+    spectra = np.random.random((20000, 1)) * x + np.sin(3 * x) * np.random.random((20000, 1)) \
+        + 0.05 * np.random.random((20000, len(wavenumbers)))
 
+    rubberband_batch(wavenumbers, spectra[:10])  # compile
+    t0 = time.perf_counter()
+    for a in spectra[:1000]:
+        rubberband_convex_hull(wavenumbers, a)
+    t_single = (time.perf_counter() - t0) * len(spectra) / 1000
+    t0 = time.perf_counter()
+    baselines = rubberband_batch(wavenumbers, spectra)
+    t_batch = time.perf_counter() - t0
+    print(f'{len(spectra)} spectra: ConvexHull per spectrum {t_single:.2f} s (estimated), batched {t_batch:.2f} s')
 
+    for k in range(0, 20000, 997):
+        assert np.allclose(baselines[k], rubberband_convex_hull(wavenumbers, spectra[k]))
+        assert np.all(baselines[k] <= spectra[k] + 1e-12)
+    # descending wavenumbers and image cubes
+    cube = spectra[:12, ::-1].reshape(3, 4, -1)
+    assert np.allclose(rubberband_batch(wavenumbers[::-1], cube).reshape(12, -1)[:, ::-1], baselines[:12])
+    print('OK')
@@ -1,7 +1,15 @@
 import numpy as np
 import scipy.optimize
 import sklearn.decomposition as skl_decomposition
-from scipy.signal import hilbert
+from lbl_ir.math_tools.kramers_kronig import kk_transform
+from lbl_ir.tasks.preprocessing.basis_cache import basis_key, extinction_cache
+
+# alpha grids of Kohler and Kohler_zero, alpha = 2 * pi * d * (n - 1) * wavenumber
+KOHLER_ALPHA = np.linspace(3.14, 49.95, 150) * 1.0e-4
+KOHLER_ZERO_ALPHA = np.linspace(1.25, 49.95, 150) * 1.0e-4
+# average refractive index and cell diameter grids of Bassan
+BASSAN_A = np.linspace(1.1, 1.5, 10)
+BASSAN_D = np.linspace(2.0, 8.0, 10) * 1.0e-4
 
 
 def konevskikh_parameters(a, n0, f):
@@ -23,14 +31,10 @@ def GramSchmidt(V):
     :param V: matrix
     :return: nGram-Schmidt normalized matrix
     """
-    V = np.array(V)
-    U = np.zeros(np.shape(V))
-
-    for k in range(len(V)):
-        sum1 = 0
-        for j in range(k):
-            sum1 += np.dot(V[k], U[j]) / np.dot(U[j], U[j]) * U[j]
-        U[k] = V[k] - sum1
+    V = np.array(V, dtype='float64')
+    # V.T = Q R, the k-th Gram-Schmidt vector is the k-th column of Q scaled back by R[k, k]
+    Q, R = np.linalg.qr(V.T)
+    U = (Q * np.diag(R)).T
     return U
 
 
@@ -79,6 +83,131 @@ def Q_ext_kohler(wn, alpha):
     return Q
 
 
+def kohler_basis(wn, alpha, n_components):
+    """
+    Principal components of the extinction matrix Q_ext_kohler(wn, alpha) for all alpha.
+    Bases are cached in basis_cache.extinction_cache, keyed by wn, alpha and n_components.
+    :param wn: array of wavenumbers
+    :param alpha: array of alpha values
+    :param n_components: number of principal components
+    :return: read only (n_components, len(wn)) array of principal components
+    """
+    wn = np.asarray(wn, dtype='float64')
+    alpha = np.asarray(alpha, dtype='float64')
+
+    def build():
+        Q_ext = Q_ext_kohler(wn[np.newaxis, :], alpha[:, np.newaxis])  # one row per alpha
+        pca = skl_decomposition.IncrementalPCA(n_components=n_components)
+        pca.fit(Q_ext)
+        return pca.components_
+
+    return extinction_cache.get(basis_key('kohler', wn, alpha, n_components), build)
+
+
+def precompute_kohler_basis(wavenumbers, n_components=8, zero=True):
+    """
+    Fill the basis cache before a preprocessing job, so the first spectra don't pay for the PCA fit
+    :param wavenumbers: array of wavenumbers of the spectra to be corrected
+    :param n_components: number of principal components
+    :param zero: basis of Kohler_zero if True, of Kohler otherwise
+    :return: the basis, for sorted wavenumbers
+    """
+    return kohler_basis(np.sort(wavenumbers), KOHLER_ZERO_ALPHA if zero else KOHLER_ALPHA, n_components)
+
+
+def Q_ext_konevskikh(wn, ns_re, ns_im, alpha_0, gamma):
+    """
+    Compute the extinction matrix of Konevskikh's algorithm for all combinations of alpha_0 and gamma
+    :param wn: array of wavenumbers
+    :param ns_re: real part of the refractive index (from the Kramers-Kronig transform of ns_im)
+    :param ns_im: imaginary part of the refractive index
+    :param alpha_0: array of alpha_0 values
+    :param gamma: array of gamma values
+    :return: (len(alpha_0) * len(gamma), len(wn)) extinction matrix, rows ordered by alpha_0 then gamma
+    """
+    alpha_0 = np.asarray(alpha_0)[:, np.newaxis, np.newaxis]
+    gamma = np.asarray(gamma)[np.newaxis, :, np.newaxis]
+    rho = alpha_0 * (1.0 + gamma * ns_re) * wn
+    beta = np.arctan(ns_im / (1.0 / gamma + ns_re))
+    cos_rho = np.cos(beta) / rho
+    damping = np.exp(-1.0 * rho * np.tan(beta))
+    Q_ext = 2.0 - 4.0 * damping * cos_rho * np.sin(rho - beta) - 4.0 * damping * cos_rho ** 2.0 * \
+        np.cos(rho - 2.0 * beta) + 4.0 * cos_rho ** 2.0 * np.cos(2.0 * beta)
+    return Q_ext.reshape(-1, np.size(wn))
+
+
+def Q_ext_bassan(wn, nkk, a, d, n_loadings=10):
+    """
+    Compute the resonant Mie extinction matrix of Bassan's algorithm
+    :param wn: array of wavenumbers
+    :param nkk: scaled real part of the refractive index (Kramers-Kronig transform of the reference), (len(wn),)
+                or (N, len(wn)) for the matrices of N spectra at once
+    :param a: array of average refractive indexes
+    :param d: array of cell diameters
+    :param n_loadings: number of amplification factors of nkk for each refractive index
+    :return: (len(a) * n_loadings * len(d), len(wn)) extinction matrix, rows ordered by a, amplification and d,
+             or (N, len(a) * n_loadings * len(d), len(wn)) for a block of nkk
+    """
+    nkk = np.asarray(nkk)
+    b = np.linspace(0.0, a - 1.0, n_loadings).T  # Range of amplification factors of nkk for each a
+    # Compute the real refractive index
+    n = a[:, np.newaxis, np.newaxis] + b[:, :, np.newaxis] * nkk[..., np.newaxis, np.newaxis, :]
+    alpha = 2.0 * np.pi * d[:, np.newaxis] * (n[..., np.newaxis, :] - 1.0)
+    rho = alpha * wn
+    Q = 2.0 - np.divide(4.0, rho) * np.sin(rho) + np.divide(4.0, rho ** 2.0) * (1.0 - np.cos(rho))
+    return Q.reshape(nkk.shape[:-1] + (-1, np.size(wn)))
+
+
+def bassan_basis(wn, m, m_0, n_components, a, d):
+    """
+    Principal components of the Bassan extinction matrix built from the spectrum m, orthogonalized with
+    respect to the reference m_0
+    :param wn: sorted wavenumbers
+    :param m: spectrum used for the Kramers-Kronig transform
+    :param m_0: reference spectrum
+    :param n_components: number of principal components
+    :param a: array of average refractive indexes
+    :param d: array of cell diameters
+    :return: (n_components, len(wn)) principal components
+    """
+    nkk = kk_transform(m, dtype='float64')  # scaled real part of the refractive index by Kramers-Kronig transform
+    Q = orthogonalize(Q_ext_bassan(wn, nkk, a, d), m_0)
+    pca = skl_decomposition.IncrementalPCA(n_components=n_components)
+    pca.fit(Q)
+    return pca.components_
+
+
+def orthogonalize(Q, m):
+    """
+    Orthogonalize the rows of Q with respect to the spectrum m
+    :param Q: matrix, one row per extinction curve, or a stack of matrices
+    :param m: reference spectrum
+    :return: orthogonalized matrix
+    """
+    return Q - (np.dot(Q, m) / np.linalg.norm(m) ** 2.0)[..., np.newaxis] * m
+
+
+def konevskikh_basis(wn, m, m_0, alpha_0, gamma, n_components):
+    """
+    Principal components of the Konevskikh extinction matrix built from the reference m, orthogonalized
+    with respect to m_0
+    :param wn: sorted wavenumbers
+    :param m: spectrum used for the refractive index
+    :param m_0: reference spectrum
+    :param alpha_0: array of alpha_0 values
+    :param gamma: array of gamma values
+    :param n_components: number of principal components
+    :return: (n_components, len(wn)) principal components
+    """
+    ns_im = np.divide(m, wn)  # Compute the imaginary part of the refractive index
+    # Compute the real part of the refractive index by Kramers-Kronig transform
+    ns_re = kk_transform(ns_im, dtype='float64')
+    Q_ext = orthogonalize(Q_ext_konevskikh(wn, ns_re, ns_im, alpha_0, gamma), m_0)
+    pca = skl_decomposition.IncrementalPCA(n_components=n_components)
+    pca.fit(Q_ext)
+    return pca.components_
+
+
 def apparent_spectrum_fit_function(wn, Z_ref, p, b, c, g):
     """
     Function used to fit the apparent spectrum
@@ -144,15 +273,8 @@ def correct_reference(m, wn, a, d, w_regions):
 
     p0 = np.ones(1 + n_components)  # Initial guess for the fitting
 
-    # Compute extinction matrix
-    Q_ext = np.zeros((np.size(alpha), np.size(wn)))
-    for i in range(np.size(alpha)):
-        Q_ext[i][:] = Q_ext_kohler(wn, alpha=alpha[i])
-
-    # Perform PCA to Q_ext
-    pca = skl_decomposition.IncrementalPCA(n_components=n_components)
-    pca.fit(Q_ext)
-    p_i = pca.components_  # Get the principal components of the extinction matrix
+    # Get the principal components of the extinction matrix
+    p_i = kohler_basis(wn, alpha, n_components)
 
     # Get the weighted regions of the wavenumbers, the reference spectrum and the principal components
     w_indexes = []
@@ -211,19 +333,10 @@ def Kohler(wavenumbers, App, m0, n_components=8):
     A_app = A_app[ii]
     m_0 = m_0[ii]
 
-    # Initialize the alpha parameter:
-    alpha = np.linspace(3.14, 49.95, 150) * 1.0e-4  # alpha = 2 * pi * d * (n - 1) * wavenumber
     p0 = np.ones(2 + n_components)  # Initialize the initial guess for the fitting
 
-    # # Initialize the extinction matrix:
-    Q_ext = np.zeros((np.size(alpha), np.size(wn)))
-    for i in range(np.size(alpha)):
-        Q_ext[i][:] = Q_ext_kohler(wn, alpha=alpha[i])
-
-    # Perform PCA of Q_ext:
-    pca = skl_decomposition.IncrementalPCA(n_components=n_components)
-    pca.fit(Q_ext)
-    p_i = pca.components_  # Extract the principal components
+    # Principal components of the extinction matrix:
+    p_i = kohler_basis(wn, KOHLER_ALPHA, n_components)
 
     # print(np.sum(pca.explained_variance_ratio_)*100)  # Print th explained variance ratio in percentage
 
@@ -273,19 +386,10 @@ def Kohler_zero(wavenumbers, App, w_regions, n_components=8):
     A_app = A_app[ii]
     m_0 = m_0[ii]
 
-    # Initialize the alpha parameter:
-    alpha = np.linspace(1.25, 49.95, 150) * 1.0e-4  # alpha = 2 * pi * d * (n - 1) * wavenumber
     p0 = np.ones(2 + n_components)  # Initialize the initial guess for the fitting
 
-    # # Initialize the extinction matrix:
-    Q_ext = np.zeros((np.size(alpha), np.size(wn)))
-    for i in range(np.size(alpha)):
-        Q_ext[i][:] = Q_ext_kohler(wn, alpha=alpha[i])
-
-    # Perform PCA of Q_ext:
-    pca = skl_decomposition.IncrementalPCA(n_components=n_components)
-    pca.fit(Q_ext)
-    p_i = pca.components_  # Extract the principal components
+    # Principal components of the extinction matrix:
+    p_i = kohler_basis(wn, KOHLER_ZERO_ALPHA, n_components)
 
     # print(np.sum(pca.explained_variance_ratio_)*100)  # Print th explained variance ratio in percentage
     w_indexes = []
@@ -344,6 +448,9 @@ def Bassan(wavenumbers, App, m0, n_components=8, iterations=1, w_regions=None):
     A_app = A_app[ii]
     m_0 = m_0[ii]
 
+    a = BASSAN_A  # Average refractive index
+    d = BASSAN_D  # Cell diameter
+
     # Define the weighted regions:
     if w_regions is not None:
         m_0 = correct_reference(np.copy(m_0), wn, a, d, w_regions)  # Correct the reference spectrum as in Kohler method
@@ -360,36 +467,10 @@ def Bassan(wavenumbers, App, m0, n_components=8, iterations=1, w_regions=None):
         A_app_w = np.copy(A_app[w_indexes])
         m_0_w = np.copy(m_0[w_indexes])
 
-    n_loadings = 10  # Number of values to be computed for each parameter (a, b, d)
-    a = np.linspace(1.1, 1.5, n_loadings)  # Average refractive index
-    d = np.linspace(2.0, 8.0, n_loadings) * 1.0e-4  # Cell diameter
-    Q = np.zeros((n_loadings ** 3, len(wn)))  # Initialize the extinction matrix
     m_n = np.copy(m_0)  # Initialize the reference spectrum, that will be updated after each iteration
     for iteration in range(iterations):
-        # Compute the scaled real part of the refractive index by Kramers-Kronig transform:
-        nkk = -1.0 * np.imag(hilbert(m_n))
-        # Build the extinction matrix
-        n_row = 0
-        for i in range(n_loadings):
-            b = np.linspace(0.0, a[i] - 1.0, 10)  # Range of amplification factors of nkk
-            for j in range(n_loadings):
-                for k in range(n_loadings):
-                    n = a[i] + b[j] * nkk  # Compute the real refractive index
-                    alpha = 2.0 * np.pi * d[k] * (n - 1.0)
-                    rho = alpha * wn
-                    #  Compute the extinction coefficients for each combination of a, b and d:
-                    Q[n_row] = 2.0 - np.divide(4.0, rho) * np.sin(rho) + \
-                               np.divide(4.0, rho ** 2.0) * (1.0 - np.cos(rho))
-                    n_row += 1
-
-        # Orthogonalization of th extinction matrix with respect to the reference spectrum:
-        for i in range(n_loadings ** 3):
-            Q[i] -= np.dot(Q[i], m_0) / np.linalg.norm(m_0) ** 2.0 * m_0
-
-        # Perform PCA of the extinction matrix
-        pca = skl_decomposition.IncrementalPCA(n_components=n_components)
-        pca.fit(Q)
-        p_i = pca.components_  # Get the principal components
+        # Principal components of the extinction matrix, orthogonalized with respect to the reference
+        p_i = bassan_basis(wn, m_n, m_0, n_components, a, d)
 
         if w_regions is None:  # If all regions have to be taken into account:
             def min_fun(x):
@@ -461,37 +542,16 @@ def Konevskikh(wavenumbers, App, m0, n_components=8, iterations=1):
     alpha_0, gamma = np.array([np.logspace(np.log10(0.1), np.log10(2.2), num=10) * 4.0e-4 * np.pi,
                                np.logspace(np.log10(0.05e4), np.log10(0.05e5), num=10) * 1.0e-2])
     p0 = np.ones(2 + n_components)
-    Q_ext = np.zeros((len(alpha_0) * len(gamma), len(wn)))  # Initialize extinction matrix
 
     m_n = np.copy(m_0)  # Copy the reference spectrum
     for n_iteration in range(iterations):
-        ns_im = np.divide(m_n, wn)  # Compute the imaginary part of the refractive index
-        # Compute the real part of the refractive index by Kramers-Kronig transform
-        ns_re = -1.0 * np.imag(hilbert(ns_im))
-
-        # Compute the extinction matrix
-        n_index = 0
-        for i in range(len(alpha_0)):
-            for j in range(len(gamma)):
-                for k in range(len(A_app)):
-                    rho = alpha_0[i] * (1.0 + gamma[j] * ns_re[k]) * wn[k]
-                    beta = np.arctan(ns_im[k] / (1.0 / gamma[j] + ns_re[k]))
-                    Q_ext[n_index][k] = 2.0 - 4.0 * np.exp(-1.0 * rho * np.tan(beta)) * (np.cos(beta) / rho) * \
-                        np.sin(rho - beta) - 4.0 * np.exp(-1.0 * rho * np.tan(beta)) * (np.cos(beta) / rho) ** 2.0 * \
-                        np.cos(rho - 2.0 * beta) + 4.0 * (np.cos(beta) / rho) ** 2.0 * np.cos(2.0 * beta)
-                    # TODO: rewrite this in a simpler way
-
-                n_index += 1
-
-        # Orthogonalize the extinction matrix with respect to the reference:
-        for i in range(n_index):
-            Q_ext[i][:] -= np.dot(Q_ext[i][:], m_0) / np.linalg.norm(m_0) ** 2.0 * m_0
-        # Q_ext = GramSchmidt(np.copy(Q_ext))  # Apply Gram-Schmidt othogonalization to Q_ext (don't uncomment this)
-
-        # Compute PCA of the extinction matrix
-        pca = skl_decomposition.IncrementalPCA(n_components=n_components)
-        pca.fit(Q_ext)
-        p_i = pca.components_  # Get the principal components
+        # Principal components of the extinction matrix, orthogonalized with respect to the reference.
+        # The first iteration only depends on the reference, its basis is shared by all spectra.
+        if n_iteration == 0:
+            p_i = extinction_cache.get(basis_key('konevskikh', wn, m_0, n_components),
+                                       lambda: konevskikh_basis(wn, m_0, m_0, alpha_0, gamma, n_components))
+        else:
+            p_i = konevskikh_basis(wn, m_n, m_0, alpha_0, gamma, n_components)
 
         def min_fun(x):
             bb, cc, g = x[0], x[1], x[2:]
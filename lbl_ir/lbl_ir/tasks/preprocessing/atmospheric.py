@@ -0,0 +1,242 @@
+"""
+Atmospheric water vapour and CO2 compensation for all spectra of a map.
+
+An open path spectrum is the sample spectrum plus scaled atmospheric absorbance spectra,
+
+    A = A_sample + sum_k a_k * ref_k
+
+The references (water vapour, CO2, ...) are shared by all spectra, so the design matrix is factorized once and
+all spectra are fitted together with one QR based least squares, as in batched_EMSC. The fit only uses the bands
+where the atmosphere absorbs. By default it is done on high passed spectra, the residuals of a Savitzky-Golay
+smoothing about 25 cm-1 wide: the narrow rotational lines of the references survive the high pass while the
+broad sample bands and baselines are removed, so sample absorbance leaks little into the fitted scales. The scaled references are then subtracted from blocks of spectra, in place
+or into an output array or hdf5 dataset, with memory bounded by the block size.
+
+The package doesn't ship measured atmospheric spectra: references are measured on the instrument (e.g. a
+background ratioed against a purged background) and passed in, or simulated with simulate_atmosphere for tests.
+
+"""
+
+import numpy as np
+
+from lbl_ir.math_tools.derivative import savgol
+from lbl_ir.tasks.preprocessing.batched_EMSC import linear_emsc
+
+# bands of the water vapour bending and stretching lines and of the CO2 stretching doublet and bending band
+ATMOSPHERIC_REGIONS = ((1300, 2000), (3500, 4000), (2280, 2400), (640, 700))
+
+
+def region_mask(wavenumbers, regions):
+    """
+    :return: bool array of the wavenumbers inside any of the (low, high) regions, for either axis order
+    """
+    wavenumbers = np.asarray(wavenumbers)
+    mask = np.zeros(len(wavenumbers), dtype=bool)
+    for pair in regions:
+        mask |= (wavenumbers >= min(pair)) & (wavenumbers <= max(pair))
+    return mask
+
+
+def load_references(references, wavenumbers):
+    """
+    Atmospheric references on a wavenumber axis.
+
+    :param references: (k, N_w) array or list on the wavenumber axis, dict of name: spectrum on the axis, or the
+                       filename of an .npz file with a 'wavenumbers' array and one array per reference, which are
+                       interpolated onto the axis
+    :param wavenumbers: wavenumber array
+    :return: names, (k, N_w) references
+    """
+    wavenumbers = np.asarray(wavenumbers, dtype='float64')
+    if isinstance(references, str):
+        with np.load(references) as f:
+            w_ref = f['wavenumbers']
+            ii = np.argsort(w_ref)
+            names = [key for key in f.files if key != 'wavenumbers']
+            refs = [np.interp(wavenumbers, w_ref[ii], f[key][ii], left=0, right=0) for key in names]
+        return names, np.array(refs)
+    if isinstance(references, dict):
+        names = list(references)
+        refs = np.array([references[key] for key in names], dtype='float64')
+    else:
+        refs = np.atleast_2d(np.asarray(references, dtype='float64'))
+        names = ['ref_%d' % k for k in range(len(refs))]
+    if refs.shape[1] != len(wavenumbers):
+        raise ValueError('references must be sampled on the wavenumber axis of the spectra')
+    return names, refs
+
+
+class atmospheric_compensation(object):
+    """
+    Batched least squares compensation of atmospheric absorbance.
+
+    Arguments:
+    ----------
+    wavenumbers : wavenumber array, sorted ascending or descending
+
+    references  : atmospheric references, see load_references
+
+    regions     : (low, high) wavenumber regions used in the fit
+
+    highpass    : width (cm-1) of the Savitzky-Golay smoothing whose residuals are fitted. If None, the spectra are
+                  fitted with an offset and a slope per region in the model.
+
+    polyorder   : polynomial order of the high pass smoothing
+
+    Attributes:
+    -----------
+    names       : reference names
+
+    refs        : (k, N_w) references
+
+    solver      : linear_emsc solver of the shared design
+
+    smooth      : savgol smoothing of the high pass, None without high pass
+
+    Examples:
+    ---------
+    comp = atmospheric_compensation(wavenumbers, {'water': water, 'co2': co2})
+    scales = comp.correct(h5_spectra, out=h5_spectra)     # in place, a block at a time
+    """
+
+    def __init__(self, wavenumbers, references, regions=ATMOSPHERIC_REGIONS, highpass=25.0, polyorder=2):
+        self.wavenumbers = np.asarray(wavenumbers, dtype='float64')
+        self.names, self.refs = load_references(references, self.wavenumbers)
+        self.regions = regions
+        self.smooth = None
+        inside = region_mask(self.wavenumbers, regions)
+        if highpass is not None:
+            step = np.abs(np.mean(np.diff(self.wavenumbers)))
+            self.smooth = savgol(self.wavenumbers, int(round(highpass / step)), polyorder)
+            design = self._highpass(self.refs).T
+            rows = np.where(inside)[0]
+        else:
+            # an offset and a slope per region take up the sample baseline under the atmospheric bands
+            columns = [self.refs.T]
+            for pair in regions:
+                sel = region_mask(self.wavenumbers, [pair])
+                if sel.any():
+                    x = np.where(sel, self.wavenumbers - np.mean(pair), 0) / max(np.ptp(pair), 1)
+                    columns.append(np.column_stack([sel.astype('float64'), x]))
+            design = np.column_stack(columns)
+            rows = np.where(inside)[0]
+        if len(rows) <= design.shape[1]:
+            raise ValueError('too few bands in the atmospheric regions for the fit')
+        self.solver = linear_emsc(design, rows=rows)
+
+    def _highpass(self, block):
+        return block - self.smooth(block)
+
+    def fit(self, block):
+        """
+        :param block: (n, N_w) spectra
+        :return: (n, k) scales of the references
+        """
+        block = np.asarray(block, dtype='float64')
+        if self.smooth is not None:
+            return self.solver.fit(self._highpass(block))
+        return self.solver.fit(block)[:, :len(self.refs)]
+
+    def __call__(self, block):
+        """Subtract the fitted atmosphere from a float block of spectra in place"""
+        block -= (self.fit(block) @ self.refs).astype(block.dtype)
+        return block
+
+    def correct(self, data, out=None, chunk_size=2048):
+        """
+        Compensate all spectra, a block at a time.
+
+        :param data: (N_obs, N_w) spectra, array or row sliceable dataset
+        :param out: output array or dataset, pass data itself to correct in place. A new float32 array if None.
+        :param chunk_size: number of spectra per block
+        :return: (N_obs, k) fitted scales of the references
+        """
+        N_obs = len(data)
+        if out is None:
+            out = np.empty(data.shape, dtype='float32')
+        scales = np.empty((N_obs, len(self.refs)))
+        for i0 in range(0, N_obs, chunk_size):
+            i1 = min(i0 + chunk_size, N_obs)
+            block = np.array(data[i0:i1], dtype='float64')
+            scales[i0:i1] = self.fit(block)
+            block -= scales[i0:i1] @ self.refs
+            out[i0:i1] = block
+        if hasattr(out, 'attrs'):
+            out.attrs['atmospheric_compensation'] = ','.join(self.names)
+        return scales
+
+
+def simulate_atmosphere(wavenumbers, seed=0):
+    """
+    Synthetic atmospheric absorbance spectra for validation: water vapour as random narrow Lorentzian lines in
+    its bending and stretching regions, CO2 as the P/R branch doublet near 2349 cm-1 and the band near 667 cm-1.
+
+    :return: dict of name: absorbance spectrum, peak absorbance 1
+    """
+    rng = np.random.RandomState(seed)
+    wn = np.asarray(wavenumbers, dtype='float64')
+
+    def lorentzians(centers, widths, heights):
+        spectrum = np.zeros(len(wn))
+        for c, g, h in zip(centers, widths, heights):
+            spectrum += h * g ** 2 / ((wn - c) ** 2 + g ** 2)
+        return spectrum / spectrum.max()
+
+    centers = np.r_[rng.uniform(1350, 1950, 120), rng.uniform(3550, 3950, 100)]
+    water = lorentzians(centers, rng.uniform(1.5, 3, len(centers)), rng.exponential(1, len(centers)))
+    lines = np.r_[2348 - 1.6 * np.arange(1, 30), 2350 + 1.6 * np.arange(1, 30)]
+    envelope = np.exp(-0.5 * ((lines - 2349) / 15) ** 2)
+    co2 = lorentzians(np.r_[lines, 667], np.r_[np.full(len(lines), 0.5), 1], np.r_[envelope, 1])
+    return {'water': water, 'co2': co2}
+
+
+if __name__ == "__main__":
+    import os
+    import time
+    import h5py
+    from lbl_ir.tasks.preprocessing.batched_EMSC import simulate_map
+
+    wavenumbers = np.linspace(4000, 650, 3475)  # ~1 cm-1 spacing, so the water lines are resolved
+    spectra, m0 = simulate_map(wavenumbers, 20000)
+    atmosphere = simulate_atmosphere(wavenumbers)
+    rng = np.random.RandomState(1)
+    true_scales = rng.uniform(0, 0.05, (len(spectra), 2))
+    observed = spectra + (true_scales @ np.array([atmosphere['water'], atmosphere['co2']])).astype('float32')
+
+    comp = atmospheric_compensation(wavenumbers, atmosphere)
+    t0 = time.perf_counter()
+    corrected = np.empty_like(observed)
+    scales = comp.correct(observed, out=corrected)
+    t_batch = time.perf_counter() - t0
+    # residual atmosphere after compensation, relative to what was added
+    err = scales - true_scales
+    rms_before = np.sqrt(np.mean((observed[:500] - spectra[:500]) ** 2))
+    rms_after = np.sqrt(np.mean((corrected[:500] - spectra[:500]) ** 2))
+    print(f'scale error: bias {err.mean(axis=0)}, std {err.std(axis=0)}; '
+          f'rms atmosphere {rms_before:.2e} -> {rms_after:.2e}')
+    assert np.all(np.abs(err.mean(axis=0)) < 2e-4) and np.all(err.std(axis=0) < 2e-3)
+    assert rms_after < 0.15 * rms_before
+
+    # per spectrum least squares, the unbatched way
+    design = comp.solver.design[comp.solver.rows]
+    t0 = time.perf_counter()
+    for a in observed[:500]:
+        a = a.astype('float64')[None, :]
+        np.linalg.lstsq(design, comp._highpass(a)[0, comp.solver.rows], rcond=None)
+    t_single = (time.perf_counter() - t0) * len(observed) / 500
+    print(f'{len(observed)} spectra: per spectrum lstsq {t_single:.2f} s (estimated), batched {t_batch:.2f} s')
+
+    # without the high pass the model carries its own offset and baseline
+    plain = atmospheric_compensation(wavenumbers, atmosphere, highpass=None).fit(observed[:500])
+    print(f'scale error std without high pass {(plain - true_scales[:500]).std(axis=0)}')
+
+    # in place on an hdf5 dataset, references from an npz file, descending axis
+    np.savez('tst_atm.npz', wavenumbers=wavenumbers[::-1], **{k: v[::-1] for k, v in atmosphere.items()})
+    with h5py.File('tst_atm.h5', 'w') as f:
+        f.create_dataset('spectra', data=observed[:3000])
+    with h5py.File('tst_atm.h5', 'r+') as f:
+        atmospheric_compensation(wavenumbers, 'tst_atm.npz').correct(f['spectra'], out=f['spectra'], chunk_size=700)
+        assert np.allclose(f['spectra'][:], corrected[:3000], atol=1e-5)
+    os.remove('tst_atm.h5')
+    os.remove('tst_atm.npz')
+    print('OK')
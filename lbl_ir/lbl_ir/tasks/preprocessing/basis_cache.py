@@ -0,0 +1,162 @@
+"""
+Cache of extinction bases used by the EMSC corrections.
+
+The principal components of an extinction matrix only depend on the wavenumber axis, the parameter grid
+(alpha, or refractive index and radius) and the number of components, not on the corrected spectrum. They are
+cached in memory (least recently used entries are dropped first) and optionally as .npy files in a cache
+directory, keyed by a hash of these inputs.
+
+"""
+
+import os
+import hashlib
+import threading
+from collections import OrderedDict
+import numpy as np
+
+
+def basis_key(name, *args):
+    """
+    Hash of the inputs of an extinction basis.
+
+    :param name: basis type, e.g. 'kohler'
+    :param args: arrays and scalars the basis depends on
+    :return: hex digest
+    """
+    h = hashlib.sha1(name.encode())
+    for arg in args:
+        arg = np.ascontiguousarray(arg, dtype='float64')
+        h.update(str(arg.shape).encode())
+        h.update(arg.tobytes())
+    return h.hexdigest()
+
+
+class basis_cache(object):
+    """
+    LRU cache of extinction bases, in memory and optionally on disk.
+
+    Arguments:
+    ----------
+    maxsize   : number of bases kept in memory
+
+    cache_dir : directory of the disk cache, no disk cache if None
+
+    Attributes:
+    -----------
+    hits, misses, disk_hits : cache statistics since creation or the last clear()
+    """
+
+    def __init__(self, maxsize=32, cache_dir=None):
+        self.maxsize = maxsize
+        self.cache_dir = cache_dir
+        self._cache = OrderedDict()
+        self.hits, self.misses, self.disk_hits = 0, 0, 0
+        # the caches are shared by worker threads: _lock guards the OrderedDict and the counters, a lock per
+        # missing key makes threads that miss the same key wait for one build instead of repeating it
+        self._lock = threading.Lock()
+        self._key_locks = {}
+
+    def _lookup(self, key):
+        # call with self._lock held
+        if key in self._cache:
+            self.hits += 1
+            self._cache.move_to_end(key)
+            return self._cache[key]
+        return None
+
+    def _load(self, key):
+        if self.cache_dir is None:
+            return None
+        filename = os.path.join(self.cache_dir, key + '.npy')
+        if os.path.isfile(filename):
+            try:
+                return np.load(filename)
+            except (OSError, ValueError):
+                return None
+        return None
+
+    def get(self, key, build):
+        """
+        :param key: hash from basis_key
+        :param build: function without arguments computing the basis on a miss, called without holding the
+                      cache lock, so other keys are served meanwhile
+        :return: read only basis array
+        """
+        with self._lock:
+            basis = self._lookup(key)
+            if basis is not None:
+                return basis
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+        with key_lock:
+            with self._lock:
+                # built by another thread while this one waited
+                basis = self._lookup(key)
+                if basis is not None:
+                    return basis
+            basis = self._load(key)
+            from_disk = basis is not None
+            if basis is None:
+                basis = np.asarray(build())
+                if self.cache_dir is not None:
+                    try:
+                        os.makedirs(self.cache_dir, exist_ok=True)
+                        np.save(os.path.join(self.cache_dir, key + '.npy'), basis)
+                    except OSError:
+                        pass
+            basis.flags.writeable = False
+            with self._lock:
+                if from_disk:
+                    self.disk_hits += 1
+                else:
+                    self.misses += 1
+                self._cache[key] = basis
+                while len(self._cache) > self.maxsize:
+                    self._cache.popitem(last=False)
+                self._key_locks.pop(key, None)
+        return basis
+
+    def set_cache_dir(self, cache_dir):
+        self.cache_dir = cache_dir
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'disk_hits': self.disk_hits, 'size': len(self._cache)}
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+            self.hits, self.misses, self.disk_hits = 0, 0, 0
+
+
+# cache shared by the EMSC functions
+extinction_cache = basis_cache()
+
+
+if __name__ == "__main__":
+    import time
+    from concurrent.futures import ThreadPoolExecutor
+
+    # threads hitting, missing and evicting in a small cache at the same time
+    cache = basis_cache(maxsize=4)
+    builds = []
+
+    def build(k):
+        builds.append(k)
+        time.sleep(0.001)
+        return np.full(10, k, dtype='float64')
+
+    def task(i):
+        k = i % 7
+        assert cache.get(str(k), lambda: build(k))[0] == k
+    with ThreadPoolExecutor(8) as pool:
+        list(pool.map(task, range(5000)))
+    stats = cache.stats()
+    assert stats['hits'] + stats['misses'] == 5000 and stats['misses'] == len(builds) and stats['size'] == 4
+
+    # concurrent misses of one key build it once
+    cache.clear()
+    builds.clear()
+    with ThreadPoolExecutor(8) as pool:
+        list(pool.map(lambda i: cache.get('slow', lambda: build(0)), range(32)))
+    assert builds == [0] and cache.stats()['hits'] == 31
+    print('OK')
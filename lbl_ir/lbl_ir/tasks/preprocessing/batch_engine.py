@@ -0,0 +1,211 @@
+"""
+Headless batch preprocessing of the spectra of a map.
+
+Runs one preprocessing configuration (anchor point, convex hull or Kohler EMSC baseline, plus the 2nd derivative) over all or
+a selection of spectra, in chunks spread over worker threads. Only the selected method is computed, outputs are
+preallocated, and progress is reported per chunk. A threading.Event cancels the run between chunks.
+
+"""
+
+import ast
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+from lbl_ir.tasks.baseline.anchor_points import parse_anchors, anchor_baseline
+from lbl_ir.tasks.baseline.rubberband import rubberband_batch
+from lbl_ir.math_tools.derivative import savgol
+from lbl_ir.tasks.preprocessing.batched_EMSC import kohler_zero_batch
+from lbl_ir.tasks.preprocessing.EMSC import precompute_kohler_basis
+
+# outputs of every method, named as the attributes of the preprocessing widget's Preprocessor
+OUTPUTS = {'rubberband': ['rubberDebased', 'rubberBaseline', 'deriv2_rubber'],
+           'convex_hull': ['hullDebased', 'hullBaseline', 'deriv2_hull'],
+           'kohler': ['kohlerDebased', 'kohlerBaseline', 'deriv2_kohler']}
+
+
+def nth_order_gradient(dx, y, n=1):
+    """
+    nth order derivative of the spectra y along the last axis, infinite values set to 0
+    """
+    for i in range(n):
+        y = np.gradient(y, dx, axis=-1)
+    return np.where(np.abs(y) == np.inf, 0, y)
+
+
+class batch_preprocessor(object):
+    """
+    Batch preprocessing of spectra.
+
+    Arguments:
+    ----------
+    wavenumbers : wavenumber array
+
+    data        : (N_obs, N_w) spectra, array or sequence of spectra
+
+    spectra_ids : indexes of the spectra to process, all if None
+
+    method      : 'rubberband' (anchor point baseline), 'convex_hull' (lower convex hull over the anchor range)
+                  or 'kohler'
+
+    anchors     : anchor points string; the first and last anchor define the processed energy range
+
+    kind        : interpolation of the rubberband baseline between anchors: 'linear', 'quadratic' or 'cubic'
+
+    w_regions   : Kohler fitting regions, list of (low, high) pairs or its string representation
+
+    anchor_window : local minimum search half width around every rubberband anchor, in points, 0 uses the
+                  anchor values
+
+    derivative  : 'gradient' (np.gradient twice) or 'savgol' (Savitzky-Golay) 2nd derivative
+
+    sg_window, sg_polyorder : Savitzky-Golay window length and polynomial order
+
+    chunk_size  : number of spectra per task
+
+    n_threads   : number of worker threads
+
+    Attributes:
+    -----------
+    energy      : processed wavenumbers
+
+    outputs     : dict of (n_spectra, len(energy)) result arrays, see OUTPUTS
+    """
+
+    def __init__(self, wavenumbers, data, spectra_ids=None, method='kohler', anchors='400, 4000', kind='linear',
+                 w_regions='[(650, 750), (1780, 2680), (3680, 4000)]', anchor_window=0, derivative='gradient',
+                 sg_window=11, sg_polyorder=3, chunk_size=500, n_threads=4):
+        if method not in OUTPUTS:
+            raise ValueError(f'method must be one of {list(OUTPUTS)}')
+        self.wavenumbers = np.asarray(wavenumbers)
+        self.data = data
+        self.spectra_ids = np.arange(len(data)) if spectra_ids is None else np.asarray(spectra_ids)
+        self.method = method
+        self.kind = kind
+        self.w_regions = ast.literal_eval(w_regions) if isinstance(w_regions, str) else w_regions
+        self.chunk_size = chunk_size
+        self.n_threads = n_threads
+
+        self.anchor_idx = parse_anchors(anchors, self.wavenumbers)
+        if len(self.anchor_idx) < 2:
+            raise ValueError('At least 2 anchor points are needed.')
+        self.trim = slice(self.anchor_idx[0], self.anchor_idx[-1] + 1)
+        self.energy = self.wavenumbers[self.trim]
+        self.wav_anchor = self.wavenumbers[self.anchor_idx]
+        if method == 'rubberband':
+            self.baseline = anchor_baseline(self.wavenumbers, self.anchor_idx, kind, anchor_window)
+        self.derivative = derivative
+        if derivative == 'savgol':
+            # Kohler results are in sorted wavenumber order
+            axis = np.sort(self.energy) if method == 'kohler' else self.energy
+            self.sg = savgol(axis, sg_window, sg_polyorder, deriv=2)
+        n = len(self.spectra_ids)
+        self.outputs = {name: np.empty((n, len(self.energy)), dtype='float32') for name in OUTPUTS[method]}
+        self.n_done = 0
+        self._lock = threading.Lock()
+
+    def read(self, i0, i1):
+        ids = self.spectra_ids[i0:i1]
+        if isinstance(self.data, np.ndarray):
+            return np.asarray(self.data[ids], dtype='float64')
+        return np.array([self.data[i] for i in ids], dtype='float64')
+
+    def second_derivative(self, block):
+        if self.derivative == 'savgol':
+            return self.sg(block)
+        return nth_order_gradient(self.energy[1] - self.energy[0], block, n=2)
+
+    def process_chunk(self, i0, i1):
+        """
+        Process spectra i0:i1 of spectra_ids and store the results in outputs
+        """
+        spectra = self.read(i0, i1)
+        specTrim = spectra[:, self.trim]
+        if self.method == 'rubberband':
+            baseline = self.baseline(spectra)
+            self.outputs['rubberBaseline'][i0:i1] = baseline
+            self.outputs['rubberDebased'][i0:i1] = specTrim - baseline
+            # as in the preprocessing widget, the derivative is taken of the trimmed raw spectrum
+            self.outputs['deriv2_rubber'][i0:i1] = self.second_derivative(specTrim)
+        elif self.method == 'convex_hull':
+            baseline = rubberband_batch(self.energy, specTrim, parallel=False)
+            self.outputs['hullBaseline'][i0:i1] = baseline
+            self.outputs['hullDebased'][i0:i1] = specTrim - baseline
+            self.outputs['deriv2_hull'][i0:i1] = self.second_derivative(specTrim - baseline)
+        else:
+            debased, baseline = kohler_zero_batch(self.energy, specTrim, self.w_regions, chunk_size=self.chunk_size)
+            self.outputs['kohlerDebased'][i0:i1] = debased
+            self.outputs['kohlerBaseline'][i0:i1] = baseline
+            self.outputs['deriv2_kohler'][i0:i1] = self.second_derivative(debased)
+
+    def run(self, progress=None, chunk_done=None, cancel=None):
+        """
+        Process all spectra.
+
+        :param progress: function(n_done, n_total) called after every chunk, from a worker thread
+        :param chunk_done: function(i0, i1) called after every chunk, from a worker thread
+        :param cancel: threading.Event; when set, chunks that haven't started are skipped
+        :return: True if all spectra were processed, False if cancelled
+        """
+        if self.method == 'kohler':
+            precompute_kohler_basis(self.energy)
+        n_total = len(self.spectra_ids)
+        self.n_done = 0
+
+        def task(i0, i1):
+            if (cancel is not None) and cancel.is_set():
+                return False
+            self.process_chunk(i0, i1)
+            with self._lock:
+                self.n_done += i1 - i0
+                n_done = self.n_done
+            if chunk_done is not None:
+                chunk_done(i0, i1)
+            if progress is not None:
+                progress(n_done, n_total)
+            return True
+
+        with ThreadPoolExecutor(max_workers=self.n_threads) as executor:
+            futures = [executor.submit(task, i0, min(i0 + self.chunk_size, n_total))
+                       for i0 in range(0, n_total, self.chunk_size)]
+            done = [future.result() for future in futures]
+        return all(done)
+
+    def params(self):
+        """Parameters of the run, as reported by the preprocessing widget"""
+        return {'preprocess_method': self.method, 'wav_anchor': self.wav_anchor,
+                'interp_method': self.kind if self.method == 'rubberband' else None,
+                'w_regions': self.w_regions if self.method == 'kohler' else None,
+                'derivative': self.derivative}
+
+
+if __name__ == "__main__":
+    import time
+    from scipy.interpolate import interp1d
+    from lbl_ir.tasks.preprocessing.batched_EMSC import simulate_map
+
+    wavenumbers = np.linspace(4000, 650, 1738)
+    spectra, m0 = simulate_map(wavenumbers, 20000)
+    engine = batch_preprocessor(wavenumbers, spectra, method='kohler')
+    t0 = time.perf_counter()
+    assert engine.run()
+    print(f'kohler: {len(spectra)} spectra in {time.perf_counter() - t0:.1f} s')
+    trim = engine.trim
+    # the preprocessing widget previews a spectrum with the same solver
+    debased, baseline = kohler_zero_batch(engine.energy, spectra[7:8, trim], engine.w_regions)
+    assert np.max(np.abs(engine.outputs['kohlerDebased'][7] - debased[0])) < 1e-5 * np.ptp(spectra[7])
+    assert np.max(np.abs(engine.outputs['kohlerBaseline'][7] - baseline[0])) < 1e-5 * np.ptp(spectra[7])
+
+    engine = batch_preprocessor(wavenumbers, spectra, spectra_ids=np.arange(0, 20000, 3), method='rubberband',
+                                anchors='650, 1800, 2700, 3700, 4000', kind='cubic')
+    cancel = threading.Event()
+    assert not engine.run(progress=lambda n, total: cancel.set(), cancel=cancel)
+    assert engine.n_done < len(engine.spectra_ids)
+    assert engine.run()
+    f = interp1d(engine.wav_anchor, spectra[3, engine.anchor_idx], kind='cubic')
+    assert np.allclose(engine.outputs['rubberBaseline'][1], f(engine.energy), rtol=1e-4, atol=1e-5)
+
+    engine = batch_preprocessor(wavenumbers, spectra[:2000], method='convex_hull', anchors='650, 4000')
+    assert engine.run()
+    assert np.all(engine.outputs['hullDebased'] >= -1e-5)
+    print('OK')
@@ -0,0 +1,358 @@
+"""
+Batched Kohler and Bassan EMSC for all spectra of a map.
+
+The Kohler model of an apparent spectrum
+
+    A_app = b * m0 + c + sum_j g_j * p_j
+
+is linear in its parameters (b, c, g), so instead of minimizing the residual spectrum by spectrum, the design
+matrix [m0, 1, p_1 ... p_n] is factorized once and all spectra are solved together with one QR based least
+squares. The correction is then applied to blocks of spectra with array operations.
+
+Bassan's iterative correction rebuilds the extinction basis from every corrected spectrum. All spectra of a
+block advance one iteration together: their extinction matrices are built in one broadcast, their principal
+components come from one stacked SVD and their models are solved with one stacked QR. Spectra that have converged
+drop out of the following iterations.
+
+"""
+
+import time
+import numpy as np
+import scipy.linalg
+from lbl_ir.math_tools.kramers_kronig import kk_transform
+from lbl_ir.math_tools.streaming_stats import stream_stats
+from lbl_ir.tasks.preprocessing.EMSC import Q_ext_kohler, find_nearest_number_index, Kohler, Kohler_zero, \
+    kohler_basis, KOHLER_ALPHA, KOHLER_ZERO_ALPHA, Bassan, bassan_basis, Q_ext_bassan, orthogonalize, \
+    correct_reference, BASSAN_A, BASSAN_D
+from lbl_ir.tasks.preprocessing.basis_cache import basis_key, extinction_cache
+
+
+def region_indexes(wn, w_regions):
+    """
+    Indexes of the fitting regions, as selected in EMSC.Kohler_zero
+    """
+    w_indexes = []
+    for pair in w_regions:
+        ii1 = find_nearest_number_index(wn, min(pair))
+        ii2 = find_nearest_number_index(wn, max(pair))
+        w_indexes.extend(np.arange(ii1, ii2))
+    return np.array(w_indexes, dtype='int64')
+
+
+class linear_emsc(object):
+    """
+    Least squares solver for a linear EMSC model shared by all spectra.
+
+    Arguments:
+    ----------
+    design  : (N_w, n_params) design matrix, one column per model term
+
+    rows    : indexes of the wavenumbers used in the fit, all wavenumbers if None
+
+    Attributes:
+    -----------
+    fit(A)  : (N_obs, n_params) parameters of spectra A (N_obs, N_w)
+    """
+
+    def __init__(self, design, rows=None):
+        self.design = np.asarray(design, dtype='float64')
+        self.rows = rows
+        fit_design = self.design if rows is None else self.design[rows, :]
+        self._Q, self._R = scipy.linalg.qr(fit_design, mode='economic')
+
+    def fit(self, A):
+        A = np.asarray(A, dtype='float64')
+        if self.rows is not None:
+            A = A[:, self.rows]
+        return scipy.linalg.solve_triangular(self._R, self._Q.T @ A.T).T
+
+
+def stacked_lstsq(design, A):
+    """
+    Least squares solutions of a stack of models, one design matrix per spectrum.
+
+    :param design: (N_obs, N_rows, n_params) design matrices
+    :param A: (N_obs, N_rows) spectra
+    :return: (N_obs, n_params) parameters
+    """
+    Q, R = np.linalg.qr(design)
+    return np.linalg.solve(R, np.einsum('nrp,nr->np', Q, A)[..., np.newaxis])[..., 0]
+
+
+def bassan_bases(wn, M, m_0, n_components, a=BASSAN_A, d=BASSAN_D):
+    """
+    EMSC.bassan_basis of every spectrum of a block: the extinction matrices are built in one broadcast and their
+    principal components, the leading right singular vectors of the centered matrices, come from one stacked
+    eigendecomposition of their Gram matrices (of the smaller side), 3-4x faster than a stacked SVD.
+
+    :param wn: sorted wavenumbers
+    :param M: (N_obs, len(wn)) spectra used for the Kramers-Kronig transform
+    :param m_0: reference spectrum
+    :return: (N_obs, n_components, len(wn)) principal components, signs may differ from bassan_basis
+    """
+    nkk = kk_transform(M, dtype='float64')
+    Q = orthogonalize(Q_ext_bassan(wn, nkk, a, d), m_0)
+    Q -= Q.mean(axis=1, keepdims=True)
+    if Q.shape[1] < Q.shape[2]:
+        # eigenvectors u of Q Q^T give the components u^T Q / |u^T Q|
+        U = np.linalg.eigh(Q @ Q.transpose(0, 2, 1))[1][:, :, :-n_components - 1:-1]
+        p_i = U.transpose(0, 2, 1) @ Q
+        return p_i / np.linalg.norm(p_i, axis=2, keepdims=True)
+    return np.linalg.eigh(Q.transpose(0, 2, 1) @ Q)[1][:, :, :-n_components - 1:-1].transpose(0, 2, 1)
+
+
+def _blocks(N_obs, chunk_size):
+    for i0 in range(0, N_obs, chunk_size):
+        yield i0, min(i0 + chunk_size, N_obs)
+
+
+def kohler_batch(wavenumbers, App, m0, n_components=8, chunk_size=10000, basis=None):
+    """
+    Batched version of EMSC.Kohler.
+
+    :param wavenumbers: array of wavenumbers
+    :param App: (N_obs, N_w) apparent spectra, array or row sliceable dataset
+    :param m0: reference spectrum, the mean spectrum of App, accumulated in a streaming pass, if None
+    :param n_components: number of principal components of the extinction matrix
+    :param chunk_size: number of spectra corrected at a time
+    :param basis: extinction basis for the sorted wavenumbers, taken from the basis cache if None
+    :return: (N_obs, N_w) corrected spectra, in reverse sorted wavenumber order like EMSC.Kohler
+    """
+    if m0 is None:
+        m0 = stream_stats(App, covariance=False, chunk_size=chunk_size).mean
+    ii = np.argsort(wavenumbers)
+    wn = np.asarray(wavenumbers, dtype='float64')[ii]
+    m_0 = np.asarray(m0, dtype='float64')[ii]
+    p_i = kohler_basis(wn, KOHLER_ALPHA, n_components) if basis is None else basis
+    solver = linear_emsc(np.column_stack([m_0, np.ones(len(wn)), p_i.T]))
+
+    N_obs = len(App)
+    Z_corr = np.empty((N_obs, len(wn)), dtype=np.result_type(App.dtype, np.float32))
+    for i0, i1 in _blocks(N_obs, chunk_size):
+        A_app = np.asarray(App[i0:i1], dtype='float64')[:, ii]
+        x = solver.fit(A_app)
+        b, c, g_i = x[:, 0:1], x[:, 1:2], x[:, 2:]
+        Z_corr[i0:i1] = ((A_app - c - g_i @ p_i) / b)[:, ::-1]
+    return Z_corr
+
+
+def kohler_zero_batch(wavenumbers, App, w_regions, n_components=8, chunk_size=10000, basis=None):
+    """
+    Batched version of EMSC.Kohler_zero.
+
+    With a zero reference spectrum the reference factor drops out of the model, so only the offset and the
+    extinction scores are fitted on the fitting regions.
+
+    :param wavenumbers: array of wavenumbers
+    :param App: (N_obs, N_w) apparent spectra, array or row sliceable dataset
+    :param w_regions: fitting regions, list of (low, high) wavenumber pairs
+    :param n_components: number of principal components of the extinction matrix
+    :param chunk_size: number of spectra corrected at a time
+    :param basis: extinction basis for the sorted wavenumbers, taken from the basis cache if None
+    :return: corrected spectra and baselines (N_obs, N_w), in sorted wavenumber order like EMSC.Kohler_zero
+    """
+    ii = np.argsort(wavenumbers)
+    wn = np.asarray(wavenumbers, dtype='float64')[ii]
+    p_i = kohler_basis(wn, KOHLER_ZERO_ALPHA, n_components) if basis is None else basis
+    solver = linear_emsc(np.column_stack([np.ones(len(wn)), p_i.T]), rows=region_indexes(wn, w_regions))
+
+    N_obs = len(App)
+    dtype = np.result_type(App.dtype, np.float32)
+    Z_corr = np.empty((N_obs, len(wn)), dtype=dtype)
+    base = np.empty((N_obs, len(wn)), dtype=dtype)
+    for i0, i1 in _blocks(N_obs, chunk_size):
+        A_app = np.asarray(App[i0:i1], dtype='float64')[:, ii]
+        x = solver.fit(A_app)
+        c, g_i = x[:, 0:1], x[:, 1:]
+        base[i0:i1] = g_i @ p_i
+        Z_corr[i0:i1] = A_app - c - base[i0:i1]
+    return Z_corr, base
+
+
+def bassan_batch(wavenumbers, App, m0, n_components=8, iterations=1, w_regions=None, tol=1e-4, chunk_size=1000,
+                 basis_values=2 ** 25):
+    """
+    Batched version of EMSC.Bassan.
+
+    The first iteration builds the extinction basis from the reference and solves all spectra of a block
+    together. Each following iteration rebuilds the bases of all spectra that haven't converged from their
+    last corrections with bassan_bases, and solves their models together with stacked_lstsq.
+
+    :param wavenumbers: array of wavenumbers
+    :param App: (N_obs, N_w) apparent spectra, array or row sliceable dataset
+    :param m0: reference spectrum
+    :param n_components: number of principal components of the extinction matrix
+    :param iterations: maximum number of iterations
+    :param w_regions: fitting regions, list of (low, high) wavenumber pairs, all wavenumbers if None.
+                      The reference factor is then only determined by the reference inside these regions.
+    :param tol: a spectrum has converged when its correction changes by less than tol (relative norm)
+    :param chunk_size: number of spectra iterated together
+    :param basis_values: bound on the number of float64 values of the stacked extinction matrices, spectra whose
+                         bases are rebuilt together are limited to it
+    :return: (N_obs, N_w) corrected spectra in reverse sorted wavenumber order like EMSC.Bassan,
+             and the number of iterations of every spectrum
+    """
+    ii = np.argsort(wavenumbers)
+    wn = np.asarray(wavenumbers, dtype='float64')[ii]
+    m_0 = np.asarray(m0, dtype='float64')[ii]
+    rows = None
+    if w_regions is not None:
+        m_0 = correct_reference(np.copy(m_0), wn, BASSAN_A, BASSAN_D, w_regions)
+        rows = region_indexes(wn, w_regions)
+    terms = np.column_stack([np.ones(len(wn)), wn, m_0])  # offset, linear baseline, reference
+
+    def correct(A_app, p_i, x):
+        c, m, h, g_i = x[:, 0:1], x[:, 1:2], x[:, 2:3], x[:, 3:]
+        return (A_app - c - m * wn - g_i @ p_i) / h
+
+    # first iteration: the basis only depends on the reference
+    p_0 = extinction_cache.get(basis_key('bassan', wn, m_0, n_components),
+                               lambda: bassan_basis(wn, m_0, m_0, n_components, BASSAN_A, BASSAN_D))
+    solver = linear_emsc(np.column_stack([terms, p_0.T]), rows=rows)
+
+    def correct_stacked(A_app, p_i, x):
+        c, m, h, g_i = x[:, 0:1], x[:, 1:2], x[:, 2:3], x[:, 3:]
+        return (A_app - c - m * wn - np.einsum('nk,nkw->nw', g_i, p_i)) / h
+
+    fit_rows = np.arange(len(wn)) if rows is None else rows
+    n_Q = Q_ext_bassan(wn[:1], np.zeros(1), BASSAN_A, BASSAN_D).shape[0]  # rows of an extinction matrix
+    group = max(1, basis_values // (n_Q * len(wn)))
+    N_obs = len(App)
+    Z_out = np.empty((N_obs, len(wn)), dtype=np.result_type(App.dtype, np.float32))
+    n_iter = np.zeros(N_obs, dtype='int64')
+    for i0, i1 in _blocks(N_obs, chunk_size):
+        A_app = np.asarray(App[i0:i1], dtype='float64')[:, ii]
+        Z_corr = correct(A_app, p_0, solver.fit(A_app))
+        active = np.ones(len(A_app), dtype='bool')
+        n_iter[i0:i1] = 1
+        for iteration in range(1, iterations):
+            idx = np.nonzero(active)[0]
+            if len(idx) == 0:
+                break
+            for j0 in range(0, len(idx), group):
+                j = idx[j0:j0 + group]
+                p_i = bassan_bases(wn, Z_corr[j], m_0, n_components)
+                design = np.concatenate([np.broadcast_to(terms, (len(j),) + terms.shape),
+                                         p_i.transpose(0, 2, 1)], axis=2)
+                x = stacked_lstsq(design[:, fit_rows], A_app[j][:, fit_rows])
+                Z_new = correct_stacked(A_app[j], p_i, x)
+                change = np.linalg.norm(Z_new - Z_corr[j], axis=1) / np.linalg.norm(Z_corr[j], axis=1)
+                Z_corr[j] = Z_new
+                active[j[change < tol]] = False
+            n_iter[i0 + idx] += 1
+        Z_out[i0:i1] = Z_corr[:, ::-1]
+    return Z_out, n_iter
+
+
+def validate(wavenumbers, App, m0=None, w_regions=None, n_components=8, n_check=10, seed=0):
+    """
+    Compare the batched solver with the per-spectrum Powell optimizer of EMSC.Kohler (m0 given) or
+    EMSC.Kohler_zero (w_regions given) on a random subset of spectra.
+
+    The batched solver gives the exact least squares optimum, the optimizer stops at its own tolerance,
+    so small differences are expected.
+
+    :return: dict with the largest difference relative to the spectrum range and the largest difference
+             of the residual norms of the two fits (positive if the batched fit is better)
+    """
+    rng = np.random.RandomState(seed)
+    check = np.sort(rng.choice(len(App), min(n_check, len(App)), replace=False))
+    A = np.asarray(App[check], dtype='float64')
+    ii = np.argsort(wavenumbers)
+    if m0 is not None:
+        batched = kohler_batch(wavenumbers, A, m0, n_components)
+        single = np.array([Kohler(wavenumbers, a, m0, n_components) for a in A])
+        # corrected spectra are scaled by 1/b, compare them relative to their own range
+        scale = np.ptp(single, axis=1)
+        residual = None
+    else:
+        batched, batched_base = kohler_zero_batch(wavenumbers, A, w_regions, n_components)
+        single = np.array([Kohler_zero(wavenumbers, a, w_regions, n_components)[0] for a in A])
+        scale = np.ptp(A, axis=1)
+        rows = region_indexes(np.asarray(wavenumbers)[ii], w_regions)
+        # corrected spectra are the fit residuals in the fitting regions
+        residual = float(np.max(np.linalg.norm(single[:, rows], axis=1) - np.linalg.norm(batched[:, rows], axis=1)))
+    diff = np.max(np.abs(batched - single), axis=1) / scale
+    return {'n_checked': len(check), 'max_rel_diff': float(diff.max()), 'median_rel_diff': float(np.median(diff)),
+            'residual_gain': residual}
+
+
+def simulate_map(wavenumbers, n_spectra, seed=0):
+    """
+    Simulated scattering spectra: a reference with Gaussian bands, a random scale, offset and a random Mie-like
+    extinction term per spectrum, plus noise.
+
+    :return: spectra (n_spectra, N_w), reference spectrum
+    """
+    rng = np.random.RandomState(seed)
+    wn = np.asarray(wavenumbers, dtype='float64')
+    m0 = np.zeros(len(wn))
+    for center, width, height in [(1655, 25, 1.0), (1545, 20, 0.6), (1240, 30, 0.3), (1080, 30, 0.35),
+                                  (2925, 35, 0.4), (3300, 120, 0.5)]:
+        m0 += height * np.exp(-0.5 * ((wn - center) / width) ** 2)
+    alpha = rng.uniform(5e-4, 45e-4, n_spectra).astype('float32')
+    spectra = np.empty((n_spectra, len(wn)), dtype='float32')
+    for i0, i1 in _blocks(n_spectra, 10000):
+        n = i1 - i0
+        Q = Q_ext_kohler(wn[np.newaxis, :], alpha[i0:i1, np.newaxis])
+        spectra[i0:i1] = (rng.uniform(0.5, 1.5, (n, 1)) * m0 + rng.uniform(-0.1, 0.1, (n, 1))
+                          + rng.uniform(0.05, 0.3, (n, 1)) * Q + rng.normal(0, 0.002, (n, len(wn))))
+    return spectra, m0
+
+
+if __name__ == "__main__":
+    wavenumbers = np.linspace(4000, 650, 1738)
+    w_regions = [(650, 750), (1780, 2680), (3680, 4000)]
+
+    spectra, m0 = simulate_map(wavenumbers, 100000)
+    print('validation Kohler     :', validate(wavenumbers, spectra, m0=m0, n_check=5))
+    print('validation Kohler_zero:', validate(wavenumbers, spectra, w_regions=w_regions, n_check=5))
+
+    # benchmark on a simulated 100k-spectrum map
+    n_single = 5
+    t0 = time.perf_counter()
+    for a in spectra[:n_single]:
+        Kohler_zero(wavenumbers, a, w_regions)
+    t_single = (time.perf_counter() - t0) / n_single
+    t0 = time.perf_counter()
+    Z_corr, base = kohler_zero_batch(wavenumbers, spectra, w_regions)
+    t_batch = time.perf_counter() - t0
+    print(f'Kohler_zero, {len(spectra)} spectra: per-spectrum optimizer {t_single * len(spectra):.0f} s (estimated), '
+          f'batched {t_batch:.1f} s ({len(spectra) / t_batch:.0f} spectra/s)')
+    t0 = time.perf_counter()
+    kohler_batch(wavenumbers, spectra, m0)
+    t_batch = time.perf_counter() - t0
+    print(f'Kohler, {len(spectra)} spectra: batched {t_batch:.1f} s ({len(spectra) / t_batch:.0f} spectra/s)')
+
+    # Bassan: per-spectrum optimizer against the batched iterations on a small map
+    wn = wavenumbers[::4]
+    spectra, m0 = simulate_map(wn, 1000)
+    t0 = time.perf_counter()
+    single = np.array([Bassan(wn, a, m0, iterations=3) for a in spectra[:5]])
+    t_single = (time.perf_counter() - t0) / 5
+    t0 = time.perf_counter()
+    Z_corr, n_iter = bassan_batch(wn, spectra, m0, iterations=3, tol=1e-3)
+    t_batch = time.perf_counter() - t0
+    # the spectra are scaled copies of m0 plus offset, extinction and noise, so the correction should recover m0
+    err = np.max(np.abs(Z_corr - m0), axis=1) / np.ptp(m0)
+    err_single = np.max(np.abs(single - m0), axis=1) / np.ptp(m0)
+    print(f'Bassan, {len(spectra)} spectra, 3 iterations: max error relative to the reference range, median '
+          f'{np.median(err):.2e} (90th percentile {np.percentile(err, 90):.2e}), first 5 spectra batched '
+          f'{np.median(err[:5]):.2e} / optimizer {np.median(err_single):.2e}; per-spectrum '
+          f'{t_single * len(spectra):.0f} s (estimated), batched {t_batch:.1f} s, '
+          f'iterations per spectrum {np.bincount(n_iter)[1:]}')
+    assert np.median(err) < 0.02 and np.percentile(err, 90) < 0.05
+    assert np.median(err[:5]) <= np.median(err_single)
+
+    # the stacked iterations against the same least squares model solved spectrum by spectrum
+    ii = np.argsort(wn)
+    wn_s, m_0 = wn[ii], m0[ii]
+    terms = np.column_stack([np.ones(len(wn_s)), wn_s, m_0])
+    for a, z, n in zip(spectra[:5].astype('float64')[:, ii], Z_corr[:5], n_iter[:5]):
+        m_n = m_0
+        for iteration in range(n):
+            p_i = bassan_basis(wn_s, m_n, m_0, 8, BASSAN_A, BASSAN_D)
+            x = linear_emsc(np.column_stack([terms, p_i.T])).fit(a[np.newaxis, :])[0]
+            m_n = (a - x[0] - x[1] * wn_s - x[3:] @ p_i) / x[2]
+        assert np.max(np.abs(m_n[::-1] - z)) < 1e-6 * np.ptp(m_n)
+    print('OK')
@@ -0,0 +1,200 @@
+"""
+Spectral binning of IR spectra for interactive previews.
+
+Groups of `factor` neighbouring wavenumbers are averaged with weights equal to the width of the wavenumber
+interval each point covers, so that the band areas are preserved also on non uniform wavenumber axes.
+Groups never span a gap in the wavenumber axis (e.g. between two selected wavenumber ranges).
+
+"""
+
+import time
+from collections import OrderedDict
+import numpy as np
+
+BIN_FACTORS = [1, 2, 4, 8]
+
+
+def point_widths(wavenumbers):
+    """
+    Width of the wavenumber interval covered by every point: half the distance to both neighbours.
+    """
+    wavenumbers = np.asarray(wavenumbers, dtype='float64')
+    if len(wavenumbers) < 2:
+        return np.ones(len(wavenumbers))
+    edges = np.concatenate(([wavenumbers[0]], (wavenumbers[1:] + wavenumbers[:-1]) / 2, [wavenumbers[-1]]))
+    return np.abs(np.diff(edges))
+
+
+def bin_groups(wavenumbers, factor, gap=1.5):
+    """
+    Assign every wavenumber to a bin.
+
+    :param wavenumbers: wavenumber array
+    :param factor: number of points per bin
+    :param gap: spacings larger than gap * median spacing start a new segment, bins don't cross segments
+    :return: bin index of every wavenumber
+    """
+    wavenumbers = np.asarray(wavenumbers, dtype='float64')
+    N_w = len(wavenumbers)
+    if N_w < 2:
+        return np.zeros(N_w, dtype='int64')
+    step = np.abs(np.diff(wavenumbers))
+    starts = np.concatenate(([0], np.nonzero(step > gap * np.median(step))[0] + 1, [N_w]))
+    groups = np.empty(N_w, dtype='int64')
+    n_bins = 0
+    for s0, s1 in zip(starts[:-1], starts[1:]):
+        groups[s0:s1] = n_bins + np.arange(s1 - s0) // factor
+        n_bins = groups[s1 - 1] + 1
+    return groups
+
+
+def binning_matrix(wavenumbers, factor):
+    """
+    (N_w, N_bins) matrix W so that data @ W is the width weighted average of every bin.
+
+    :return: W, binned wavenumbers
+    """
+    groups = bin_groups(wavenumbers, factor)
+    widths = point_widths(wavenumbers)
+    n_bins = groups[-1] + 1 if len(groups) else 0
+    W = np.zeros((len(groups), n_bins))
+    W[np.arange(len(groups)), groups] = widths
+    W /= W.sum(axis=0, keepdims=True)
+    return W, np.asarray(wavenumbers, dtype='float64') @ W
+
+
+def bin_spectra(data, wavenumbers, factor, chunk_size=20000):
+    """
+    Bin spectra along the wavenumber axis.
+
+    :param data: (N_obs, N_w) spectra, array or array like that supports row slicing
+    :param wavenumbers: wavenumber array
+    :param factor: number of points per bin; factor 1 returns the data unchanged
+    :param chunk_size: number of spectra binned at a time
+    :return: binned spectra (N_obs, N_bins) as float32, binned wavenumbers
+    """
+    if factor <= 1:
+        return np.asarray(data), np.asarray(wavenumbers)
+    W, wavenumbers_binned = binning_matrix(wavenumbers, factor)
+    W = W.astype('float32')
+    N_obs = len(data)
+    binned = np.empty((N_obs, W.shape[1]), dtype='float32')
+    for i0 in range(0, N_obs, chunk_size):
+        i1 = min(i0 + chunk_size, N_obs)
+        binned[i0:i1, :] = np.asarray(data[i0:i1], dtype='float32') @ W
+    return binned, wavenumbers_binned
+
+
+class binned_cache(object):
+    """
+    Bounded cache of binned copies of spectra datasets, so parameter changes in interactive tasks don't
+    rebin the same map.
+
+    Arguments:
+    ----------
+    maxsize : number of binned copies kept, the least recently used copy is dropped first
+    """
+
+    def __init__(self, maxsize=8):
+        self.maxsize = maxsize
+        self._cache = OrderedDict()
+
+    def get(self, key, data, wavenumbers, factor):
+        """
+        :param key: hashable identifier of the dataset and its wavenumber selection
+        :param data: spectra, or a function returning them; only used on a cache miss
+        :return: binned spectra, binned wavenumbers
+        """
+        key = (key, factor)
+        if key in self._cache:
+            self._cache.move_to_end(key)
+            return self._cache[key]
+        if callable(data):
+            data = data()
+        result = bin_spectra(data, wavenumbers, factor)
+        self._cache[key] = result
+        while len(self._cache) > self.maxsize:
+            self._cache.popitem(last=False)
+        return result
+
+    def clear(self):
+        self._cache.clear()
+
+
+def agreement(result_full, result_binned):
+    """
+    Agreement between a full resolution and a binned result.
+
+    Integer label arrays (e.g. cluster labels) are compared with the adjusted rand index. Float arrays
+    (scores, embeddings; one column per component) are compared with the mean absolute correlation of
+    matching columns, so sign flips of components don't count as disagreement.
+    """
+    a, b = np.asarray(result_full), np.asarray(result_binned)
+    if np.issubdtype(a.dtype, np.integer) and np.issubdtype(b.dtype, np.integer):
+        from sklearn.metrics import adjusted_rand_score
+        return adjusted_rand_score(a.ravel(), b.ravel())
+    a, b = a.reshape(len(a), -1), b.reshape(len(b), -1)
+    n = min(a.shape[1], b.shape[1])
+    r = [abs(np.corrcoef(a[:, k], b[:, k])[0, 1]) for k in range(n)]
+    return float(np.mean(r))
+
+
+def binning_report(compute, data, wavenumbers, factors=(2, 4, 8)):
+    """
+    Time a computation at full resolution and on binned spectra and compare the results.
+
+    :param compute: function(data, wavenumbers) returning labels or scores, one row per spectrum
+    :param data: (N_obs, N_w) spectra
+    :param wavenumbers: wavenumber array
+    :param factors: binning factors to compare with full resolution
+    :return: list of dicts with factor, n_bands, time, speedup and agreement; the first entry is full resolution
+    """
+    t0 = time.perf_counter()
+    reference = compute(data, wavenumbers)
+    t_full = time.perf_counter() - t0
+    report = [{'factor': 1, 'n_bands': len(wavenumbers), 'time': t_full, 'speedup': 1.0, 'agreement': 1.0}]
+    for factor in factors:
+        t0 = time.perf_counter()
+        binned, wavenumbers_binned = bin_spectra(data, wavenumbers, factor)
+        result = compute(binned, wavenumbers_binned)
+        t = time.perf_counter() - t0
+        report.append({'factor': factor, 'n_bands': len(wavenumbers_binned), 'time': t,
+                       'speedup': t_full / max(t, 1e-12), 'agreement': agreement(reference, result)})
+    return report
+
+
+def print_report(report):
+    print(f"{'factor':>6} {'bands':>6} {'time (s)':>9} {'speedup':>8} {'agreement':>9}")
+    for entry in report:
+        print(f"{entry['factor']:>6d} {entry['n_bands']:>6d} {entry['time']:>9.3f} "
+              f"{entry['speedup']:>8.1f} {entry['agreement']:>9.3f}")
+
+
+if __name__ == "__main__":
+    from sklearn.decomposition import PCA
+    from sklearn.cluster import KMeans
+
+    # band areas are preserved on a non uniform axis
+    wn = np.sort(np.random.uniform(800, 1800, 501))
+    spec = np.exp(-0.5 * ((wn - 1650) / 20) ** 2)[np.newaxis, :]
+    binned, wn_binned = bin_spectra(spec, wn, 4)
+    area = np.sum(spec[0] * point_widths(wn))
+    area_binned = np.sum(binned[0] * np.bincount(bin_groups(wn, 4), weights=point_widths(wn)))
+    assert np.isclose(area, area_binned, rtol=1e-5)
+    # bins don't cross the gap between two wavenumber ranges
+    wn = np.concatenate((np.arange(900, 1000, 2.0), np.arange(1500, 1703, 2.0)))
+    assert len(np.unique(bin_groups(wn, 8)[:50])) == 7 and bin_groups(wn, 8)[50] == 7
+
+    # simulated map: three tissue classes with different band ratios
+    np.random.seed(0)
+    wn = np.linspace(4000, 650, 1738)
+    bands = np.array([np.exp(-0.5 * ((wn - c) / w) ** 2) for c, w in [(1650, 25), (1545, 20), (1080, 30), (2925, 40)]])
+    classes = np.random.randint(0, 3, 20000)
+    weights = np.array([[1.0, 0.6, 0.2, 0.5], [0.7, 0.5, 0.8, 0.3], [1.0, 0.3, 0.1, 1.0]])[classes]
+    data = weights @ bands + np.random.normal(0, 0.02, (len(classes), len(wn)))
+
+    def pca_kmeans(d, w):
+        scores = PCA(n_components=3).fit_transform(d - d.mean(axis=0))
+        return KMeans(n_clusters=3, random_state=0, n_init=3).fit(scores).labels_
+
+    print_report(binning_report(pca_kmeans, data, wn))
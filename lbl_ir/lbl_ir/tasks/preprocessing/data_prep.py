@@ -2,34 +2,187 @@ import matplotlib.pyplot as plt
 #import pyqtgraph as pq
 
 
+import os
 import sys
+import hashlib
 import numpy as np
+import h5py
 from lbl_ir.io_tools import read_map
+from lbl_ir.math_tools.band_stats import summary_files, write_summary
+from lbl_ir.tasks.preprocessing.basis_cache import basis_cache
 
 from scipy.stats import iqr
 import scipy.signal
 import scipy.ndimage
 
-from numba import jit
+from numba import jit, prange
 
 
-@jit#(nopython=True)
-def band_score_numba(map,subsample=1,band=10):
-    Nx,Ny,Nwav = map.shape
-    result = np.zeros((Nwav,Nwav))
-    norma  = np.zeros((Nwav,Nwav))
-    for ii in range(Nwav):
-        for jj in range( ii+1 ,min(ii+band,Nwav)):
-            slab_0 = map[::subsample,::subsample,ii].flatten()
-            slab_1 = map[::subsample,::subsample,jj].flatten()
-            cc = np.corrcoef(slab_0, slab_1)[0][1]
-            norma[ii,jj]=1.0
-            norma[jj,ii]=1.0
-            result[ii,jj]=cc
-            result[jj,ii]=cc
-    result = np.sum( result, axis=1)
-    norma  = np.sum( norma, axis=1)
-    return result/norma
+@jit(nopython=True, parallel=True)
+def _standardize_bands(z):
+    """
+    Center every band (row) of a (Nwav, Npix) array in place and scale it to unit norm; constant bands become 0
+    """
+    Nwav, Npix = z.shape
+    for ii in prange(Nwav):
+        mean = 0.0
+        for p in range(Npix):
+            mean += z[ii, p]
+        mean /= Npix
+        ss = 0.0
+        for p in range(Npix):
+            ss += (z[ii, p] - mean) ** 2
+        inv = 1.0 / np.sqrt(ss) if ss > 0 else 0.0
+        for p in range(Npix):
+            z[ii, p] = (z[ii, p] - mean) * inv
+
+
+@jit(nopython=True, parallel=True)
+def _neighbor_correlations(z, band):
+    """
+    Correlation coefficients of every standardized band with the next band - 1 bands, as dot products
+    :return: (Nwav, band - 1) array, cc[ii, d - 1] is the correlation of bands ii and ii + d, 0 past the last band
+    """
+    Nwav, Npix = z.shape
+    cc = np.zeros((Nwav, band - 1))
+    for ii in prange(Nwav):
+        for d in range(1, min(band, Nwav - ii)):
+            acc = 0.0
+            for p in range(Npix):
+                acc += z[ii, p] * z[ii + d, p]
+            cc[ii, d - 1] = acc
+    return cc
+
+
+def band_score_numba(map, subsample=1, band=10, n_pixels=None, seed=0, return_error=False):
+    """
+    Band quality score: the mean correlation coefficient, over all pixels, of every band with its band - 1
+    neighbors on either side. Noisy or broken bands decorrelate from their neighbors.
+
+    Every band is standardized once, then all neighbor correlations are dot products, in parallel over bands.
+
+    :param map: (Nx, Ny, Nwav) image cube
+    :param subsample: use every subsample-th pixel along both image axes
+    :param band: neighborhood width, bands ii and jj are neighbors for 0 < |ii - jj| < band
+    :param n_pixels: estimate the scores from a random subset of this many pixels
+    :param seed: random seed of the pixel subset
+    :param return_error: also return the standard error of every score, (1 - r^2) / sqrt(n - 1) averaged over
+                         the neighbors, which bounds the sampling error of a subset of pixels
+    :return: (Nwav,) band scores, and their standard errors if return_error
+    """
+    Nwav = map.shape[2]
+    pixels = np.asarray(map[::subsample, ::subsample, :]).reshape(-1, Nwav)
+    if (n_pixels is not None) and (n_pixels < len(pixels)):
+        pick = np.sort(np.random.default_rng(seed).choice(len(pixels), n_pixels, replace=False))
+        pixels = pixels[pick]
+    z = np.ascontiguousarray(pixels.T, dtype='float32')
+    _standardize_bands(z)
+    cc = _neighbor_correlations(z, band)
+
+    # every pair appears in the rows of both bands
+    result = np.zeros(Nwav)
+    norma = np.zeros(Nwav)
+    error = np.zeros(Nwav)
+    se = (1 - cc ** 2) / np.sqrt(max(z.shape[1] - 1, 1))
+    for d in range(1, min(band, Nwav)):
+        result[:-d] += cc[:-d, d - 1]
+        result[d:] += cc[:-d, d - 1]
+        error[:-d] += se[:-d, d - 1]
+        error[d:] += se[:-d, d - 1]
+        norma[:-d] += 1
+        norma[d:] += 1
+    norma = np.maximum(norma, 1)
+    if return_error:
+        return result / norma, error / norma
+    return result / norma
+
+
+# band scores and their errors, (2, Nwav) arrays, keyed by band_score_key. Set a directory with
+# band_score_cache.set_cache_dir to keep the scores of maps that aren't hdf5 files across sessions too.
+band_score_cache = basis_cache(maxsize=16)
+
+SCORES_PATH = '/data/band_scores'
+
+
+def band_score_key(filename, **params):
+    """
+    Key of the band scores of a map file: its path, size and modification time identify the data, so the key
+    costs O(1).
+
+    :param filename: file the image cube was read from
+    :param params: scoring parameters
+    :return: hex digest
+    """
+    h = hashlib.sha1(b'band_score')
+    for key in sorted(params):
+        h.update(('%s=%r;' % (key, params[key])).encode())
+    st = os.stat(filename)
+    h.update(('%s:%d:%d' % (os.path.realpath(filename), st.st_size, st.st_mtime_ns)).encode())
+    return h.hexdigest()
+
+
+def data_stamp(filename, wavenumbers):
+    """
+    Identity of the data band scores are computed from, stored with the scores and checked when they are read:
+    the number of bands and a hash of the wavenumbers of the image cube (a band subset of the file scores
+    differently), and the data_type attribute of the spectra in the file (set when the file is converted to
+    absorbance in place, see absorbance.h5_to_absorbance).
+
+    :param filename: map filename
+    :param wavenumbers: wavenumbers of the scored image cube
+    :return: dict of attributes
+    """
+    wavenumbers = np.ascontiguousarray(wavenumbers, dtype='float64')
+    data_type = ''
+    if h5py.is_hdf5(filename):
+        with h5py.File(filename, 'r') as f:
+            spectra = list(f.keys())[0] + '/data/spectra'
+            if spectra in f:
+                data_type = str(f[spectra].attrs.get('data_type', ''))
+    return {'n_bands': len(wavenumbers), 'wavenumbers_sha1': hashlib.sha1(wavenumbers.tobytes()).hexdigest(),
+            'data_type': data_type}
+
+
+def _score_attrs(params):
+    # hdf5 attributes can't be None
+    return {key: -1 if val is None else val for key, val in params.items()}
+
+
+def write_band_scores(h5, root, scores, params):
+    """
+    Store band scores in an open hdf5 file, replacing existing ones.
+
+    :param h5: h5py.File opened for writing
+    :param root: sample root group name
+    :param scores: (2, Nwav) band scores and their errors
+    :param params: scoring parameters and data_stamp, stored as attributes
+    """
+    name = root + SCORES_PATH
+    if name in h5:
+        del h5[name]
+    dataset = h5.create_dataset(name, data=np.asarray(scores, dtype='float64'))
+    for key, val in _score_attrs(params).items():
+        dataset.attrs[key] = val
+
+
+def read_band_scores(filename, **params):
+    """
+    Read band scores from a map hdf5 file, or from its sidecar file.
+
+    :param filename: hdf5 filename
+    :param params: scoring parameters and data_stamp the stored scores must have been computed with
+    :return: (2, Nwav) band scores and their errors, or None if neither file has scores for these parameters
+    """
+    params = _score_attrs(params)
+    for name in summary_files(filename):
+        with h5py.File(name, 'r') as f:
+            root = list(f.keys())[0]
+            if root + SCORES_PATH not in f:
+                continue
+            dataset = f[root + SCORES_PATH]
+            if all(dataset.attrs.get(key) == val for key, val in params.items()):
+                return dataset[()]
+    return None
 
 
 class data_prepper(object):
@@ -37,22 +190,52 @@ class data_prepper(object):
     Prep the data for further data analyses.
     We try to detect systematic issues, such as bad bands and synchortron noise spikes
 
+    Band scores of a map read from a file are stored next to the map (in the hdf5 file, or its sidecar file, see
+    band_stats.write_summary) with the data_stamp of the image cube, and cached in band_score_cache, keyed by the
+    file, the stamp and the scoring parameters, so repeated analyses of a map only recompute the masks for new
+    thresholds. Pass the filename only if data_map holds the data of the file as read. Without a filename the
+    scores are computed every time: a key of the data would cost a full read of it.
 
     """
-    def __init__(self, data_map, band_limit=0.99, threshold=6.0,band=5, additional_selection = None):
+    def __init__(self, data_map, band_limit=0.99, threshold=6.0,band=5, additional_selection = None, n_pixels=None,
+                 filename=None, use_cache=True):
         self.data_map    = data_map
         self.waves       = self.data_map.wavenumbers
         self.threshold   = threshold
         self.additional_selection = additional_selection
         self.band_limit   = band_limit
+        self.n_pixels     = n_pixels
+        self.filename     = filename
+        self.use_cache    = use_cache
         self.band_scores  = None
+        self.band_score_error = None
         self.bad_bands    = None
         self.decent_bands = None
         self.score_bands(band)
 
     def score_bands(self,band=10):
         # we need to loop over every single frame and detect spikes
-        self.band_scores  = band_score_numba( self.data_map.imageCube,subsample=1,band=band )
+        def build():
+            return np.vstack(band_score_numba( self.data_map.imageCube,subsample=1,band=band,
+                                               n_pixels=self.n_pixels, return_error=True ))
+
+        def build_stored():
+            if not h5py.is_hdf5(self.filename):
+                return build()
+            scores = read_band_scores(self.filename, **params)
+            if scores is None:
+                scores = build()
+                write_summary(self.filename, write_band_scores, scores, params)
+            return scores
+
+        # the stamp identifies the bands by the wavenumbers, which must describe the bands of the image cube
+        if self.use_cache and (self.filename is not None) and \
+                (len(self.waves) == self.data_map.imageCube.shape[-1]):
+            params = {'band': band, 'n_pixels': self.n_pixels, **data_stamp(self.filename, self.waves)}
+            scores = band_score_cache.get(band_score_key(self.filename, **params), build_stored)
+        else:
+            scores = build()
+        self.band_scores, self.band_score_error = scores[0], scores[1]
         self.bad_bands    = np.where( self.band_scores < self.band_limit )[0]
         self.decent_bands = np.where( self.band_scores >= self.band_limit)[0]
 
@@ -83,7 +266,7 @@ class data_prepper(object):
 if __name__ == "__main__":
     print(sys.argv)
     data,fmt = read_map.read_all_formats( sys.argv[1] )
-    ds = data_prepper(data)
+    ds = data_prepper(data, filename=sys.argv[1])
     ds.plot_bad_bands()
     #ds.plot_decent_bands()
     plt.plot(data.wavenumbers, ds.band_scores);
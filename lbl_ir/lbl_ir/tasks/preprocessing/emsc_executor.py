@@ -0,0 +1,281 @@
+"""
+Multi-process EMSC correction of whole maps and folders of maps.
+
+The spectra of a map are loaded once into shared memory (or an on-disk memmap for maps larger than the memory
+budget), split into chunks and corrected in a process pool. Every worker runs with a single BLAS thread, so
+n_workers processes don't oversubscribe the cores. Corrected chunks are written to the hdf5 file as soon as they
+complete, under <root>/data/emsc/<method>/.
+
+"""
+
+import os
+import glob
+import time
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import shared_memory
+import numpy as np
+import h5py
+
+from lbl_ir.tasks.preprocessing.EMSC import Konevskikh, kohler_basis, KOHLER_ALPHA, KOHLER_ZERO_ALPHA
+from lbl_ir.tasks.preprocessing.batched_EMSC import kohler_batch, kohler_zero_batch, bassan_batch
+
+METHODS = ['Kohler', 'Kohler_zero', 'Bassan', 'Konevskikh']
+BLAS_THREAD_VARS = ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS', 'VECLIB_MAXIMUM_THREADS',
+                    'NUMEXPR_NUM_THREADS']
+
+
+class shared_array(object):
+    """
+    Array in shared memory or in an on-disk memmap that worker processes attach to by name.
+
+    Arguments:
+    ----------
+    shape, dtype : array shape and dtype
+
+    memmap_dir   : directory of the memmap file, shared memory if None
+    """
+
+    def __init__(self, shape, dtype='float32', memmap_dir=None):
+        self.shape, self.dtype = tuple(shape), np.dtype(dtype).str
+        nbytes = max(int(np.prod(self.shape)) * np.dtype(dtype).itemsize, 1)
+        if memmap_dir is None:
+            self._shm = shared_memory.SharedMemory(create=True, size=nbytes)
+            self.name, self.path = self._shm.name, None
+        else:
+            fd, self.path = tempfile.mkstemp(suffix='.dat', dir=memmap_dir)
+            os.close(fd)
+            self._shm, self.name = None, None
+            np.memmap(self.path, dtype=self.dtype, mode='w+', shape=self.shape).flush()
+
+    def handle(self):
+        """Picklable description passed to the workers"""
+        return self.name, self.path, self.shape, self.dtype
+
+    @property
+    def array(self):
+        if self._shm is not None:
+            return np.ndarray(self.shape, dtype=self.dtype, buffer=self._shm.buf)
+        return np.memmap(self.path, dtype=self.dtype, mode='r+', shape=self.shape)
+
+    def release(self):
+        if self._shm is not None:
+            self._shm.close()
+            self._shm.unlink()
+        elif self.path is not None and os.path.isfile(self.path):
+            os.remove(self.path)
+
+
+def attach(handle):
+    """
+    :return: numpy view of a shared_array, and the shared memory object to keep alive while the view is used
+    """
+    name, path, shape, dtype = handle
+    if path is not None:
+        return np.memmap(path, dtype=dtype, mode='r+', shape=shape), None
+    shm = shared_memory.SharedMemory(name=name)
+    return np.ndarray(shape, dtype=dtype, buffer=shm.buf), shm
+
+
+def _pin_blas_threads(n_threads=1):
+    """Pool initializer: limit BLAS/OpenMP threads of the worker"""
+    for var in BLAS_THREAD_VARS:
+        os.environ[var] = str(n_threads)
+    try:
+        from threadpoolctl import threadpool_limits
+        threadpool_limits(n_threads)
+    except ImportError:
+        pass
+
+
+def _correct_chunk(method, i0, i1, src, dst, base, wavenumbers, reference, kwargs):
+    """
+    Worker: correct spectra i0:i1 of the shared input and store them in the shared output
+    """
+    t0 = time.perf_counter()
+    A, shm_src = attach(src)
+    Z, shm_dst = attach(dst)
+    App = np.asarray(A[i0:i1])
+    if method == 'Kohler':
+        Z[i0:i1] = kohler_batch(wavenumbers, App, reference, **kwargs)
+    elif method == 'Kohler_zero':
+        B, shm_base = attach(base)
+        Z[i0:i1], B[i0:i1] = kohler_zero_batch(wavenumbers, App, **kwargs)
+        del B
+        if shm_base is not None:
+            shm_base.close()
+    elif method == 'Bassan':
+        Z[i0:i1] = bassan_batch(wavenumbers, App, reference, **kwargs)[0]
+    elif method == 'Konevskikh':
+        for k, a in enumerate(App):
+            Z[i0 + k] = Konevskikh(wavenumbers, a, reference, **kwargs)
+    del A, Z
+    for shm in (shm_src, shm_dst):
+        if shm is not None:
+            shm.close()
+    return i0, i1, time.perf_counter() - t0
+
+
+def output_wavenumbers(method, wavenumbers):
+    """Wavenumber order of the corrected spectra: Kohler_zero returns sorted, the others reverse sorted order"""
+    wn = np.sort(wavenumbers)
+    return wn if method == 'Kohler_zero' else wn[::-1]
+
+
+def run_emsc(filename, method='Kohler_zero', out_file=None, reference=None, n_workers=None, chunk_size=2000,
+             memory_limit=2 * 2 ** 30, memmap_dir=None, **kwargs):
+    """
+    Correct all spectra of a map hdf5 file in a process pool.
+
+    :param filename: map hdf5 file
+    :param method: one of METHODS
+    :param out_file: hdf5 file the results are written to, the map file itself if None
+    :param reference: reference spectrum for Kohler, Bassan and Konevskikh, the mean spectrum of the map if None
+    :param n_workers: number of worker processes, the number of cores if None
+    :param chunk_size: number of spectra per task
+    :param memory_limit: maps whose input and output exceed this many bytes use memmaps instead of shared memory
+    :param memmap_dir: directory of the memmaps of large maps, the directory of out_file if None
+    :param kwargs: passed to the correction, e.g. w_regions for Kohler_zero or iterations for Bassan
+    :return: dict of stage timings (s) and throughputs (spectra/s)
+    """
+    if method not in METHODS:
+        raise ValueError(f'method must be one of {METHODS}')
+    if (method == 'Kohler_zero') and ('w_regions' not in kwargs):
+        raise ValueError('Kohler_zero needs w_regions')
+    out_file = filename if out_file is None else out_file
+    n_workers = os.cpu_count() if n_workers is None else n_workers
+    report = {'method': method}
+
+    # load spectra into shared memory
+    t0 = time.perf_counter()
+    with h5py.File(filename, 'r') as f:
+        root = list(f.keys())[0]
+        dset = f[root + '/data/spectra']
+        N_obs, N_w = dset.shape
+        wavenumbers = f[root + '/data/wavenumbers'][:]
+        n_out = 2 if method == 'Kohler_zero' else 1
+        if (1 + n_out) * N_obs * N_w * 4 <= memory_limit:
+            memmap_dir = None
+        elif memmap_dir is None:
+            memmap_dir = os.path.dirname(os.path.abspath(out_file))
+        src = shared_array((N_obs, N_w), memmap_dir=memmap_dir)
+        A = src.array
+        mean = np.zeros(N_w)
+        for i0 in range(0, N_obs, chunk_size):
+            i1 = min(i0 + chunk_size, N_obs)
+            A[i0:i1] = dset[i0:i1]
+            mean += A[i0:i1].sum(axis=0, dtype='float64')
+        del A
+    if reference is None:
+        reference = mean / max(N_obs, 1)
+    report['load'] = time.perf_counter() - t0
+
+    dst = shared_array((N_obs, N_w), memmap_dir=memmap_dir)
+    base = shared_array((N_obs, N_w), memmap_dir=memmap_dir) if method == 'Kohler_zero' else None
+    try:
+        # the Kohler bases are computed once and sent to the workers
+        t0 = time.perf_counter()
+        if method in ['Kohler', 'Kohler_zero']:
+            alpha = KOHLER_ALPHA if method == 'Kohler' else KOHLER_ZERO_ALPHA
+            kwargs['basis'] = np.array(kohler_basis(np.sort(wavenumbers), alpha, kwargs.get('n_components', 8)))
+        report['basis'] = time.perf_counter() - t0
+
+        # output datasets
+        with h5py.File(out_file, 'a') as f:
+            root = list(f.keys())[0] if len(f.keys()) else os.path.splitext(os.path.basename(filename))[0]
+            group_name = root + '/data/emsc/' + method
+            if group_name in f:
+                del f[group_name]
+            group = f.create_group(group_name)
+            group.create_dataset('wavenumbers', data=output_wavenumbers(method, wavenumbers))
+            group.create_dataset('reference', data=np.asarray(reference)[np.argsort(wavenumbers)])
+            out_sets = [group.create_dataset('spectra', (N_obs, N_w), dtype='float32',
+                                             chunks=(min(chunk_size, N_obs), N_w))]
+            if base is not None:
+                out_sets.append(group.create_dataset('baseline', (N_obs, N_w), dtype='float32',
+                                                     chunks=(min(chunk_size, N_obs), N_w)))
+            outputs = [dst] if base is None else [dst, base]
+
+            # correct chunks in the pool, write every chunk when it completes
+            t0 = time.perf_counter()
+            t_write, t_workers = 0.0, 0.0
+            saved = {var: os.environ.get(var) for var in BLAS_THREAD_VARS}
+            for var in BLAS_THREAD_VARS:  # inherited by the workers before numpy is loaded
+                os.environ[var] = '1'
+            try:
+                with ProcessPoolExecutor(max_workers=n_workers, initializer=_pin_blas_threads) as executor:
+                    futures = [executor.submit(_correct_chunk, method, i0, min(i0 + chunk_size, N_obs),
+                                               src.handle(), dst.handle(),
+                                               None if base is None else base.handle(),
+                                               wavenumbers, reference, kwargs)
+                               for i0 in range(0, N_obs, chunk_size)]
+                    for future in as_completed(futures):
+                        i0, i1, t = future.result()
+                        t_workers += t
+                        tw = time.perf_counter()
+                        for dset, out in zip(out_sets, outputs):
+                            dset[i0:i1] = out.array[i0:i1]
+                        t_write += time.perf_counter() - tw
+            finally:
+                for var, val in saved.items():
+                    if val is None:
+                        os.environ.pop(var, None)
+                    else:
+                        os.environ[var] = val
+            report['correct'] = time.perf_counter() - t0 - t_write
+            report['correct_cpu'] = t_workers
+            report['write'] = t_write
+    finally:
+        for array in (src, dst, base):
+            if array is not None:
+                array.release()
+
+    report['n_spectra'] = N_obs
+    report['n_workers'] = n_workers
+    for stage in ['load', 'basis', 'correct', 'write']:
+        report[stage + '_throughput'] = N_obs / max(report[stage], 1e-9)
+    report['total'] = report['load'] + report['basis'] + report['correct'] + report['write']
+    report['throughput'] = N_obs / max(report['total'], 1e-9)
+    return report
+
+
+def run_emsc_folder(folder, pattern='*.h5', **kwargs):
+    """
+    Correct all maps of a folder one after another, each with a process pool.
+
+    :param folder: folder of map hdf5 files
+    :param pattern: filename pattern
+    :param kwargs: passed to run_emsc
+    :return: dict of reports by filename
+    """
+    reports = {}
+    for filename in sorted(glob.glob(os.path.join(folder, pattern))):
+        reports[filename] = run_emsc(filename, **kwargs)
+    return reports
+
+
+def print_report(report):
+    print(f"{report['method']}: {report['n_spectra']} spectra, {report['n_workers']} workers, "
+          f"{report['throughput']:.0f} spectra/s overall")
+    for stage in ['load', 'basis', 'correct', 'write']:
+        print(f"  {stage:8s} {report[stage]:8.2f} s {report[stage + '_throughput']:12.0f} spectra/s")
+
+
+if __name__ == "__main__":
+    from lbl_ir.tasks.preprocessing.batched_EMSC import simulate_map
+
+    wavenumbers = np.linspace(4000, 650, 1738)
+    spectra, m0 = simulate_map(wavenumbers, 20000)
+    with h5py.File('tst_emsc.h5', 'w') as f:
+        f.create_dataset('tst/data/spectra', data=spectra)
+        f.create_dataset('tst/data/wavenumbers', data=wavenumbers)
+    w_regions = [(650, 750), (1780, 2680), (3680, 4000)]
+
+    report = run_emsc('tst_emsc.h5', 'Kohler_zero', w_regions=w_regions, n_workers=4)
+    print_report(report)
+    with h5py.File('tst_emsc.h5', 'r') as f:
+        Z = f['tst/data/emsc/Kohler_zero/spectra'][:100]
+    assert np.allclose(Z, kohler_zero_batch(wavenumbers, spectra[:100], w_regions)[0], atol=1e-4)
+
+    print_report(run_emsc('tst_emsc.h5', 'Kohler', reference=m0, n_workers=4, memory_limit=0))
+    os.remove('tst_emsc.h5')
@@ -0,0 +1,215 @@
+"""
+Normalization of spectra, in place and chunk by chunk.
+
+Methods, applied to every spectrum (row) on its own:
+
+* 'l1', 'l2'  : divide by the vector norm
+* 'max'       : divide by the largest absolute value
+* 'snv'       : standard normal variate, subtract the mean and divide by the standard deviation
+* 'minmax'    : scale to [0, 1]
+* 'area'      : divide by the area under a band (or the whole spectrum), trapezoidal rule over the wavenumbers
+* 'msc'       : multiplicative scatter correction, regress the spectrum on a reference spectrum, a + b * ref,
+                and return (spectrum - a) / b. The reference defaults to the mean spectrum, accumulated in a
+                streaming pass.
+* 'none'      : no normalization
+
+Spectra are normalized in blocks of rows, in place or into an output array or hdf5 dataset, so a map is never
+copied in full.
+
+"""
+
+import numpy as np
+
+from lbl_ir.math_tools.streaming_stats import stream_stats
+
+METHODS = ['l1', 'l2', 'max', 'snv', 'minmax', 'area', 'msc', 'none']
+
+
+def trapezoid_weights(wavenumbers):
+    """
+    Weights w of the trapezoidal rule, area = spectrum @ w, positive for either wavenumber order
+    """
+    dx = np.abs(np.diff(np.asarray(wavenumbers, dtype='float64')))
+    w = np.zeros(len(dx) + 1)
+    w[:-1] += dx / 2
+    w[1:] += dx / 2
+    return w
+
+
+def _divide(block, scale):
+    block /= np.where(scale == 0, 1, scale)
+    return block
+
+
+def normalize_block(block, method='l2', area_weights=None, reference=None):
+    """
+    Normalize a block of spectra in place.
+
+    :param block: (n, N_w) float array
+    :param method: one of METHODS
+    :param area_weights: (N_w,) weights of 'area', zero outside of the band, see normalizer
+    :param reference: (N_w,) reference spectrum of 'msc'
+    :return: block
+    """
+    if method == 'l1':
+        return _divide(block, np.abs(block).sum(axis=1, keepdims=True))
+    elif method == 'l2':
+        return _divide(block, np.sqrt(np.einsum('ij,ij->i', block, block))[:, None])
+    elif method == 'max':
+        return _divide(block, np.abs(block).max(axis=1, keepdims=True))
+    elif method == 'snv':
+        block -= block.mean(axis=1, keepdims=True)
+        return _divide(block, block.std(axis=1, keepdims=True))
+    elif method == 'minmax':
+        low = block.min(axis=1, keepdims=True)
+        block -= low
+        return _divide(block, block.max(axis=1, keepdims=True))
+    elif method == 'area':
+        return _divide(block, np.abs(block @ area_weights.astype(block.dtype))[:, None])
+    elif method == 'msc':
+        ref = np.asarray(reference, dtype='float64')
+        ref_c = ref - ref.mean()
+        mean = block.mean(axis=1, keepdims=True)
+        b = ((block @ ref_c.astype(block.dtype)) / (ref_c @ ref_c))[:, None]
+        a = mean - b * ref.mean()
+        block -= a
+        return _divide(block, b)
+    elif method == 'none':
+        return block
+    raise ValueError(f'method must be one of {METHODS}')
+
+
+class normalizer(object):
+    """
+    Chunked normalization of the spectra of a map.
+
+    Arguments:
+    ----------
+    method      : one of METHODS
+
+    wavenumbers : wavenumber array, needed by 'area'
+
+    band        : (low, high) wavenumbers of the 'area' band, the whole spectrum if None
+
+    reference   : reference spectrum of 'msc', the mean spectrum of the data passed to fit() if None
+
+    chunk_size  : number of spectra per block
+
+    Examples:
+    ---------
+    normalizer('snv').transform(data, out=data)              # in place
+    normalizer('msc').fit(h5_dataset).transform(h5_dataset, out=h5_dataset)
+    """
+
+    def __init__(self, method='l2', wavenumbers=None, band=None, reference=None, chunk_size=4096):
+        if method not in METHODS:
+            raise ValueError(f'method must be one of {METHODS}')
+        self.method = method
+        self.reference = None if reference is None else np.asarray(reference, dtype='float64')
+        self.chunk_size = chunk_size
+        self.area_weights = None
+        if method == 'area':
+            if wavenumbers is None:
+                raise ValueError("'area' normalization needs the wavenumbers")
+            self.area_weights = trapezoid_weights(wavenumbers)
+            if band is not None:
+                low, high = min(band), max(band)
+                self.area_weights[(wavenumbers < low) | (wavenumbers > high)] = 0
+                # trapezoid weights of the band alone
+                inside = np.where(self.area_weights > 0)[0]
+                self.area_weights[inside] = trapezoid_weights(np.asarray(wavenumbers)[inside])
+
+    def fit(self, data):
+        """
+        Accumulate the mean spectrum of data as the 'msc' reference, in a streaming pass
+        :param data: (N_obs, N_w) array or dataset
+        :return: self
+        """
+        if self.method == 'msc':
+            self.reference = stream_stats(data, covariance=False, chunk_size=self.chunk_size).mean
+        return self
+
+    def __call__(self, block):
+        """Normalize a block of spectra in place"""
+        if (self.method == 'msc') and (self.reference is None):
+            raise ValueError("'msc' normalization needs a reference, call fit() first")
+        return normalize_block(block, self.method, self.area_weights, self.reference)
+
+    def transform(self, data, out=None, dtype='float32'):
+        """
+        Normalize all spectra, a block at a time.
+
+        :param data: (N_obs, N_w) array or row sliceable dataset
+        :param out: output array or dataset, pass data itself to normalize in place. A new array if None.
+        :param dtype: block working precision and dtype of a new output
+        :return: out
+        """
+        if (self.method == 'msc') and (self.reference is None):
+            self.fit(data)
+        if out is None:
+            out = np.empty(data.shape, dtype=dtype)
+        for i0 in range(0, len(data), self.chunk_size):
+            i1 = min(i0 + self.chunk_size, len(data))
+            out[i0:i1] = self(np.array(data[i0:i1], dtype=dtype))
+        return out
+
+
+def normalize(data, method='l2', out=None, dtype='float32', **kwargs):
+    """
+    Normalize all spectra of data, see normalizer
+    """
+    return normalizer(method, **kwargs).transform(data, out=out, dtype=dtype)
+
+
+def mean_center(data, mask=None, chunk_size=4096):
+    """
+    Subtract the mean spectrum from every spectrum of an array, in place
+    :param mask: spectra the mean is taken over, e.g. those without quality flags; all spectra if None
+    :return: mean spectrum
+    """
+    mean = stream_stats(data, mask=mask, covariance=False, chunk_size=chunk_size).mean
+    for i0 in range(0, len(data), chunk_size):
+        data[i0:i0 + chunk_size] -= mean.astype(data.dtype)
+    return mean
+
+
+if __name__ == "__main__":
+    import time
+    from sklearn.preprocessing import Normalizer, StandardScaler
+
+    np.random.seed(0)
+    wavenumbers = np.linspace(4000, 650, 1738)
+    data = np.random.random((20000, len(wavenumbers))).astype('float32')
+
+    for method in ['l1', 'l2']:
+        ref = StandardScaler(with_std=False).fit_transform(Normalizer(norm=method).fit_transform(data))
+        out = normalize(data, method)
+        mean_center(out)
+        assert np.allclose(out, ref, atol=1e-6)
+
+    good = np.arange(len(data)) % 7 != 0
+    out = data[:1000].copy()
+    assert np.allclose(mean_center(out, mask=good[:1000]), data[:1000][good[:1000]].mean(axis=0), atol=1e-6)
+
+    out = normalize(data[:100], 'snv')
+    assert np.allclose(out.mean(axis=1), 0, atol=1e-6) and np.allclose(out.std(axis=1), 1, atol=1e-4)
+    out = normalize(data[:100], 'minmax')
+    assert np.allclose(out.min(axis=1), 0) and np.allclose(out.max(axis=1), 1)
+    out = normalize(data[:100], 'area', wavenumbers=wavenumbers, band=(1500, 1700))
+    sel = (wavenumbers >= 1500) & (wavenumbers <= 1700)
+    assert np.allclose(np.abs(np.trapezoid(out[:, sel], wavenumbers[sel], axis=1)), 1, atol=1e-5)
+    # msc removes an offset and a scale relative to the reference
+    base = data[0].astype('float64')
+    scattered = 0.3 + 2.5 * base[None, :] * np.ones((5, 1))
+    assert np.allclose(normalize(scattered, 'msc', reference=base, dtype='float64'), base)
+
+    copy = data.copy()
+    t0 = time.perf_counter()
+    ref = StandardScaler(with_std=False).fit_transform(Normalizer(norm='l2').fit_transform(data))
+    t_sklearn = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    normalize(copy, 'l2', out=copy)
+    mean_center(copy)
+    t_inplace = time.perf_counter() - t0
+    print(f'l2 + mean centering of {len(data)} spectra: sklearn {t_sklearn:.2f} s, in place {t_inplace:.2f} s')
+    print('OK')
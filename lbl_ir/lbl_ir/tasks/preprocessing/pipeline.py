@@ -0,0 +1,403 @@
+"""
+Declarative preprocessing pipelines.
+
+A pipeline is a list of steps, e.g. absorbance -> anchor_baseline -> derivative -> normalize. Each chunk of
+spectra is read once, all steps are applied to it in sequence while it is cache resident, and the result is
+written once into a single output array or hdf5 dataset. Steps that change the wavenumber axis (trimming to the
+anchor range, band masks, the sorted axis of Kohler EMSC) are resolved once in setup().
+
+Pipelines are written to and read from the basic_parser config format, one section per step:
+
+    [step_0]
+    name='absorbance'
+    scale=100.0
+
+    [step_1]
+    name='anchor_baseline'
+    anchors='650, 1800, 4000'
+
+"""
+
+import time
+import tracemalloc
+import numpy as np
+
+from lbl_ir.io_tools.basic_parser import read_and_parse
+from lbl_ir.math_tools.absorbance import t_to_a
+from lbl_ir.math_tools.derivative import savgol
+from lbl_ir.math_tools.streaming_stats import running_stats
+from lbl_ir.tasks.baseline.anchor_points import parse_anchors, anchor_baseline as anchor_interpolation
+from lbl_ir.tasks.baseline.rubberband import rubberband_batch
+from lbl_ir.tasks.preprocessing.batched_EMSC import region_indexes, linear_emsc
+from lbl_ir.tasks.preprocessing.batch_engine import nth_order_gradient
+from lbl_ir.tasks.preprocessing.EMSC import kohler_basis, KOHLER_ZERO_ALPHA
+from lbl_ir.tasks.preprocessing.normalize import normalizer
+from lbl_ir.tasks.preprocessing.atmospheric import atmospheric_compensation, ATMOSPHERIC_REGIONS
+
+
+class step(object):
+    """
+    Base class of pipeline steps. The constructor keyword arguments are the step parameters.
+    """
+    name = None
+
+    def __init__(self, **params):
+        self.params = params
+
+    def setup(self, wavenumbers):
+        """
+        Prepare the step for a wavenumber axis
+        :return: wavenumbers of the step output
+        """
+        return wavenumbers
+
+    def needs_fit(self):
+        """
+        :return: True if the step needs statistics of its whole input, collected with fit_block before the run
+        """
+        return False
+
+    def fit_block(self, block):
+        """Accumulate statistics of a block of the step input"""
+        pass
+
+    def __call__(self, block):
+        """
+        :param block: (n, N_w) float64 spectra, may be modified in place
+        :return: processed block
+        """
+        raise NotImplementedError
+
+
+class absorbance(step):
+    """Transmission to absorbance, see math_tools.absorbance.t_to_a"""
+    name = 'absorbance'
+
+    def __init__(self, scale=100.0, eps=1e-10, base=10):
+        super(absorbance, self).__init__(scale=scale, eps=eps, base=base)
+
+    def __call__(self, block):
+        return t_to_a(block, self.params['scale'], self.params['eps'], base=self.params['base'], out=block)
+
+
+class anchor_baseline(step):
+    """Subtract an anchor point baseline, the output covers the anchor range"""
+    name = 'anchor_baseline'
+
+    def __init__(self, anchors='400, 4000', kind='linear', window=0):
+        super(anchor_baseline, self).__init__(anchors=anchors, kind=kind, window=window)
+
+    def setup(self, wavenumbers):
+        self.baseline = anchor_interpolation(wavenumbers, parse_anchors(self.params['anchors'], wavenumbers),
+                                             self.params['kind'], self.params['window'])
+        return self.baseline.energy
+
+    def __call__(self, block):
+        return block[:, self.baseline.trim] - self.baseline(block)
+
+
+class hull_baseline(step):
+    """Subtract the rubberband (lower convex hull) baseline"""
+    name = 'hull_baseline'
+
+    def setup(self, wavenumbers):
+        self.wavenumbers = wavenumbers
+        return wavenumbers
+
+    def __call__(self, block):
+        block -= rubberband_batch(self.wavenumbers, block)
+        return block
+
+
+class kohler(step):
+    """Kohler EMSC with a zero reference, the output is in sorted wavenumber order like EMSC.Kohler_zero"""
+    name = 'kohler'
+
+    def __init__(self, w_regions=((650, 750), (1780, 2680), (3680, 4000)), n_components=8):
+        super(kohler, self).__init__(w_regions=w_regions, n_components=n_components)
+
+    def setup(self, wavenumbers):
+        self.order = np.argsort(wavenumbers)
+        wn = np.asarray(wavenumbers, dtype='float64')[self.order]
+        self.p_i = kohler_basis(wn, KOHLER_ZERO_ALPHA, self.params['n_components'])
+        self.solver = linear_emsc(np.column_stack([np.ones(len(wn)), self.p_i.T]),
+                                  rows=region_indexes(wn, self.params['w_regions']))
+        return wn
+
+    def __call__(self, block):
+        block = block[:, self.order]
+        x = self.solver.fit(block)
+        block -= x[:, 0:1] + x[:, 1:] @ self.p_i
+        return block
+
+
+class derivative(step):
+    """
+    nth order derivative along the wavenumber axis, with np.gradient ('gradient') or a Savitzky-Golay filter
+    ('savgol'), which also smooths with order 0
+    """
+    name = 'derivative'
+
+    def __init__(self, order=2, method='gradient', window=11, polyorder=3):
+        super(derivative, self).__init__(order=order, method=method, window=window, polyorder=polyorder)
+
+    def setup(self, wavenumbers):
+        self.dx = wavenumbers[1] - wavenumbers[0]
+        if self.params['method'] == 'savgol':
+            self.sg = savgol(wavenumbers, self.params['window'], self.params['polyorder'], self.params['order'])
+        return wavenumbers
+
+    def __call__(self, block):
+        if self.params['method'] == 'savgol':
+            return self.sg(block)
+        return nth_order_gradient(self.dx, block, n=self.params['order'])
+
+
+class normalize(step):
+    """
+    Normalize every spectrum, norm one of normalize.METHODS: 'l1', 'l2', 'max', 'snv', 'minmax', 'area' (under
+    band, or the whole spectrum) or 'msc'. The 'msc' reference defaults to the mean spectrum of the step input,
+    accumulated in a pass over the data before the run.
+    """
+    name = 'normalize'
+
+    def __init__(self, norm='l2', band=None, reference=None):
+        super(normalize, self).__init__(norm=norm, band=band, reference=reference)
+
+    def setup(self, wavenumbers):
+        self.norm = normalizer(self.params['norm'], wavenumbers, self.params['band'], self.params['reference'])
+        self.stats = running_stats(len(wavenumbers), covariance=False)
+        return wavenumbers
+
+    def needs_fit(self):
+        return (self.params['norm'] == 'msc') and (self.params['reference'] is None)
+
+    def fit_block(self, block):
+        self.norm.reference = self.stats.update(block).mean
+
+    def __call__(self, block):
+        return self.norm(block)
+
+
+class atmospheric(step):
+    """
+    Water vapour and CO2 compensation, see atmospheric.atmospheric_compensation. references is the filename of an
+    .npz file with the reference spectra and their wavenumbers, or a list of spectra on the step input axis.
+    """
+    name = 'atmospheric'
+
+    def __init__(self, references, regions=ATMOSPHERIC_REGIONS, highpass=25.0):
+        super(atmospheric, self).__init__(references=references, regions=regions, highpass=highpass)
+
+    def setup(self, wavenumbers):
+        self.comp = atmospheric_compensation(wavenumbers, self.params['references'], self.params['regions'],
+                                             self.params['highpass'])
+        return wavenumbers
+
+    def __call__(self, block):
+        return self.comp(block)
+
+
+class band_mask(step):
+    """
+    Keep a selection of bands: wavenumber regions, a list of (low, high) pairs, and/or band indexes, e.g. the
+    decent_bands of a data_prepper
+    """
+    name = 'band_mask'
+
+    def __init__(self, regions=None, indexes=None):
+        super(band_mask, self).__init__(regions=regions, indexes=indexes)
+
+    def setup(self, wavenumbers):
+        keep = np.ones(len(wavenumbers), dtype=bool)
+        if self.params['regions'] is not None:
+            keep[:] = False
+            keep[region_indexes(wavenumbers, self.params['regions'])] = True
+        if self.params['indexes'] is not None:
+            selected = np.zeros(len(wavenumbers), dtype=bool)
+            selected[np.asarray(self.params['indexes'], dtype=int)] = True
+            keep &= selected
+        self.keep = np.where(keep)[0]
+        return wavenumbers[self.keep]
+
+    def __call__(self, block):
+        return block[:, self.keep]
+
+
+STEPS = {cls.name: cls for cls in [absorbance, atmospheric, anchor_baseline, hull_baseline, kohler, derivative,
+                                   normalize, band_mask]}
+
+
+class pipeline(object):
+    """
+    A sequence of preprocessing steps applied chunk by chunk.
+
+    Arguments:
+    ----------
+    steps      : list of step objects or of (name, params dict) pairs, names as in STEPS
+
+    chunk_size : number of spectra per block; blocks of a few MB stay cache resident through all steps
+
+    Attributes:
+    -----------
+    report     : timings (s) and peak memory (bytes) of the last run, per step and for reading and writing
+
+    Examples:
+    ---------
+    p = pipeline([('absorbance', {}), ('anchor_baseline', {'anchors': '650, 4000'}), ('derivative', {})])
+    energy, out = p.run(wavenumbers, spectra)
+    """
+
+    def __init__(self, steps, chunk_size=256):
+        self.steps = [STEPS[s[0]](**s[1]) if isinstance(s, (tuple, list)) else s for s in steps]
+        self.chunk_size = chunk_size
+        self.report = None
+
+    @classmethod
+    def from_config(cls, txt, chunk_size=256):
+        """
+        :param txt: pipeline in the basic_parser config format, see as_config
+        """
+        config = read_and_parse(txt)
+        steps = []
+        for section in config.__dict__.values():
+            params = dict(section.__dict__)
+            steps.append((params.pop('name'), params))
+        return cls(steps, chunk_size)
+
+    def as_config(self):
+        """
+        :return: the pipeline in the basic_parser config format
+        """
+        txt = ''
+        for i, s in enumerate(self.steps):
+            txt += '[step_%d]\nname=%r\n' % (i, s.name)
+            for key in sorted(s.params):
+                # repr, so that strings such as anchor lists are read back as strings by literal_eval
+                txt += '%s=%r\n' % (key, s.params[key])
+            txt += '\n'
+        return txt
+
+    def setup(self, wavenumbers):
+        """
+        :return: wavenumbers of the pipeline output
+        """
+        wavenumbers = np.asarray(wavenumbers, dtype='float64')
+        for s in self.steps:
+            wavenumbers = s.setup(wavenumbers)
+        return wavenumbers
+
+    def run(self, wavenumbers, data, out=None, profile=False):
+        """
+        Apply all steps to all spectra.
+
+        :param wavenumbers: wavenumber array
+        :param data: (N_obs, N_w) spectra, array or row sliceable dataset
+        :param out: (N_obs, N_out) output array or hdf5 dataset, a new float32 array if None
+        :param profile: also record the peak memory of every step with tracemalloc, which slows the run down
+        :return: output wavenumbers, output
+        """
+        energy = self.setup(wavenumbers)
+        N_obs = len(data)
+        if out is None:
+            out = np.empty((N_obs, len(energy)), dtype='float32')
+        names = ['read'] + ['%d_%s' % (i, s.name) for i, s in enumerate(self.steps)] + ['write']
+        times = dict.fromkeys(names, 0.0)
+        peaks = dict.fromkeys(names, 0)
+        if profile:
+            tracemalloc.start()
+
+        def stage(name, t0):
+            times[name] += time.perf_counter() - t0
+            if profile:
+                peaks[name] = max(peaks[name], tracemalloc.get_traced_memory()[1])
+                tracemalloc.reset_peak()
+            return time.perf_counter()
+
+        # steps with whole data statistics (the mean reference of msc) are fitted in a pass up to the last of them
+        n_fit = max([k + 1 for k, s in enumerate(self.steps) if s.needs_fit()], default=0)
+        for i0 in range(0, N_obs if n_fit else 0, self.chunk_size):
+            block = np.array(data[i0:min(i0 + self.chunk_size, N_obs)], dtype='float64')
+            for s in self.steps[:n_fit]:
+                if s.needs_fit():
+                    s.fit_block(block)
+                block = s(block)
+        try:
+            for i0 in range(0, N_obs, self.chunk_size):
+                i1 = min(i0 + self.chunk_size, N_obs)
+                t0 = time.perf_counter()
+                block = np.array(data[i0:i1], dtype='float64')
+                t0 = stage('read', t0)
+                for name, s in zip(names[1:-1], self.steps):
+                    block = s(block)
+                    t0 = stage(name, t0)
+                out[i0:i1] = block
+                stage('write', t0)
+        finally:
+            if profile:
+                tracemalloc.stop()
+        self.report = {'n_spectra': N_obs, 'time': times, 'peak_memory': peaks if profile else None}
+        return energy, out
+
+    def print_report(self):
+        total = sum(self.report['time'].values())
+        print(f"{self.report['n_spectra']} spectra in {total:.2f} s")
+        for name, t in self.report['time'].items():
+            line = f'  {name:20s} {t:8.3f} s'
+            if self.report['peak_memory'] is not None:
+                line += f"  peak {self.report['peak_memory'][name] / 2 ** 20:8.1f} MB"
+            print(line)
+
+
+if __name__ == "__main__":
+    from lbl_ir.tasks.preprocessing.EMSC import Kohler_zero
+    from lbl_ir.tasks.preprocessing.batched_EMSC import simulate_map
+    from lbl_ir.tasks.preprocessing.normalize import normalize_block
+    from lbl_ir.tasks.preprocessing.atmospheric import simulate_atmosphere
+    import os
+
+    wavenumbers = np.linspace(4000, 650, 1738)
+    spectra, m0 = simulate_map(wavenumbers, 20000)
+    T = 100 * 10 ** (-spectra)
+
+    p = pipeline([('absorbance', {}), ('anchor_baseline', {'anchors': '650, 1800, 2700, 4000'}),
+                  ('derivative', {'order': 2}), ('normalize', {'norm': 'l2'})])
+    energy, out = p.run(wavenumbers, T)
+    p.print_report()
+    # reference: one full array pass per step
+    A = -np.log10(T / 100)
+    idx = parse_anchors('650, 1800, 2700, 4000', wavenumbers)
+    base = anchor_interpolation(wavenumbers, idx)
+    ref = nth_order_gradient(energy[1] - energy[0], A[:, base.trim] - base(A), n=2)
+    ref /= np.linalg.norm(ref, axis=1, keepdims=True)
+    assert np.allclose(out, ref, atol=1e-5)
+
+    p = pipeline.from_config(p.as_config())
+    assert [s.name for s in p.steps] == ['absorbance', 'anchor_baseline', 'derivative', 'normalize']
+    assert p.steps[1].params['anchors'] == '650, 1800, 2700, 4000'
+
+    # msc against the mean spectrum of the absorbance, fitted in a streaming pass
+    energy, out = pipeline([('absorbance', {}), ('normalize', {'norm': 'msc'})]).run(wavenumbers, T[:1000])
+    ref = normalize_block(A[:1000].copy(), 'msc', reference=A[:1000].mean(axis=0))
+    assert np.allclose(out, ref, atol=1e-4)
+
+    # atmospheric compensation with references from a file, written to and read back from the config format
+    atm = simulate_atmosphere(wavenumbers)
+    np.savez('tst_pipeline_atm.npz', wavenumbers=wavenumbers, **atm)
+    p = pipeline.from_config(pipeline([('atmospheric', {'references': 'tst_pipeline_atm.npz'})]).as_config())
+    observed = spectra[:1000] + 0.03 * atm['water'] + 0.02 * atm['co2']
+    energy, out = p.run(wavenumbers, observed)
+    os.remove('tst_pipeline_atm.npz')
+    ref = observed.astype('float64')
+    atmospheric_compensation(wavenumbers, atm).correct(observed, out=ref)
+    assert np.allclose(out, ref, atol=1e-5)
+
+    p = pipeline([('kohler', {'w_regions': [(650, 750), (1780, 2680), (3680, 4000)]}),
+                  ('band_mask', {'regions': [(900, 1800), (2800, 3050)]})])
+    energy, out = p.run(wavenumbers, spectra[:2000], profile=True)
+    p.print_report()
+    p = pipeline.from_config(p.as_config())
+    Z, _ = Kohler_zero(wavenumbers, spectra[5], [(650, 750), (1780, 2680), (3680, 4000)])
+    p.setup(wavenumbers)
+    assert np.allclose(out[5], Z[p.steps[1].keep], atol=1e-3)
+    print('OK')
@@ -1,4 +1,5 @@
 from functools import partial
+import threading
 from qtpy.QtCore import *
 from qtpy.QtGui import *
 from xicam.core import msg
@@ -10,6 +11,7 @@ from xicam.BSISB.widgets.spectraplotwidget import SpectraPlotWidget
 from xicam.BSISB.widgets.factorizationwidget import FactorizationWidget
 from xicam.BSISB.widgets.preprocesswidget import PreprocessWidget
 from xicam.BSISB.widgets.clusteringwidget import ClusteringWidget
+from xicam.BSISB.formats.mapfile import MapFilePlugin
 from xicam.plugins import GUIPlugin, GUILayout
 from xicam.gui.widgets.tabview import TabView
 
@@ -19,6 +21,10 @@ class BSISBTabview(TabView):
         super(BSISBTabview, self).__init__(*args, **kwargs)
 
     def closeTab(self, i):
+        # closing a map of a multi-file open stops loading the rest of its files
+        cancel = getattr(self.catalogmodel.item(i), 'ingestCancel', None)
+        if cancel is not None:
+            cancel.set()
         newindex = self.currentIndex()
         if (i <= self.currentIndex()) and (newindex > 0):
             newindex -= 1
@@ -29,6 +35,23 @@ class BSISBTabview(TabView):
         self.selectionmodel.setCurrentIndex(self.catalogmodel.index(newindex, 0), QItemSelectionModel.Rows
                                             | QItemSelectionModel.ClearAndSelect)
 
+class HeaderLoader(QObject):
+    """
+    Hands the headers of map files ingested on worker threads to the GUI thread
+    """
+    sigHeader = Signal(object, object)
+
+    def load(self, paths):
+        """
+        Ingest map files concurrently, sigHeader(header, cancel) is emitted for every file as soon as it is read
+        :param paths: map file paths
+        :return: cancel event, set it to skip the files that are not read yet
+        """
+        cancel = threading.Event()
+        return MapFilePlugin.ingestAsync(paths, lambda doc: self.sigHeader.emit(NonDBHeader(**doc), cancel),
+                                         cancel=cancel)
+
+
 class BSISB(GUIPlugin):
     name = 'BSISB'
 
@@ -40,6 +63,9 @@ class BSISB(GUIPlugin):
 
         # Selection model
         self.selectionmodel = QItemSelectionModel(self.headermodel)
+        # the other files of a multi-file open are read in the background and appended as they come in
+        self.headerLoader = HeaderLoader()
+        self.headerLoader.sigHeader.connect(lambda header, cancel: self.appendHeader(header, ingestCancel=cancel))
         self.preprocess = PreprocessWidget(self.headermodel, self.selectionmodel)
         self.FA_widget = FactorizationWidget(self.headermodel, self.selectionmodel)
         self.clusterwidget = ClusteringWidget(self.headermodel, self.selectionmodel)
@@ -66,6 +92,10 @@ class BSISB(GUIPlugin):
         item = QStandardItem(fileName + '_' + str(self.headermodel.rowCount()))
         item.header = header
         item.selectedPixels = None
+        item.ingestCancel = kwargs.get('ingestCancel')
+        pending = header.startdoc.get('pending_paths', [])
+        if pending:
+            item.ingestCancel = self.headerLoader.load(pending)
 
         self.headermodel.appendRow(item)
         self.headermodel.dataChanged.emit(QModelIndex(), QModelIndex())
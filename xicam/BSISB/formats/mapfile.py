@@ -1,12 +1,39 @@
 from xicam.plugins.datahandlerplugin import DataHandlerPlugin, start_doc, descriptor_doc, embedded_local_event_doc
+from xicam.core import msg
 import functools
 from lbl_ir.data_objects.ir_map import ir_map
+import os
 import uuid
 import h5py
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from functools import lru_cache
 import numpy as np
 import time
 
+
+@lru_cache(maxsize=32)
+def _readMetadata(path, mtime):
+    """
+    Read the metadata shared by all events of a map file, the file is opened only once
+    :param path: hdf5 file path
+    :param mtime: file modification time, a changed file invalidates the cached entry
+    :return: metadata dict
+    """
+    with h5py.File(path, 'r') as f:
+        root_name = list(f.keys())[0] + '/'
+        n_bands = f[root_name + 'data/image/image_cube'].shape[2]
+        n_spectra = f[root_name + 'data/spectra'].shape[0]
+        wavenumbers = f[root_name + 'data/wavenumbers'][:]
+        ind_rc_map = f[root_name + 'data/image/ind_rc_map'][:, :]
+        imgShape = f[root_name + 'data/image/image_mask'].shape[:2]
+    ind2rc = {x[0]: tuple(x[1:]) for x in ind_rc_map}
+    rc2ind = {tuple(x[1:]): x[0] for x in ind_rc_map}
+    return {'n_bands': n_bands, 'n_spectra': n_spectra,
+            'metadata': {'path': path, 'wavenumbers': wavenumbers, 'rc_index': rc2ind, 'index_rc': ind2rc,
+                         'imgShape': imgShape}}
+
+
 class MapFilePlugin(DataHandlerPlugin):
     name = 'BSISB Map File'
 
@@ -14,14 +41,17 @@ class MapFilePlugin(DataHandlerPlugin):
 
     descriptor_keys = ['object_keys']
 
+    # max number of map files read concurrently by ingestAsync
+    max_workers = 4
+
     def __call__(self, *args, E=None, i=None):
         if E is None and i is not None:
             # return spectra
             return self.h5[self.root_name + 'data/spectra'][i,:]
 
         elif E is not None and i is None:
-            # return image or volume
-            return np.flipud(self.h5[self.root_name + 'data/image/image_cube'][:,:,E])
+            # return image or volume, in stored orientation (row 0 is drawn at the bottom by the viewers)
+            return self.h5[self.root_name + 'data/image/image_cube'][:,:,E]
         
         else:
             raise ValueError(f'Handler could not extract data given kwargs: { dict(E=E, i=i) }')
@@ -46,21 +76,16 @@ class MapFilePlugin(DataHandlerPlugin):
         uid = uuid.uuid4()
         return descriptor_doc(start_uid, uid, {})
 
+    @classmethod
+    def getMetadata(cls, path):
+        return _readMetadata(path, os.path.getmtime(path))
+
     @classmethod
     def getVolumeEvents(cls, path, descriptor_uid):
-        with h5py.File(path, 'r') as f:
-            root_name = list(f.keys())[0] + '/'
-            n = f[root_name + 'data/image/image_cube'].shape[2]
-            wavenumbers = f[root_name + 'data/wavenumbers'][:]
-            ind_rc_map = f[root_name + 'data/image/ind_rc_map'][:, :]
-            ind2rc = {x[0]: tuple(x[1:]) for x in ind_rc_map}
-            rc2ind = {tuple(x[1:]): x[0] for x in ind_rc_map}
-            imgMask = f[root_name + 'data/image/image_mask'][:, :]
-            imgShape = (imgMask.shape[0], imgMask.shape[1])
-
-        for i in range(n):
+        info = cls.getMetadata(path)
+        for i in range(info['n_bands']):
             yield embedded_local_event_doc(descriptor_uid, 'volume', cls, (path,), resource_kwargs={'E': i},
-                                       metadata = {'path': path, 'wavenumbers': wavenumbers, 'rc_index': rc2ind, 'index_rc': ind2rc, 'imgShape': imgShape})
+                                           metadata=info['metadata'])
 
     @classmethod
     def getImageDescriptor(cls, path, start_uid):
@@ -69,24 +94,11 @@ class MapFilePlugin(DataHandlerPlugin):
 
     @classmethod
     def getImageEvents(cls, path, descriptor_uid):
-        # get a h5 object
-        # find the imagecube
-        # get imagecube shape
-        # iterate over E dimension
-        with h5py.File(path, 'r') as f:
-            root_name = list(f.keys())[0] + '/'
-            # get number of frames
-            n = f[root_name + 'data/image/image_cube'].shape[2]
-            wavenumbers = f[root_name + 'data/wavenumbers'][:]
-            ind_rc_map = f[root_name + 'data/image/ind_rc_map'][:, :]
-            ind2rc = {x[0]: tuple(x[1:]) for x in ind_rc_map}
-            rc2ind = {tuple(x[1:]): x[0] for x in ind_rc_map}
-            imgMask = f[root_name + 'data/image/image_mask'][:, :]
-            imgShape = (imgMask.shape[0], imgMask.shape[1])
-            
-        for i in range(n):
+        # iterate over E dimension of the imagecube
+        info = cls.getMetadata(path)
+        for i in range(info['n_bands']):
             yield embedded_local_event_doc(descriptor_uid, 'image', cls, (path,), resource_kwargs={'E': i},
-                                           metadata={'path': path, 'wavenumbers': wavenumbers, 'rc_index': rc2ind, 'index_rc': ind2rc, 'imgShape': imgShape})
+                                           metadata=info['metadata'])
 
     @classmethod
     def getSpectraDescriptor(cls, path, start_uid):
@@ -95,30 +107,20 @@ class MapFilePlugin(DataHandlerPlugin):
 
     @classmethod
     def getSpectraEvents(cls, path, descriptor_uid):
-        # get a h5 object
-        # find the spectra data
-        # get spectra index
-        # iterate over rows
-        with h5py.File(path, 'r') as f:
-            root_name = list(f.keys())[0] + '/'
-            # get number of rows
-            n = f[root_name + 'data/spectra'].shape[0]
-            wavenumbers = f[root_name + 'data/wavenumbers'][:]
-            ind_rc_map = f[root_name + 'data/image/ind_rc_map'][:,:]
-            ind2rc = {x[0]: tuple(x[1:]) for x in ind_rc_map}
-            rc2ind = {tuple(x[1:]): x[0] for x in ind_rc_map}
-            mask = f[root_name + 'data/image/image_mask'][:, :]
-            imgShape = (mask.shape[0], mask.shape[1])
-
-        for i in range(n):
+        # iterate over rows of the spectra data
+        info = cls.getMetadata(path)
+        for i in range(info['n_spectra']):
             yield embedded_local_event_doc(descriptor_uid, 'spectra', cls, (path,), resource_kwargs={'i': i},
-                                           metadata={'path': path, 'wavenumbers':wavenumbers, 'rc_index': rc2ind, 'index_rc': ind2rc, 'imgShape':imgShape})
+                                           metadata=info['metadata'])
 
     @classmethod
     def ingest(cls, paths):
+        """
+        Ingest the first map file as one run. The widgets take imgShape, rc_index, wavenumbers and path of a run
+        from its first event, so every map is a run of its own; the other paths are listed in the start document
+        as 'pending_paths' and ingested concurrently with ingestAsync.
+        """
         paths = cls.reduce_paths(paths)
-
-        # TODO: handle multiple paths
         path = paths[0]
 
         start_uid = str(uuid.uuid4())
@@ -127,9 +129,85 @@ class MapFilePlugin(DataHandlerPlugin):
         image_descriptor = cls.getImageDescriptor(path, start_uid)
         spectra_descriptor = cls.getSpectraDescriptor(path, start_uid)
 
-        return {'start': cls._setTitle(cls.getStartDoc(paths, start_uid), paths),
+        start = cls._setTitle(cls.getStartDoc([path], start_uid), [path])
+        start['pending_paths'] = list(paths[1:])
+        # band images come first, spectra are resolved lazily by the handler
+        return {'start': start,
                 'descriptors': [volume_descriptor, image_descriptor, spectra_descriptor],
-                'events': list(cls.getVolumeEvents(path, volume_descriptor['uid'])) +
-                          list(cls.getImageEvents(path, image_descriptor['uid'])) +
+                'events': list(cls.getImageEvents(path, image_descriptor['uid'])) +
+                          list(cls.getVolumeEvents(path, volume_descriptor['uid'])) +
                           list(cls.getSpectraEvents(path, spectra_descriptor['uid'])),
-                'stop': cls.getStopDoc(paths, start_uid)}
+                'stop': cls.getStopDoc([path], start_uid)}
+
+    @classmethod
+    def ingestAsync(cls, paths, callback, max_workers=None, cancel=None):
+        """
+        Ingest map files as one run each on a thread pool, so the GUI thread is not blocked
+        :param paths: map file paths
+        :param callback: called from the worker thread with the document of every file as soon as it is read,
+                         in order of completion
+        :param max_workers: max number of files read concurrently, cls.max_workers if None
+        :param cancel: threading.Event of the files, a new one if None. Setting it, also before the files start,
+                       skips the files that are not read yet.
+        :return: the cancel event
+        """
+        if cancel is None:
+            cancel = threading.Event()
+        paths = list(paths)
+        if not paths:
+            return cancel
+        max_workers = max(1, min(max_workers or cls.max_workers, len(paths)))
+        executor = ThreadPoolExecutor(max_workers=max_workers)
+
+        def run(path):
+            if cancel.is_set():
+                return
+            try:
+                document = cls.ingest([path])
+            except Exception as e:
+                msg.logMessage(f'Could not open {path}: {e}', msg.ERROR)
+                return
+            if not cancel.is_set():
+                callback(document)
+
+        for path in paths:
+            executor.submit(run, path)
+        executor.shutdown(wait=False)
+        return cancel
+
+
+if __name__ == "__main__":
+    # memory of drawing a band: the image item needs a C-contiguous band, so a band flipped with np.flipud (a
+    # negative stride view) is copied before it is drawn, while a band in stored orientation is drawn as read
+    import tracemalloc
+    import tempfile
+
+    def peakMemory(getBand):
+        tracemalloc.start()
+        band = np.ascontiguousarray(getBand())
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        return band, peak / 2 ** 20
+
+    N_y, N_x, N_w, E = 512, 512, 64, 10
+    cube = np.random.random((N_y, N_x, N_w)).astype('float32')
+    path = os.path.join(tempfile.mkdtemp(), 'tst_band.h5')
+    with h5py.File(path, 'w') as f:
+        f.create_dataset('tst/data/image/image_cube', data=cube)
+    with h5py.File(path, 'r') as f:
+        dataset = f['tst/data/image/image_cube']
+        # handler band read, MapFilePlugin.__call__(E=...)
+        old, peakOld = peakMemory(lambda: np.flipud(dataset[:, :, E]))
+        new, peakNew = peakMemory(lambda: dataset[:, :, E])
+    os.remove(path)
+    assert np.array_equal(old, new[::-1])
+    print(f'{N_y}x{N_x} float32 band from hdf5, drawn: peak {peakOld:.2f} MB with flipud, {peakNew:.2f} MB in '
+          f'stored orientation')
+    assert peakNew < 0.6 * peakOld
+
+    # conversion widget, band E of the band-first view of an in-memory cube: both are strided views, so the
+    # band is copied either way and removing the flip saves no memory here
+    _, peakOld = peakMemory(lambda: np.moveaxis(np.flipud(cube), -1, 0)[E])
+    _, peakNew = peakMemory(lambda: np.moveaxis(cube, -1, 0)[E])
+    print(f'band of an in-memory cube, drawn: peak {peakOld:.2f} MB with flipud, {peakNew:.2f} MB in stored '
+          f'orientation')
@@ -1,6 +1,10 @@
 from functools import partial
+import time
 import numpy as np
 from lbl_ir.data_objects.ir_map import val2ind
+from lbl_ir.tasks.preprocessing.binning import BIN_FACTORS, binned_cache, agreement
+from lbl_ir.tasks.preprocessing.normalize import normalize, mean_center
+from lbl_ir.math_tools.quality import read_quality, good_spectra
 from matplotlib import cm
 from pyqtgraph import TextItem, mkBrush, mkPen
 from pyqtgraph.parametertree import ParameterTree, Parameter
@@ -10,7 +14,6 @@ from qtpy.QtWidgets import *
 from sklearn.cluster import KMeans
 from sklearn.neighbors import NearestNeighbors
 from sklearn.decomposition import PCA
-from sklearn.preprocessing import StandardScaler, Normalizer
 from umap import UMAP
 from xicam.BSISB.widgets.mapviewwidget import MapViewWidget, toHtml
 from xicam.BSISB.widgets.spectraplotwidget import SpectraPlotWidget
@@ -43,12 +46,19 @@ class ClusteringParameters(ParameterTree):
                                               'value': 'euclidean',
                                               'type': 'list'},
                                              {'name': "Normalization",
-                                              'values': ['L2', 'L1', 'None'],
+                                              'values': ['L2', 'L1', 'SNV', 'MSC', 'None'],
                                               'value': 'L2',
                                               'type': 'list'},
                                              {'name': "Wavenumber Range",
                                               'value': '400, 4000',
                                               'type': 'str'},
+                                             {'name': "Spectral Binning",
+                                              'values': BIN_FACTORS,
+                                              'value': 4,
+                                              'type': 'list'},
+                                             {'name': "Full Resolution",
+                                              'value': False,
+                                              'type': 'bool'},
                                              {'name': "Clusters",
                                               'value': 3,
                                               'type': 'int'},
@@ -79,7 +89,8 @@ class ClusteringParameters(ParameterTree):
         # connect signals
         self.parameter.child('Embedding').sigValueChanged.connect(self.updateMethod)
         self.parameter.child('Components').sigValueChanged.connect(self.setComponents)
-        for entry in ['Components', 'Clusters', 'X Component', 'Y Component']:
+        for entry in ['Components', 'Clusters', 'X Component', 'Y Component', 'Spectral Binning',
+                      'Full Resolution']:
             self.parameter.child(entry).sigValueChanged.connect(partial(self.updateClusterParams, entry))
 
     def updateMethod(self):
@@ -232,6 +243,9 @@ class ClusteringWidget(QSplitter):
         self.embedding = None
         self.labels = None
         self.mean_spectra = None
+        # binned copies of the spectra used while exploring parameters
+        self.binnedCache = binned_cache()
+        self.previewRun = None
 
         # split between cluster image and scatter plot
         self.image_and_scatter = QSplitter()
@@ -325,13 +339,13 @@ class ClusteringWidget(QSplitter):
             msg.logMessage('"Wavenumber Range" values must be in pairs', msg.ERROR)
             MsgBox('Clustering computation aborted.', 'error')
             return
-        self.wavenumbers_select = self.wavenumbers[wavROIidx]
+        # get current dataset, spectrally binned unless full resolution is requested
+        factor = 1 if self.parameter['Full Resolution'] else self.parameter['Spectral Binning']
+        self.dataset, self.wavenumbers_select = self.binnedCache.get((id(self.data), tuple(wavROIidx)),
+                                                                     partial(self.selectSpectra, wavROIidx),
+                                                                     self.wavenumbers[wavROIidx], factor)
         self.N_w = len(self.wavenumbers_select)
-        # get current dataset
-        n_spectra = len(self.data)
-        self.dataset = np.zeros((n_spectra, self.N_w))
-        for i in range(n_spectra):
-            self.dataset[i, :] = self.data[i][wavROIidx]
+        t0 = time.perf_counter()
         # get parameters and compute embedding
         n_components = self.parameter['Components']
         if self.parameter['Embedding'] == 'UMAP':
@@ -346,22 +360,50 @@ class ClusteringWidget(QSplitter):
             self.embedding = self.umap.fit_transform(self.dataset)
         elif self.parameter['Embedding'] == 'PCA':
             # normalize and mean center
-            if self.parameter['Normalization'] == 'L1':  # normalize
-                data_norm = Normalizer(norm='l1').fit_transform(self.dataset)
-            elif self.parameter['Normalization'] == 'L2':
-                data_norm = Normalizer(norm='l2').fit_transform(self.dataset)
-            else:
-                data_norm = self.dataset
-            # subtract mean
-            data_centered = StandardScaler(with_std=False).fit_transform(data_norm)
+            # one float32 copy, normalized and centered in place; self.dataset is left as is
+            data_centered = normalize(self.dataset, self.parameter['Normalization'].lower())
+            # flagged spectra (spikes, saturation, ...) are left out of the mean and the fit
+            good = self.goodSpectra(len(data_centered))
+            mean_center(data_centered, mask=good)
             # Do PCA
             self.PCA = PCA(n_components=n_components)
-            self.PCA.fit(data_centered)
+            self.PCA.fit(data_centered if good.all() else data_centered[good])
             self.embedding = self.PCA.transform(data_centered)
         # save embedding to standardModelItem
         self.item.embedding = self.embedding
         # update cluster map
         self.computeCluster()
+        self.reportBinning(factor, time.perf_counter() - t0)
+
+    def selectSpectra(self, wavROIidx):
+        n_spectra = len(self.data)
+        dataset = np.zeros((n_spectra, len(wavROIidx)))
+        for i in range(n_spectra):
+            dataset[i, :] = self.data[i][wavROIidx]
+        return dataset
+
+    def goodSpectra(self, n_spectra):
+        """
+        Whether the spectra of the selected map have no quality flags; all True for maps saved without flags, or
+        if every spectrum is flagged
+        """
+        flags = self.qualityList[self.selectMapidx] if self.selectMapidx < len(self.qualityList) else None
+        if (flags is None) or (len(flags) != n_spectra):
+            return np.ones(n_spectra, dtype=bool)
+        good = good_spectra(flags)
+        return good if good.any() else np.ones(n_spectra, dtype=bool)
+
+    def reportBinning(self, factor, t):
+        """
+        Remember the last binned run and compare it with the full resolution rerun of the same map
+        """
+        if factor > 1:
+            self.previewRun = (self.selectMapidx, factor, t, self.labels)
+        elif (self.previewRun is not None) and (self.previewRun[0] == self.selectMapidx):
+            _, binFactor, t_binned, labels = self.previewRun
+            msg.showMessage(f'Full resolution: {t:.1f} s. Binning x{binFactor}: {t_binned:.1f} s '
+                            f'({t / max(t_binned, 1e-6):.1f}x faster), cluster agreement (ARI) '
+                            f'{agreement(self.labels, labels):.3f}.')
 
     def computeCluster(self):
         # check if embeddings exist
@@ -373,22 +415,23 @@ class ClusteringWidget(QSplitter):
         # set colorLUT
         self.colorLUT = cm.get_cmap('viridis', n_clusters).colors[:, :3] * 255
         # compute cluster
-        cluster_object = KMeans(n_clusters=n_clusters, random_state=0).fit(self.embedding)
-        self.labels = cluster_object.labels_
+        # clusters are fitted on the spectra without quality flags, flagged ones are assigned to the nearest
+        good = self.goodSpectra(len(self.embedding))
+        cluster_object = KMeans(n_clusters=n_clusters, random_state=0).fit(self.embedding[good])
+        self.labels = cluster_object.predict(self.embedding)
         # update cluster image
         self.cluster_map = self.labels.reshape(self.imgShape[0], self.imgShape[1])
-        self.cluster_map = np.flipud(self.cluster_map)
         self.clusterImage.setImage(self.cluster_map, levels=[0, n_clusters - 1])
         # self.clusterImage.setImage(self.cluster_map)
         self.clusterImage._image = self.cluster_map
         self.clusterImage.rc2ind = self.rc2ind
         self.clusterImage.row, self.clusterImage.col = self.imgShape[0], self.imgShape[1]
-        self.clusterImage.txt.setPos(self.clusterImage.col, 0)
+        self.clusterImage.txt.setPos(self.clusterImage.col, self.clusterImage.row)
         self.clusterImage.cross.show()
         # update cluster mean
         mean_spectra = []
         for ii in range(n_clusters):
-            sel = (self.labels == ii)
+            sel = (self.labels == ii) & good
             this_mean = np.mean(self.dataset[sel, :], axis=0)
             mean_spectra.append(this_mean)
         self.mean_spectra = np.vstack(mean_spectra)
@@ -416,7 +459,7 @@ class ClusteringWidget(QSplitter):
         self.clusterScatterPlot.getNN()
 
     def updateClusterParams(self, name):
-        if name == 'Components':
+        if name in ['Components', 'Spectral Binning', 'Full Resolution']:
             self.computeEmbedding()
         elif name == 'Clusters':
             self.computeCluster()
@@ -447,12 +490,12 @@ class ClusteringWidget(QSplitter):
     def setImageCross(self, ind):
         row, col = self.ind2rc[ind]
         # update cross
-        self.clusterImage.cross.setData([col + 0.5], [self.imgShape[0] - row - 0.5])
+        self.clusterImage.cross.setData([col + 0.5], [row + 0.5])
         # update text
         self.clusterImage.txt.setHtml(toHtml(f'Point: #{ind}', size=8)
                                       + toHtml(f'X: {col}', size=8)
                                       + toHtml(f'Y: {row}', size=8)
-                                      + toHtml(f'Val: {self.clusterImage._image[self.imgShape[0] - row - 1, col] :d}',
+                                      + toHtml(f'Val: {self.clusterImage._image[row, col] :d}',
                                                size=8))
 
     def cleanUp(self):
@@ -476,6 +519,9 @@ class ClusteringWidget(QSplitter):
         self.rc2indList = []
         self.ind2rcList = []
         self.dataSets = []
+        self.qualityList = []
+        self.binnedCache.clear()
+        self.previewRun = None
 
         # get wavenumbers, imgShapes, rc2ind
         for header in self.headers:
@@ -484,6 +530,8 @@ class ClusteringWidget(QSplitter):
             self.imgShapes.append(dataEvent['imgShape'])
             self.rc2indList.append(dataEvent['rc_index'])
             self.ind2rcList.append(dataEvent['index_rc'])
+            # quality flags stored at conversion, None for maps saved without them
+            self.qualityList.append(read_quality(dataEvent['path']))
             # get raw spectra
             data = None
             try:  # spectra datasets
@@ -4,10 +4,10 @@ from pyqtgraph import PlotWidget, PlotDataItem, TextItem, mkPen, InfiniteLine, I
 from qtpy.QtCore import Qt, QItemSelectionModel
 from qtpy.QtGui import QStandardItemModel, QFont
 from functools import partial
+import time
 from qtpy.QtCore import Signal
 from pymcr.mcr import McrAR
 from sklearn.decomposition import PCA, NMF, FastICA
-from sklearn.preprocessing import StandardScaler, Normalizer
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
@@ -17,6 +17,9 @@ from xicam.BSISB.widgets.imshowwidget import SlimImageView
 from xicam.BSISB.widgets.spectraplotwidget import SpectraPlotWidget
 from lbl_ir.data_objects.ir_map import val2ind
 from lbl_ir.tasks.preprocessing import data_prep
+from lbl_ir.tasks.preprocessing.binning import BIN_FACTORS, binned_cache, agreement
+from lbl_ir.tasks.preprocessing.normalize import normalize, mean_center
+from lbl_ir.math_tools.quality import read_quality, good_spectra
 from lbl_ir.tasks.NMF.multi_set_analyses import aggregate_data
 from lbl_ir.io_tools import read_map
 
@@ -58,9 +61,16 @@ class FactorizationParameters(ParameterTree):
                                               'value': '800,1800',
                                               'type': 'str'},
                                              {'name': "Normalization",
-                                              'values': ['L2', 'L1', 'None'],
+                                              'values': ['L2', 'L1', 'SNV', 'MSC', 'None'],
                                               'value': 'L2',
                                               'type': 'list'},
+                                             {'name': "Spectral Binning",
+                                              'values': BIN_FACTORS,
+                                              'value': 4,
+                                              'type': 'list'},
+                                             {'name': "Full Resolution",
+                                              'value': False,
+                                              'type': 'bool'},
                                              {'name': "C regressor",
                                               'values': ['OLS', 'NNLS'],
                                               'value': 'OLS',
@@ -99,6 +109,12 @@ class FactorizationParameters(ParameterTree):
         elif self.parameter['Method'] == 'MCR':
             self.parameter.child('Normalization').hide()
             self.parameter.child('C regressor').show()
+        # NMF reads the map files with its own band selection and always runs at full resolution
+        for entry in ['Spectral Binning', 'Full Resolution']:
+            if self.parameter['Method'] == 'NMF':
+                self.parameter.child(entry).hide()
+            else:
+                self.parameter.child(entry).show()
 
     def setNumComponents(self):
         N = self.parameter['Components']
@@ -160,6 +176,9 @@ class FactorizationWidget(QSplitter):
         self.selectionmodel.selectionChanged.connect(self.updateMap)
         self.selectionmodel.selectionChanged.connect(self.updateRoiMask)
         self.selectMapIdx = 0
+        # binned copies of the spectra used while exploring parameters
+        self.binnedCache = binned_cache()
+        self.previewRun = None
 
         self.rightsplitter = QSplitter()
         self.rightsplitter.setOrientation(Qt.Vertical)
@@ -187,7 +206,6 @@ class FactorizationWidget(QSplitter):
         for i in range(4):
             getattr(self, self._imageDict[i]).setPredefinedGradient("viridis")
             getattr(self, self._imageDict[i]).getHistogramWidget().setMinimumWidth(5)
-            getattr(self, self._imageDict[i]).view.invertY(True)
             getattr(self, self._imageDict[i]).imageItem.setOpts(axisOrder="row-major")
             # set up roi item
             roi = PolyLineROI(positions=[[0, 0], [sideLen, 0], [sideLen, sideLen], [0, sideLen]], closed=True)
@@ -270,6 +288,7 @@ class FactorizationWidget(QSplitter):
 
         #connect signals
         self.computeBtn.clicked.connect(self.calculate)
+        self.parameter.child('Full Resolution').sigValueChanged.connect(self.calculate)
         self.saveBtn.clicked.connect(self.saveResults)
         self.sigPCA.connect(self.showComponents)
 
@@ -406,13 +425,12 @@ class FactorizationWidget(QSplitter):
             img = np.zeros((self.imgShapes[self.selectMapIdx][0], self.imgShapes[self.selectMapIdx][1]))
             img[self.selectedPixelsList[self.selectMapIdx][:, 0], self.selectedPixelsList[self.selectMapIdx][:,
                                                                1]] = data_slice
-        img = np.flipud(img)
         getattr(self, self._imageDict[i]).setImage(img=img)
         # set imageTitle
         imageTitle = getattr(self, self._imageDict[i]).imageTitle
         title = self.parameter['Method'] + str(component_index)
         imageTitle.setHtml(f'<div style="text-align: center"><span style="color: #FFF; font-size: 8pt">{title}</div>')
-        imageTitle.setPos(0, -5)
+        imageTitle.setPos(0, self.imgShapes[self.selectMapIdx][0] + 5)
 
     def curveHighLight(self, k):
         for i in range(4):
@@ -434,6 +452,9 @@ class FactorizationWidget(QSplitter):
         self.rc2indList = []
         self.ind2rcList = []
         self._dataSets = {'spectra': [], 'volume': []}
+        self.qualityList = []
+        self.binnedCache.clear()
+        self.previewRun = None
 
         # get wavenumbers, imgShapes
         for header in self.headers:
@@ -457,6 +478,8 @@ class FactorizationWidget(QSplitter):
             volumeEvent = next(header.events(fields=['volume']))
             path = volumeEvent['path']  # readin filepath
             self._dataSets['volume'].append(path)
+            # quality flags stored at conversion, None for maps saved without them
+            self.qualityList.append(read_quality(path))
 
         # init maps
         if len(self.imgShapes) > 0:
@@ -509,43 +532,49 @@ class FactorizationWidget(QSplitter):
             msg.showMessage('Start computing', self.method + '. Image shape:', str(self.imgShapes))
             self.dataRowSplit = [0]  # remember the starting/end row positions of each dataset
             if self.field == 'spectra':  # PCA workflow
-                self.N_w = len(self.wavenumbers_select)
-                self._allData = np.empty((0, self.N_w))
-
+                spectraIdx = []  # spectra index of every data row, per map
                 for i, data in enumerate(self._dataSets['spectra']):  # i: map idx
                     if self.selectedPixelsList[i] is None:
                         n_spectra = len(data)
-                        tmp = np.zeros((n_spectra, self.N_w))
+                        spectraIdx.append(list(range(n_spectra)))
                         for j in range(n_spectra):
-                            tmp[j, :] = data[j][wavROIidx]
                             self.df_row_idx.append((self.ind2rcList[i][j], j))
                     else:
                         n_spectra = len(self.selectedPixelsList[i])
-                        tmp = np.zeros((n_spectra, self.N_w))
+                        spectraIdx.append([])
                         for j in range(n_spectra):  # j: jth selected pixel
                             row_col = tuple(self.selectedPixelsList[i][j])
-                            tmp[j, :] = data[self.rc2indList[i][row_col]][wavROIidx]
+                            spectraIdx[i].append(self.rc2indList[i][row_col])
                             self.df_row_idx.append((row_col, self.rc2indList[i][row_col]))
 
                     self.dataRowSplit.append(self.dataRowSplit[-1] + n_spectra)
-                    self._allData = np.append(self._allData, tmp, axis=0)
+
+                # spectrally binned data unless full resolution is requested
+                factor = 1 if self.parameter['Full Resolution'] else self.parameter['Spectral Binning']
+                cacheKey = (tuple(wavROIidx), tuple(tuple(idx) for idx in spectraIdx))
+                self._allData, self.wavenumbers_select = self.binnedCache.get(
+                    cacheKey, partial(self.selectSpectra, spectraIdx, wavROIidx), self.wavenumbers_select, factor)
+                self.N_w = len(self.wavenumbers_select)
+                t0 = time.perf_counter()
 
                 if len(self._allData) > 0:
                     if self.method == 'PCA':
                         self.data_fac_name = 'data_PCA' # define pop up plots labels
                         # normalize and mean center
-                        if self.parameter['Normalization'] == 'L1':# normalize
-                            data_norm = Normalizer(norm='l1').fit_transform(self._allData)
-                        elif self.parameter['Normalization'] == 'L2':
-                            data_norm = Normalizer(norm='l2').fit_transform(self._allData)
-                        else:
-                            data_norm = self._allData
-                        #subtract mean
-                        data_centered = StandardScaler(with_std=False).fit_transform(data_norm)
+                        # one float32 copy, normalized and centered in place; the binned cache is left as is
+                        data_centered = normalize(self._allData, self.parameter['Normalization'].lower())
+                        # spectra with quality flags (spikes, saturation, ...) are left out of the mean and the
+                        # fit, and still get scores for the maps
+                        good = self.goodRows(spectraIdx)
+                        if not good.any():
+                            good[:] = True
+                        mean_center(data_centered, mask=good)
                         # Do PCA
                         self.PCA = PCA(n_components=N)
-                        self.PCA.fit(data_centered)
+                        self.PCA.fit(data_centered if good.all() else data_centered[good])
                         self.data_PCA = self.PCA.transform(data_centered)
+                        if not good.all():
+                            msg.showMessage(f'{np.count_nonzero(~good)} flagged spectra are left out of the PCA fit.')
                         # pop up plots
                         self.popup_plots()
                     elif self.method == 'MCR':
@@ -569,6 +598,7 @@ class FactorizationWidget(QSplitter):
                     MsgBox('The data matrix is empty. No PCA is performed.', 'error')
                     self.PCA, self.data_PCA = None, None
                     self.MCR, self.data_MCR = None, None
+                self.reportBinning(cacheKey, factor, time.perf_counter() - t0)
                 # emit PCA and transformed data
                 if self.method == 'PCA':
                     self.sigPCA.emit((self.wavenumbers_select, self.PCA, self.data_PCA, self.dataRowSplit))
@@ -586,7 +616,7 @@ class FactorizationWidget(QSplitter):
                     n_spectra = ir_data.data.shape[0]
                     self.allDataRowSplit.append(self.allDataRowSplit[-1] + n_spectra)
                     data_files.append(ir_data)
-                    ds = data_prep.data_prepper(ir_data)
+                    ds = data_prep.data_prepper(ir_data, filename=file)
                     wav_masks.append(ds.decent_bands)
                     # row selection
                     if self.selectedPixelsList[i] is None:
@@ -625,6 +655,44 @@ class FactorizationWidget(QSplitter):
                 # emit NMF and transformed data : data_NMF
                 self.sigPCA.emit((self.wavenumbers_select, self.NMF, self.data_NMF, self.dataRowSplit))
 
+    def goodRows(self, spectraIdx):
+        """
+        Whether the spectra of the data rows have no quality flags, all True for maps saved without flags
+        """
+        good = []
+        for i, idx in enumerate(spectraIdx):
+            flags = self.qualityList[i] if i < len(self.qualityList) else None
+            if flags is None:
+                good.append(np.ones(len(idx), dtype=bool))
+            else:
+                good.append(good_spectra(flags[np.asarray(idx, dtype='int')]))
+        return np.concatenate(good) if good else np.zeros(0, dtype=bool)
+
+    def selectSpectra(self, spectraIdx, wavROIidx):
+        allData = np.zeros((sum(len(idx) for idx in spectraIdx), len(wavROIidx)))
+        k = 0
+        for i, data in enumerate(self._dataSets['spectra']):
+            for j in spectraIdx[i]:
+                allData[k, :] = data[j][wavROIidx]
+                k += 1
+        return allData
+
+    def reportBinning(self, cacheKey, factor, t):
+        """
+        Remember the last binned run and compare it with the full resolution rerun on the same data
+        """
+        result = getattr(self, 'data_' + self.method, None)
+        if result is None:
+            return
+        runKey = (cacheKey, self.method, self.parameter['Components'])
+        if factor > 1:
+            self.previewRun = (runKey, factor, t, result)
+        elif (self.previewRun is not None) and (self.previewRun[0] == runKey):
+            _, binFactor, t_binned, binnedResult = self.previewRun
+            msg.showMessage(f'Full resolution: {t:.1f} s. Binning x{binFactor}: {t_binned:.1f} s '
+                            f'({t / max(t_binned, 1e-6):.1f}x faster), score correlation '
+                            f'{agreement(result, binnedResult):.3f}.')
+
     def popup_plots(self):
         # component variance ratio plot
         if self.method == 'PCA':
@@ -1,9 +1,13 @@
 from xicam.gui.widgets.imageviewmixins import BetterButtons
+from qtpy.QtCore import QThread, Signal
+from xicam.core import msg
+from lbl_ir.math_tools.band_stats import band_levels
+from lbl_ir.math_tools.map_summary import backfill_map_summary
 import numpy as np
 
 
 class SlimImageView(BetterButtons):
-    def __init__(self, invertY=True):
+    def __init__(self, invertY=False):
         super(SlimImageView, self).__init__()
         # Shrink LUT
         self.getHistogramWidget().setMinimumWidth(1)
@@ -13,17 +17,46 @@ class SlimImageView(BetterButtons):
         # self.ui.gridLayout.addWidget(self.ui.graphicsView, 0, 0, 4, 1)
         # set up colorbar
         self.setPredefinedGradient("viridis")
+        # maps are stored with row 0 at the bottom, an upward y axis shows them without flipping the data
         self.view.invertY(invertY)
         self.imageItem.setOpts(axisOrder="row-major")
         # Setup late signal
         self.sigTimeChangeFinished = self.timeLine.sigPositionChangeFinished
+        # precomputed per-band statistics, see lbl_ir.math_tools.band_stats
+        self.bandStats = None
+
+    def setBandStats(self, bandStats):
+        """
+        Take display levels and LUT histograms from precomputed per-band statistics
+        :param bandStats: stats dict from lbl_ir.math_tools.band_stats, None to go back to computing from pixel data
+        :return: None
+        """
+        self.bandStats = bandStats
+        if bandStats is not None:
+            self.imageItem.getHistogram = self.bandHistogram
+            if self.image is not None:
+                self.setLevels(*band_levels(bandStats, self.currentIndex))
+        elif 'getHistogram' in self.imageItem.__dict__:
+            del self.imageItem.getHistogram
+
+    def bandHistogram(self, *args, **kwargs):
+        """
+        Stored histogram of the current band, replaces ImageItem.getHistogram
+        """
+        edges = self.bandStats['hist_edges'][self.currentIndex]
+        return (edges[:-1] + edges[1:]) / 2, self.bandStats['histogram'][self.currentIndex]
 
     def quickMinMax(self, data):
         """
         Estimate the min/max values of *data* by subsampling. MODIFIED TO USE THE 99TH PERCENTILE instead of max.
+        Stored band statistics are used instead when available.
         """
         if data is None:
             return 0, 0
+        if self.bandStats is not None:
+            if data.ndim == 2:
+                return band_levels(self.bandStats, self.currentIndex)
+            return band_levels(self.bandStats)
         ax = np.argmax(data.shape)
         sl = [slice(None)] * data.ndim
         sl[ax] = slice(None, None, max(1, int(data.size // 1e4)))
@@ -31,3 +64,21 @@ class SlimImageView(BetterButtons):
         return (np.nanmin(data), np.nanpercentile(np.where(data < np.nanmax(data), data, np.nanmin(data)), 99))
 
 
+class MapSummaryWorker(QThread):
+    sigSummary = Signal(str, object, object)
+
+    def __init__(self, path):
+        """
+        Compute the band statistics and pixel metrics of a map file saved without them, in one background read
+        :param path: hdf5 file path
+        """
+        super(MapSummaryWorker, self).__init__()
+        self.path = path
+
+    def run(self):
+        try:
+            stats, metrics = backfill_map_summary(self.path)
+        except Exception as e:
+            msg.logMessage(f'Band statistics and pixel metrics of {self.path} could not be computed: {e}', msg.ERROR)
+            return
+        self.sigSummary.emit(self.path, stats, metrics)
@@ -121,19 +121,18 @@ class mapToH5(QSplitter):
                     userChoice = userMsg.choice()
                     if userChoice == QMessageBox.Yes:
                         self.T2AConvert.setChecked(True)
-                        self.irMap.imageCube = -np.log10(self.irMap.imageCube / 100 + self.epsilon)
-                        self.irMap.data = -np.log10(self.irMap.data / 100 + self.epsilon)
+                        self.irMap.to_absorbance(scale=100, eps=self.epsilon)
                         self.infoBox.setText(f'User chooses to perform T->A conversion in {self.fileName}.')
                     else:
                         self.infoBox.setText(f'User chooses not to perform T->A conversion in {self.fileName}.')
                 elif maxSpecY >= self.minYLimit:
-                    self.irMap.imageCube = -np.log10(self.irMap.imageCube / 100 + self.epsilon)
-                    self.irMap.data = -np.log10(self.irMap.data / 100 + self.epsilon)
+                    self.irMap.to_absorbance(scale=100, eps=self.epsilon)
                     self.infoBox.setText(f'T->A conversion is performed in {self.fileName}.')
                 else:
                     self.infoBox.setText(f"{self.fileName}'s datatype is absorbance. \nT->A conversion is not performed.")
 
-            self.dataCube = np.moveaxis(np.flipud(self.irMap.imageCube), -1, 0)
+            # band-first view of the cube, no copy
+            self.dataCube = np.moveaxis(self.irMap.imageCube, -1, 0)
             # set up required data/properties in self.imageview
             row, col = self.irMap.imageCube.shape[0], self.irMap.imageCube.shape[1]
             wavenumbers = self.irMap.wavenumbers
@@ -230,20 +229,18 @@ class mapToH5(QSplitter):
                     if userChoice == QMessageBox.YesToAll: # set 'auto T->A' on
                         self.T2AConvert.setChecked(True)
                     if (userChoice == QMessageBox.YesToAll) or (userChoice == QMessageBox.Yes):
-                        irMap.imageCube = -np.log10(irMap.imageCube / 100 + self.epsilon)
-                        irMap.data = -np.log10(irMap.data / 100 + self.epsilon)
+                        irMap.to_absorbance(scale=100, eps=self.epsilon)
                         self.infoBox.setText(f'User chooses to perform T->A conversion in {fileName}.')
                     else:
                         self.infoBox.setText(f'User chooses not to perform T->A conversion in {fileName}.')
                 elif maxSpecY >= self.minYLimit:
-                    irMap.imageCube = -np.log10(irMap.imageCube / 100 + self.epsilon)
-                    irMap.data = -np.log10(irMap.data / 100 + self.epsilon)
+                    irMap.to_absorbance(scale=100, eps=self.epsilon)
                     self.infoBox.setText(f'T->A conversion is performed in {fileName}.')
                 else:
                     self.infoBox.setText(
                         f"{fileName}'s datatype is absorbance. \nT->A conversion is not performed.")
 
-                dataCube = np.moveaxis(np.flipud(irMap.imageCube), -1, 0)
+                dataCube = np.moveaxis(irMap.imageCube, -1, 0)
                 # set up required data/properties in self.imageview and show image
                 row, col = irMap.imageCube.shape[0], irMap.imageCube.shape[1]
                 wavenumbers = irMap.wavenumbers
@@ -311,19 +308,17 @@ class BatchMapConverter(QThread):
                     if userChoice == QMessageBox.YesToAll:  # set 'auto T->A' on
                         self.sigT2A.emit(True)
                     if (userChoice == QMessageBox.YesToAll) or (userChoice == QMessageBox.Yes):
-                        irMap.imageCube = -np.log10(irMap.imageCube / 100 + self.epsilon)
-                        irMap.data = -np.log10(irMap.data / 100 + self.epsilon)
+                        irMap.to_absorbance(scale=100, eps=self.epsilon)
                         self.sigText.emit(f'User chooses to perform T->A conversion in {fileName}.')
                     else:
                         self.sigText.emit(f'User chooses not to perform T->A conversion in {fileName}.')
                 elif maxSpecY >= self.minYLimit:
-                    irMap.imageCube = -np.log10(irMap.imageCube / 100 + self.epsilon)
-                    irMap.data = -np.log10(irMap.data / 100 + self.epsilon)
+                    irMap.to_absorbance(scale=100, eps=self.epsilon)
                     self.sigText.emit(f'T->A conversion is performed in {fileName}.')
                 else:
                     self.sigText.emit(f"{fileName}'s datatype is absorbance. \nT->A conversion is not performed.")
 
-                dataCube = np.moveaxis(np.flipud(irMap.imageCube), -1, 0)
+                dataCube = np.moveaxis(irMap.imageCube, -1, 0)
                 # set up required data/properties in self.imageview and show image
                 row, col = irMap.imageCube.shape[0], irMap.imageCube.shape[1]
                 wavenumbers = irMap.wavenumbers
@@ -1,10 +1,13 @@
 import numpy as np
-from xicam.BSISB.widgets.imshowwidget import SlimImageView
+from xicam.BSISB.widgets.imshowwidget import SlimImageView, MapSummaryWorker
 from xicam.core import msg
 from xicam.core.data import NonDBHeader
 from pyqtgraph import ArrowItem, TextItem, PlotDataItem
-from qtpy.QtCore import Signal
+from qtpy.QtCore import Signal, QRectF
 from lbl_ir.data_objects.ir_map import val2ind
+from lbl_ir.math_tools.band_stats import read_band_stats, band_levels
+from lbl_ir.math_tools.pyramid import has_pyramid, pyramid_source
+from lbl_ir.math_tools.pixel_metrics import read_pixel_metrics, metric_mask
 
 def toHtml(txt, size=12):
     return f'<div style="text-align: center"><span style="color: #FFF; font-size: {size}pt">{txt}</div>'
@@ -16,7 +19,6 @@ class MapViewWidget(SlimImageView):
         super(MapViewWidget, self).__init__(*args, **kwargs)
         # self.scene.sigMouseMoved.connect(self.showSpectra)
         self.scene.sigMouseClicked.connect(self.showSpectra)
-        self.view.invertY(True)
         # add arrow
         self.cross = PlotDataItem([0], [0], symbolBrush=(200, 0, 0), symbolPen=(200, 0, 0), symbol='+', symbolSize=16)
         self.view.addItem(self.cross)
@@ -24,32 +26,75 @@ class MapViewWidget(SlimImageView):
         #add txt
         self.txt = TextItem('', anchor=(0, 0))
         self.addItem(self.txt)
+        # multi-resolution source for very large maps, see lbl_ir.math_tools.pyramid
+        self._pyramid = None
+        self._tileKey = None
+        self.view.sigRangeChanged.connect(self.updatePyramid)
+        # per-pixel metrics from conversion, see lbl_ir.math_tools.pixel_metrics
+        self.pixelMetrics = None
 
     def setEnergy(self, lineobject):
         E = lineobject.value()
         # map E to index
         idx = val2ind(E, self.wavenumbers)
+        if self._pyramid is not None:
+            self.currentIndex = idx
+            self.updatePyramid()
+            return
         self._image = self._data[idx]
         self.setCurrentIndex(idx)
 
+    def updatePyramid(self, *args):
+        """
+        Show the current band from the pyramid level that matches the zoom factor. At full resolution
+        only the visible region (plus a margin) is read.
+        """
+        if self._pyramid is None:
+            return
+        zoom = max(self.view.viewPixelSize())  # map pixels per screen pixel
+        level = self._pyramid.pick_level(zoom)
+        (x0, x1), (y0, y1) = self.view.viewRange()
+        if level > 0:
+            region = None
+        else:
+            # keep the loaded tile while the visible region stays inside it
+            if (self._tileKey is not None) and (self._tileKey[:2] == (0, self.currentIndex)):
+                r0, r1, c0, c1 = self._tileKey[2]
+                if (r0 <= max(y0, 0)) and (min(y1, self.row) <= r1) and (c0 <= max(x0, 0)) and (min(x1, self.col) <= c1):
+                    return
+            dy, dx = (y1 - y0) / 2, (x1 - x0) / 2
+            region = (y0 - dy, y1 + dy, x0 - dx, x1 + dx)
+        if (region is None) and (self._tileKey == (level, self.currentIndex, None)):
+            return
+        img, (r0, r1, c0, c1) = self._pyramid.band(self.currentIndex, level, region)
+        self._tileKey = (level, self.currentIndex, None if region is None else (r0, r1, c0, c1))
+        self.imageItem.setImage(img, autoLevels=False)
+        self.imageItem.setRect(QRectF(c0, r0, c1 - c0, r1 - r0))
+        if self.bandStats is not None:
+            self.setLevels(*band_levels(self.bandStats, self.currentIndex))
+
+    def pixelValue(self, row, col):
+        if self._pyramid is not None:
+            return self._pyramid.value(self.currentIndex, row, col)
+        return self._image[row, col]
+
     def showSpectra(self, event):
         pos = event.pos()
         if self.view.sceneBoundingRect().contains(pos):  # Note, when axes are added, you must get the view with self.view.getViewBox()
             mousePoint = self.view.mapSceneToView(pos)
             x, y = int(mousePoint.x()), int(mousePoint.y())
-            y = self.row - y - 1
             try:
                 ind = self.rc2ind[(y,x)]
                 self.sigShowSpectra.emit(ind)
                 # print(x, y, ind, x + y * self.n_col)
                 #update crosshair
-                self.cross.setData([x + 0.5], [self.row - y - 0.5])
+                self.cross.setData([x + 0.5], [y + 0.5])
                 self.cross.show()
                 # update text
                 self.txt.setHtml(toHtml(f'Point: #{ind}', size=8)
                                  + toHtml(f'X: {x}', size=8)
                                  + toHtml(f'Y: {y}', size=8)
-                                 + toHtml(f'Val: {self._image[self.row - y -1, x]: .4f}', size=8)
+                                 + toHtml(f'Val: {self.pixelValue(y, x): .4f}', size=8)
                                  )
             except Exception:
                 self.cross.hide()
@@ -62,17 +107,37 @@ class MapViewWidget(SlimImageView):
         imageEvent = next(header.events(fields=['image']))
         self.rc2ind = imageEvent['rc_index']
         self.wavenumbers = imageEvent['wavenumbers']
+        # display levels from band statistics and masks from pixel metrics stored at conversion,
+        # both backfilled in one background read if missing
+        self.mapPath = imageEvent['path']
+        self.setBandStats(read_band_stats(imageEvent['path']))
+        self.pixelMetrics = read_pixel_metrics(imageEvent['path'])
+        if (self.bandStats is None) or (self.pixelMetrics is None):
+            self.summaryWorker = MapSummaryWorker(imageEvent['path'])
+            self.summaryWorker.sigSummary.connect(self.setMapSummary)
+            self.summaryWorker.start()
         # make lazy array from document
         data = None
         try:
             data = header.meta_array(field)
             self.row = data.shape[1]
             self.col = data.shape[2]
-            self.txt.setPos(self.col, 0)
+            self.txt.setPos(self.col, self.row)
         except IndexError:
             msg.logMessage('Header object contained no frames with field ''{field}''.', msg.ERROR)
 
-        if data is not None:
+        if self._pyramid is not None:
+            self._pyramid.close()
+            self._pyramid, self._tileKey = None, None
+        if (data is not None) and has_pyramid(imageEvent['path']):
+            # large map: bands are read from the pyramid level matching the zoom, not as full images
+            self._pyramid = pyramid_source(imageEvent['path'])
+            self._data = data
+            self._image = None
+            self.currentIndex = 0
+            self.view.setRange(xRange=(0, self.col), yRange=(0, self.row), padding=0)
+            self.updatePyramid()
+        elif data is not None:
             # kwargs['transform'] = QTransform(1, 0, 0, -1, 0, data.shape[-2])
             self.setImage(img=data, *args, **kwargs)
             self._data = data
@@ -81,14 +146,31 @@ class MapViewWidget(SlimImageView):
     def updateImage(self, autoHistogramRange=True):
         super(MapViewWidget, self).updateImage(autoHistogramRange)
         self.ui.roiPlot.setVisible(False)
+        if self.bandStats is not None:
+            self.setLevels(*band_levels(self.bandStats, self.currentIndex))
 
     def setImage(self, img, **kwargs):
         super(MapViewWidget, self).setImage(img, **kwargs)
         self.ui.roiPlot.setVisible(False)
 
+    def setMapSummary(self, path, stats, metrics):
+        if path != self.mapPath:
+            return  # backfill of a previous map
+        if self.bandStats is None:
+            self.setBandStats(stats)
+        if self.pixelMetrics is None:
+            self.setPixelMetrics(metrics)
+
+    def setPixelMetrics(self, metrics):
+        self.pixelMetrics = metrics
+
     def makeMask(self, thresholds):
-        peak1550 = val2ind(1550, self.wavenumbers)
         thr1550 = thresholds[0]
-        mask = self._data[peak1550] > thr1550
+        if self.pixelMetrics is not None:
+            # amide II absorbance stored at conversion, no band read
+            mask = metric_mask(self.pixelMetrics, amide_II=(thr1550, None))
+        else:
+            peak1550 = val2ind(1550, self.wavenumbers)
+            mask = self._data[peak1550] > thr1550
         mask = mask.astype(np.int)
         return mask
@@ -1,15 +1,20 @@
 import os
+import threading
 import numpy as np
 import pandas as pd
-from scipy.interpolate import interp1d
+from collections import OrderedDict
 from functools import partial
 from qtpy.QtWidgets import *
-from qtpy.QtCore import Qt, QItemSelectionModel, Signal
+from qtpy.QtCore import Qt, QItemSelectionModel, Signal, QThread, QTimer
 from qtpy.QtGui import QStandardItemModel, QStandardItem, QFont
 from pyqtgraph.parametertree import ParameterTree, Parameter
 from xicam.core import msg
 from lbl_ir.data_objects.ir_map import ir_map, val2ind
-from lbl_ir.tasks.preprocessing.EMSC import Kohler_zero
+from lbl_ir.tasks.preprocessing.batched_EMSC import kohler_zero_batch
+from lbl_ir.tasks.preprocessing.basis_cache import extinction_cache
+from lbl_ir.tasks.preprocessing.batch_engine import batch_preprocessor
+from lbl_ir.tasks.baseline.anchor_points import anchor_baseline
+from lbl_ir.math_tools.derivative import savgol_derivative
 from xicam.BSISB.widgets.spectraplotwidget import baselinePlotWidget
 from xicam.BSISB.widgets.uiwidget import MsgBox, YesNoDialog
 
@@ -21,6 +26,7 @@ class Preprocessor:
         self.preprocess_method = None
         self.interp_method = None
         self.wav_anchor = None
+        self.w_regions = None
 
     def parse_anchors(self, anchors):
         """
@@ -33,7 +39,7 @@ class Preprocessor:
                 anchor_idx.append(val2ind(int(entry.strip()), self.wavenumbers))
             except:
                 continue
-        anchor_idx = sorted(anchor_idx)
+        anchor_idx = self.anchor_idx = sorted(anchor_idx)
 
         self.energy = self.wavenumbers[anchor_idx[0]: anchor_idx[-1] + 1]
         self.specTrim = self.spectrum[anchor_idx[0]: anchor_idx[-1] + 1]
@@ -79,46 +85,70 @@ class Preprocessor:
                 return False
 
 
-    def rubber_band(self, anchors, kind='linear', w_regions=None):
+    def rubber_band(self, anchors, kind='linear', w_regions=None, validate=True, cancel=None, **derivArgs):
         """
         Calculate rubberBaseline, debased spectrum and 2nd, 4th order derivative of the spectrum
         :param anchors: rubberband anchor points
         :param kind: spline fit curve order
+        :param validate: check the parameters with isBaseFitOK, which may show a message box. Pass False off the
+                         GUI thread, after isBaseFitOK was called on the GUI thread.
+        :param cancel: function returning True when the result is no longer needed, checked between steps
+        :param derivArgs: derivative, sg_window, sg_polyorder, see get_derivative
         :return: baseline fit success (bool)
         """
+        self.derivArgs = derivArgs
         self.preprocess_method = 'rubberband'
         self.interp_method = kind
         # get rubberBaseline and debased spectrum
-        if not self.isBaseFitOK(anchors, kind, w_regions):
+        if validate and not self.isBaseFitOK(anchors, kind, w_regions):
             return False
 
-        f = interp1d(self.wav_anchor, self.spec_anchor, kind=kind)
-        self.rubberBaseline = f(self.energy)
+        self.rubberBaseline = anchor_baseline(self.wavenumbers, self.anchor_idx, kind)(self.spectrum)
         self.rubberDebased = self.specTrim - self.rubberBaseline
+        if (cancel is not None) and cancel():
+            return False
 
         # get 2nd order derivatives
         self.get_derivative()
         return True
 
-    def kohler(self, anchors=None, kind=None, w_regions=None):
+    def kohler(self, anchors=None, kind=None, w_regions=None, validate=True, cancel=None, **derivArgs):
+        """
+        Calculate the Kohler EMSC baseline, debased spectrum and 2nd order derivative of the spectrum
+        :param validate, cancel: see rubber_band
+        :return: baseline fit success (bool)
+        """
+        self.derivArgs = derivArgs
         self.preprocess_method = 'kohler'
         # get kohler baseline and debased spectrum
-        if not self.isBaseFitOK(anchors, kind, w_regions):
+        if validate and not self.isBaseFitOK(anchors, kind, w_regions):
             return False
 
-        self.kohlerDebased, self.kohlerBaseline = Kohler_zero(self.energy, self.specTrim, self.w_regions)
+        # the least squares solver of the batch engine, so a batch run reproduces the preview
+        debased, baseline = kohler_zero_batch(self.energy, self.specTrim[np.newaxis, :], self.w_regions)
+        self.kohlerDebased, self.kohlerBaseline = debased[0], baseline[0]
+        if (cancel is not None) and cancel():
+            return False
         # get 2nd order derivatives
         self.get_derivative()
         return True
 
     def get_derivative(self):
         """
-        Calculate 2nd and 4th order derivative of the spectrum
-        :param n: the derivative order
+        Calculate 2nd order derivative of the spectrum, with np.gradient or a Savitzky-Golay filter
+        (derivArgs: derivative='savgol', sg_window, sg_polyorder)
         :return: None
         """
         dx = self.energy[1] - self.energy[0]
-        if self.preprocess_method == 'rubberband':
+        if self.derivArgs.get('derivative', 'gradient') == 'savgol':
+            window, polyorder = self.derivArgs.get('sg_window', 11), self.derivArgs.get('sg_polyorder', 3)
+            if self.preprocess_method == 'rubberband':
+                self.deriv2_rubber = savgol_derivative(self.energy, self.specTrim, window, polyorder, deriv=2)
+            elif self.preprocess_method == 'kohler':
+                # kohlerDebased is in sorted wavenumber order
+                self.deriv2_kohler = savgol_derivative(np.sort(self.energy), self.kohlerDebased, window, polyorder,
+                                                       deriv=2)
+        elif self.preprocess_method == 'rubberband':
             self.deriv2_rubber = self.nthOrderGradient(dx, self.specTrim, n=2)
         elif self.preprocess_method == 'kohler':
             self.deriv2_kohler = self.nthOrderGradient(dx, self.kohlerDebased, n=2)
@@ -139,6 +169,62 @@ class Preprocessor:
         return y
 
 
+class PreviewWorker(QThread):
+    sigResult = Signal(object)
+
+    def __init__(self, request, isStale):
+        """
+        Compute the baseline preview of a spectrum in the background. The parameters are checked on the GUI
+        thread before, so no message box is opened from here.
+        :param request: dict with requestId, key, output (Preprocessor), method, args, plotChoice
+        :param isStale: function of the requestId, True once a newer request was made; the worker then stops early
+        """
+        super(PreviewWorker, self).__init__()
+        self.request = request
+        self.isStale = isStale
+
+    def run(self):
+        output, args = self.request['output'], self.request['args']
+        cancel = partial(self.isStale, self.request['requestId'])
+        if cancel():
+            return
+        try:
+            if self.request['method'] == 'kohler':
+                ok = output.kohler(validate=False, cancel=cancel, **args)
+            else:
+                ok = output.rubber_band(validate=False, cancel=cancel, **args)
+        except Exception as error:
+            msg.logMessage(f'Preview failed: {error}', msg.ERROR)
+            ok = False
+        if cancel():
+            return
+        self.request['ok'] = ok
+        self.sigResult.emit(self.request)
+
+
+class BatchWorker(QThread):
+    sigProgress = Signal(object)
+    sigChunk = Signal(object)
+
+    def __init__(self, engine):
+        """
+        Run a batch_preprocessor in the background
+        :param engine: lbl_ir batch_preprocessor
+        """
+        super(BatchWorker, self).__init__()
+        self.engine = engine
+        self.cancelEvent = threading.Event()
+        self.completed = False
+
+    def run(self):
+        self.completed = self.engine.run(progress=lambda n, total: self.sigProgress.emit((n, total)),
+                                         chunk_done=lambda i0, i1: self.sigChunk.emit((i0, i1)),
+                                         cancel=self.cancelEvent)
+
+    def cancel(self):
+        self.cancelEvent.set()
+
+
 class PreprocessParameters(ParameterTree):
     sigParamChanged = Signal(object)
 
@@ -159,12 +245,26 @@ class PreprocessParameters(ParameterTree):
                                              {'name': "Interp method",
                                               'value': 'linear',
                                               'values': ['linear', 'quadratic', 'cubic'],
-                                              'type': 'list'}
+                                              'type': 'list'},
+                                             {'name': "Derivative",
+                                              'value': 'gradient',
+                                              'values': ['gradient', 'savgol'],
+                                              'type': 'list'},
+                                             {'name': "SG window",
+                                              'value': 11,
+                                              'type': 'int',
+                                              'limits': (3, 201)},
+                                             {'name': "SG polyorder",
+                                              'value': 3,
+                                              'type': 'int',
+                                              'limits': (2, 6)}
                                              ])
         self.setParameters(self.parameter, showTop=False)
         self.setIndentation(0)
         self.parameter.child('Interp method').hide()
         self.parameter.child('Anchor points').hide()
+        self.parameter.child('SG window').hide()
+        self.parameter.child('SG polyorder').hide()
 
         # change Fonts
         self.fontSize = 12
@@ -180,7 +280,10 @@ class PreprocessParameters(ParameterTree):
         # init params dict
         self.argMap = {"Anchor points": 'anchors',
                        "Interp method": 'kind',
-                       "Fitting regions": 'w_regions'
+                       "Fitting regions": 'w_regions',
+                       "Derivative": 'derivative',
+                       "SG window": 'sg_window',
+                       "SG polyorder": 'sg_polyorder'
                        }
         # set self.processArgs to default value
         self.processArgs = {}
@@ -191,6 +294,8 @@ class PreprocessParameters(ParameterTree):
                 self.processArgs['kind'] = 'linear'
             elif child.name() == "Fitting regions":
                 self.processArgs['w_regions'] = '[(650, 750), (1780, 2680), (3680, 4000)]'
+            elif child.name() in ["Derivative", "SG window", "SG polyorder"]:
+                self.processArgs[self.argMap[child.name()]] = child.value()
 
         # connect signals
         self.parameter.child('Preprocess method').sigValueChanged.connect(self.updateMethod)
@@ -204,6 +309,10 @@ class PreprocessParameters(ParameterTree):
         :return: None
         """
         self.processArgs[self.argMap[name]] = self.parameter[name]
+        if name == "Derivative":
+            isSavgol = self.parameter[name] == 'savgol'
+            self.parameter.child('SG window').show(isSavgol)
+            self.parameter.child('SG polyorder').show(isSavgol)
         self.sigParamChanged.emit(self.processArgs)
 
     def updateMethod(self):
@@ -229,7 +338,18 @@ class PreprocessWidget(QSplitter):
         self.selectMapidx = 0
         self.resultDict = {}
         self.isBatchProcessOn = False
+        self.batchWorker = None
         self.out = None
+        # preview cache of Preprocessor results by (map, spectrum, method, parameters), least recently used first
+        self.previewCache = OrderedDict()
+        self.previewCacheSize = 64
+        self.previewRequestId = 0
+        self.previewWorker = None
+        self.pendingPreview = None
+        # parameter edits are debounced, the preview is computed when typing pauses
+        self.previewTimer = QTimer()
+        self.previewTimer.setSingleShot(True)
+        self.previewTimer.setInterval(300)
         self.dfDict = None
         self.reportList = ['preprocess_method', 'wav_anchor', 'interp_method', 'w_regions']
         self.arrayList = ['kohlerDebased', 'kohlerBaseline', 'rubberDebased', 'deriv2_kohler', 'deriv2_rubber']
@@ -338,7 +458,8 @@ class PreprocessWidget(QSplitter):
         self.saveResultBox.currentIndexChanged.connect(self.saveResults)
         self.specSelectModel.selectionChanged.connect(self.updateSpecPlot)
         self.normBox.currentIndexChanged.connect(self.updateSpecPlot)
-        self.parametertree.sigParamChanged.connect(self.updateSpecPlot)
+        self.parametertree.sigParamChanged.connect(lambda _: self.previewTimer.start())
+        self.previewTimer.timeout.connect(self.updateSpecPlot)
         self.rawSpectra.scene().sigMouseClicked.connect(self.setAnchors)
         self.parameter.child('Preprocess method').sigValueChanged.connect(self.updateMethod)
 
@@ -350,6 +471,7 @@ class PreprocessWidget(QSplitter):
         self.ind2rcList = []
         self.pathList = []
         self.dataSets = []
+        self.previewCache.clear()
 
         # get wavenumbers, rc2ind
         for header in self.headers:
@@ -425,45 +547,85 @@ class PreprocessWidget(QSplitter):
         elif specidx is None:
             return
 
-        # get plotchoice
+        # get plotchoice, only the baseline needed by the plot choice is computed
         plotChoice = self.normBox.currentIndex()
+        method = 'kohler' if plotChoice in [1, 3] else 'rubberband'
+        args = dict(self.processArgs)
+        key = (self.selectMapidx, specidx, method, tuple(sorted((k, str(v)) for k, v in args.items())))
+        # a newer request makes older ones stale: a running worker stops early, a pending one is dropped
+        self.previewRequestId += 1
+        self.pendingPreview = None
+        if key in self.previewCache:
+            self.previewCache.move_to_end(key)
+            self.showPreview(self.previewCache[key], plotChoice)
+            return
 
-        # create Preprocessor object
-        self.out = Preprocessor(self.wavenumberList[self.selectMapidx], self.dataSets[self.selectMapidx][specidx])
-        baselineOK = self.out.rubber_band(**self.processArgs) and self.out.kohler(**self.processArgs)
-
-        if not baselineOK:
+        # the preview stays at full resolution, unlike the binned previews of clustering and factorization: it fits
+        # one spectrum, so binning saves little time, and binned bands would move the anchor points and the
+        # derivative window away from the values the batch run uses
+        # check parameters on the GUI thread, which may show a message box
+        output = Preprocessor(self.wavenumberList[self.selectMapidx], self.dataSets[self.selectMapidx][specidx])
+        output.preprocess_method = method
+        if not output.isBaseFitOK(args['anchors'], args['kind'], args['w_regions']):
             return
+        # only the latest request waits for the worker, older pending ones are dropped
+        self.pendingPreview = {'requestId': self.previewRequestId, 'key': key, 'output': output, 'method': method,
+                               'args': args, 'plotChoice': plotChoice}
+        self.startPreviewWorker()
 
+    def startPreviewWorker(self):
+        if (self.pendingPreview is None) or ((self.previewWorker is not None) and self.previewWorker.isRunning()):
+            return
+        self.previewWorker = PreviewWorker(self.pendingPreview, lambda requestId: requestId != self.previewRequestId)
+        self.pendingPreview = None
+        self.previewWorker.sigResult.connect(self.receivePreview)
+        self.previewWorker.finished.connect(self.startPreviewWorker)
+        self.previewWorker.start()
+
+    def receivePreview(self, request):
+        if not request['ok']:
+            return
+        self.previewCache[request['key']] = request['output']
+        self.previewCache.move_to_end(request['key'])
+        while len(self.previewCache) > self.previewCacheSize:
+            self.previewCache.popitem(last=False)
+        if request['requestId'] == self.previewRequestId:
+            self.showPreview(request['output'], request['plotChoice'])
+
+    def showPreview(self, output, plotChoice):
+        self.out = output
         # make results report
         if plotChoice != 0:
             self.getReport(self.out, plotChoice)
 
         # if not batch processing, show plots
         if not self.isBatchProcessOn:
-            # clean up plots
-            self.rawSpectra.clearAll()
-            self.resultSpectra.clearAll()
-            if plotChoice == 0:  # plot raw spectrum
-                self.infoBox.setText('')  # clear txt
-                self.rawSpectra.plotBase(self.out, plotType='raw')
-            elif plotChoice == 1:  # plot raw, kohler
-                self.rawSpectra.plotBase(self.out, plotType='kohler_base')
-                self.resultSpectra.plotBase(self.out, plotType='kohler')
-            elif plotChoice == 2:  # plot raw, rubberband
-                self.rawSpectra.plotBase(self.out, plotType='rubber_base')
-                self.resultSpectra.plotBase(self.out, plotType='rubberband')
-            elif plotChoice == 3:  # plot raw, kohler 2nd derivative
-                self.rawSpectra.plotBase(self.out, plotType='kohler_base')
-                self.resultSpectra.plotBase(self.out, plotType='deriv2_kohler')
-            elif plotChoice == 4:  # plot raw, rubberband 2nd derivative
-                self.rawSpectra.plotBase(self.out, plotType='rubber_base')
-                self.resultSpectra.plotBase(self.out, plotType='deriv2_rubberband')
-
-            if plotChoice in [1, 3]:
-                self.parameter.child('Preprocess method').setValue('Kohler_EMSC', blockSignal=self.updateMethod)
-            elif plotChoice in [2, 4]:
-                self.parameter.child('Preprocess method').setValue('Rubberband', blockSignal=self.updateMethod)
+            self.plotResult(self.out, plotChoice)
+
+    def plotResult(self, output, plotChoice):
+        # clean up plots
+        self.rawSpectra.clearAll()
+        self.resultSpectra.clearAll()
+        if plotChoice == 0:  # plot raw spectrum
+            self.infoBox.setText('')  # clear txt
+            self.rawSpectra.plotBase(output, plotType='raw')
+        elif plotChoice == 1:  # plot raw, kohler
+            self.rawSpectra.plotBase(output, plotType='kohler_base')
+            self.resultSpectra.plotBase(output, plotType='kohler')
+        elif plotChoice == 2:  # plot raw, rubberband
+            self.rawSpectra.plotBase(output, plotType='rubber_base')
+            self.resultSpectra.plotBase(output, plotType='rubberband')
+        elif plotChoice == 3:  # plot raw, kohler 2nd derivative
+            self.rawSpectra.plotBase(output, plotType='kohler_base')
+            self.resultSpectra.plotBase(output, plotType='deriv2_kohler')
+        elif plotChoice == 4:  # plot raw, rubberband 2nd derivative
+            self.rawSpectra.plotBase(output, plotType='rubber_base')
+            self.resultSpectra.plotBase(output, plotType='deriv2_rubberband')
+
+        if plotChoice in [1, 3]:
+            self.parameter.child('Preprocess method').setValue('Kohler_EMSC', blockSignal=self.updateMethod)
+        elif plotChoice in [2, 4]:
+            self.parameter.child('Preprocess method').setValue('Rubberband', blockSignal=self.updateMethod)
 
     def getReport(self, output, plotChoice):
         resultTxt = ''
@@ -539,25 +701,30 @@ class PreprocessWidget(QSplitter):
         self.normBox.setCurrentIndex(0)
 
     def batchProcess(self):
+        # a running batch is cancelled by a second click
+        if self.isBatchProcessOn:
+            if self.batchWorker is not None:
+                self.batchWorker.cancel()
+            return
         # get current map idx
         if not self.isMapOpen():
             return
         elif self.specItemModel.rowCount() == 0:
             MsgBox('No spectrum is loaded.\nPlease click "Load spectra" to import data.')
             return
-        # check if baseline fit OK
-        if self.out is None:
-            self.out = Preprocessor(self.wavenumberList[self.selectMapidx], self.dataSets[self.selectMapidx][0])
-
         # get plotchoice
         plotChoice = self.normBox.currentIndex()
-        if plotChoice != 0:
-            # calculate rubberband and kohler baseline
-            baselineOK = self.out.rubber_band(**self.processArgs) and self.out.kohler(**self.processArgs)
+        if plotChoice in [1, 3]:
+            method = 'kohler'
+        elif plotChoice in [2, 4]:
+            method = 'rubberband'
         else:
             MsgBox('Plot type is "Raw spectrum".\nPlease change plot type to "Kohler" or "Rubberband".')
             return
-        if not baselineOK:
+        # check if baseline fit OK
+        probe = Preprocessor(self.wavenumberList[self.selectMapidx], self.dataSets[self.selectMapidx][0])
+        probe.preprocess_method = method
+        if not probe.isBaseFitOK(self.processArgs['anchors'], self.processArgs['kind'], self.processArgs['w_regions']):
             return
 
         # notice to user
@@ -566,47 +733,71 @@ class PreprocessWidget(QSplitter):
         if userChoice == QMessageBox.No:  # user choose to stop
             return
 
+        # run the selected method on all listed spectra in a worker thread
+        spectraIds = [self.specItemModel.item(i).idx for i in range(self.specItemModel.rowCount())]
+        try:
+            engine = batch_preprocessor(self.wavenumberList[self.selectMapidx], self.dataSets[self.selectMapidx],
+                                        spectra_ids=spectraIds, method=method, **self.processArgs)
+        except (ValueError, SyntaxError) as error:
+            MsgBox(f'Batch process parameters are not valid:\n{error}', type='error')
+            return
         self.isBatchProcessOn = True
+        self.batchPlotChoice = plotChoice
+        self.batchBtn.setText('Cancel batch')
+        self.batchWorker = BatchWorker(engine)
+        self.batchWorker.sigProgress.connect(self.showBatchProgress)
+        self.batchWorker.sigChunk.connect(self.showBatchResult)
+        self.batchWorker.finished.connect(self.finishBatch)
+        self.batchWorker.start()
+
+    def showBatchProgress(self, progress):
+        n_done, n_total = progress
+        msg.showMessage(f'Processing {n_done}/{n_total} spectra')
+
+    def showBatchResult(self, chunk):
+        """
+        Show the last spectrum of a processed chunk
+        """
+        engine = self.batchWorker.engine
+        k = chunk[1] - 1
+        output = Preprocessor(engine.wavenumbers, self.dataSets[self.selectMapidx][engine.spectra_ids[k]])
+        output.parse_anchors(self.processArgs['anchors'])
+        output.preprocess_method = engine.method
+        for name, result in engine.outputs.items():
+            setattr(output, name, result[k])
+        self.plotResult(output, self.batchPlotChoice)
+
+    def finishBatch(self):
+        engine = self.batchWorker.engine
+        completed = self.batchWorker.completed
+        self.batchWorker = None
+        self.isBatchProcessOn = False
+        self.batchBtn.setText('Batch process')
+        if not completed:
+            msg.showMessage('Batch processing is cancelled.')
+            return
 
-        # init resultSetsDict, paramsDict
-        self.resultSetsDict = {}
-        self.paramsDict = {}
-        self.paramsDict['specID'] = []
-        self.paramsDict['row_column'] = []
+        # collect results: one row per spectrum for the computed arrays, and the run parameters
         ind2rc = self.ind2rcList[self.selectMapidx]
-        energy = self.out.energy
-        n_energy = len(energy)
-        for item in self.arrayList:
-            self.resultSetsDict[item] = np.empty((0, n_energy))
+        energy = engine.energy
+        self.resultSetsDict = {item: engine.outputs[item] for item in self.arrayList if item in engine.outputs}
+        params = engine.params()
+        n_spectra = len(engine.spectra_ids)
+        self.paramsDict = {'specID': list(engine.spectra_ids),
+                           'row_column': [ind2rc[i] for i in engine.spectra_ids]}
         for item in self.reportList:
-            self.paramsDict[item] = []
-        # batch process begins
-        n_spectra = self.specItemModel.rowCount()
-        for i in range(n_spectra):
-            msg.showMessage(f'Processing {i + 1}/{n_spectra} spectra')
-            # select each spec and collect results
-            self.specSelectModel.select(self.specItemModel.index(i, 0), QItemSelectionModel.ClearAndSelect)
-            # get spec idx
-            currentSpecItem = self.specItemModel.item(i)
-            self.paramsDict['specID'].append(currentSpecItem.idx)
-            self.paramsDict['row_column'].append(ind2rc[currentSpecItem.idx])
-            # append all results into a single array/list
-            for item in self.arrayList:
-                self.resultSetsDict[item] = np.append(self.resultSetsDict[item], self.resultDict[item].reshape(1, -1),
-                                                      axis=0)
-            for item in self.reportList:
-                self.paramsDict[item].append(self.resultDict[item])
+            self.paramsDict[item] = [params[item]] * n_spectra
 
         # result collection completed. convert paramsDict to df
         self.dfDict = {}
         self.dfDict['param'] = pd.DataFrame(self.paramsDict).set_index('specID')
-        for item in self.arrayList:
+        for item in self.resultSetsDict:
             # convert resultSetsDict to df
             self.dfDict[item] = pd.DataFrame(self.resultSetsDict[item], columns=energy.tolist(),
-                                        index=self.paramsDict['specID']).rename_axis('specID', axis=0)
+                                             index=self.paramsDict['specID']).rename_axis('specID', axis=0)
+        self.batchEnergy = energy
 
-        # batch process completed
-        self.isBatchProcessOn = False
+        msg.logMessage(f'Extinction basis cache: {extinction_cache.stats()}')
         msg.showMessage(f'Batch processing is completed! Saving results to csv files.')
         #  save df to files
         self.saveResults()
@@ -615,10 +806,14 @@ class PreprocessWidget(QSplitter):
         if self.dfDict is None:
             return
         filePath = self.pathList[self.selectMapidx]
-        energy = self.out.energy
+        energy = self.batchEnergy
         saveDataChoice = self.saveResultBox.currentIndex()
         if saveDataChoice != 5:  # save a single result
             saveDataType = self.arrayList[saveDataChoice]
+            if saveDataType not in self.dfDict:  # only the selected preprocess method was batch processed
+                MsgBox(f'"{self.saveResultBox.currentText()}" was not computed by the last batch process.\n'
+                       f'Please batch process with the corresponding plot type.')
+                return
             dirName, csvName, h5Name = self.saveToFiles(energy, self.dfDict, filePath, saveDataType)
             if h5Name is None:
                 MsgBox(f'Processed data was saved as csv file at: \n{dirName + csvName}')
@@ -629,6 +824,8 @@ class PreprocessWidget(QSplitter):
             csvList = []
             h5List = []
             for saveDataType in self.arrayList:
+                if saveDataType not in self.dfDict:
+                    continue
                 dirName, csvName, h5Name = self.saveToFiles(energy, self.dfDict, filePath, saveDataType)
                 csvList.append(csvName)
                 h5List.append(h5Name)
@@ -668,10 +865,9 @@ class PreprocessWidget(QSplitter):
             fullMap.N_w = len(energy)
             fullMap.data = np.zeros((fullMap.data.shape[0], fullMap.N_w))
             fullMap.imageCube = np.zeros((fullMap.imageCube.shape[0], fullMap.imageCube.shape[1], fullMap.N_w))
-            for i in self.paramsDict['specID']:
-                fullMap.data[i, :] = self.resultSetsDict[saveDataType][i, :]
+            for k, i in enumerate(self.paramsDict['specID']):
                 row, col = ind2rc[i]
-                fullMap.imageCube[row, col, :] = fullMap.data[i, :] = self.resultSetsDict[saveDataType][i, :]
+                fullMap.imageCube[row, col, :] = fullMap.data[i, :] = self.resultSetsDict[saveDataType][k, :]
             # save data as hdf5
             h5Name = oldFileName[:-3] + '_' + saveDataType + '.h5'
             fullMap.write_as_hdf5(dirName + h5Name)
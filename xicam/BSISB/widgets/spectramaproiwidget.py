@@ -12,6 +12,28 @@ from xicam.BSISB.widgets.uiwidget import MsgBox, uiSaveFile, uiGetFile
 from xicam.BSISB.widgets.mapviewwidget import MapViewWidget
 from xicam.BSISB.widgets.spectraplotwidget import SpectraPlotWidget
 
+# ROI state files of version 2 are in stored map coordinates (row 0 at the bottom); older ones have no version and
+# are in the coordinates of the vertically flipped image the map view used to show
+ROI_STATE_VERSION = 2
+
+
+def flipRoiState(state, n_row):
+    """
+    Mirror a PolyLineROI state across the horizontal mid line of a map, from the flipped image coordinates of an
+    old ROI state file to stored map coordinates: a vertex at y goes to n_row - y, which covers the same pixels
+    :param state: roi.getState() dict
+    :param n_row: number of map rows
+    :return: state with its vertices in parent coordinates, at pos (0, 0) and angle 0
+    """
+    angle = np.deg2rad(state['angle'])
+    rot = np.array([[np.cos(angle), -np.sin(angle)], [np.sin(angle), np.cos(angle)]])
+    points = np.array([[p[0], p[1]] for p in state['points']]) @ rot.T + [state['pos'][0], state['pos'][1]]
+    points[:, 1] = n_row - points[:, 1]
+    state = dict(state)
+    state.update(pos=[0, 0], angle=0, points=points.tolist())
+    return state
+
+
 class MapView(QSplitter):
     sigRoiPixels = Signal(object)
     sigRoiState = Signal(object)
@@ -139,7 +161,7 @@ class MapView(QSplitter):
     def saveRoi(self):
         parameterDict = {name: self.parameter[name] for name in self.parameter.names.keys()}
         roiStates = {'roiBtn': self.roiBtn.isChecked(), 'maskBtn': self.autoMaskBtn.isChecked(),
-                    'roiState': self.roi.getState(), 'parameter': parameterDict}
+                    'roiState': self.roi.getState(), 'parameter': parameterDict, 'version': ROI_STATE_VERSION}
         filePath, fileName, canceled = uiSaveFile('Save ROI state', self.path, "Pickle Files (*.pkl)")
         if not canceled:
             with open(filePath + fileName, 'wb') as f:
@@ -152,6 +174,8 @@ class MapView(QSplitter):
             with open(filePath + fileName, 'rb') as f:
                 roiStates = pickle.load(f)
             self.roiBtn.setChecked(roiStates['roiBtn'])
+            if roiStates.get('version', 1) < 2:
+                roiStates['roiState'] = flipRoiState(roiStates['roiState'], self.row)
             self.roi.setState(roiStates['roiState'])
             if roiStates['roiBtn']:
                 self.roi.show()
@@ -178,7 +202,7 @@ class MapView(QSplitter):
             self.isDenseImage = False
         #set up X,Y grid
         x = np.linspace(0, self.col - 1, self.col)
-        y = np.linspace(self.row - 1, 0, self.row)
+        y = np.linspace(0, self.row - 1, self.row)
         self.X, self.Y = np.meshgrid(x, y)
         if self.isDenseImage:
             self.fullMap = list(zip(self.Y.ravel(), self.X.ravel()))
@@ -271,7 +295,6 @@ class MapView(QSplitter):
                 self.sigRoiPixels.emit(allSelected)  # no ROI, select all sparse rc2ind
                 self.selectMask = np.zeros((self.row, self.col))
                 self.selectMask[allSelected[:, 0], allSelected[:, 1]] = 1
-                self.selectMask = np.flipud(self.selectMask)
             return
         elif self.pixSelection['ROI'] is None:
             allSelected = set(self.pixSelection['Mask']) #de-duplication of pixels
@@ -289,7 +312,6 @@ class MapView(QSplitter):
         self.selectMask = np.zeros((self.row, self.col))
         if len(allSelected) > 0:
             self.selectMask[allSelected[:, 0], allSelected[:, 1]] = 1
-            self.selectMask = np.flipud(self.selectMask)
         self.sigRoiPixels.emit(allSelected)
         # show SelectMask
         self.showSelectMask(selector)